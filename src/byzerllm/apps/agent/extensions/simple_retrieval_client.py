@@ -150,9 +150,9 @@ field(created_time,long,sort)
                 "owner":owner,
                 "chunk":self.search_tokenize(item),
                 "raw_chunk":item,
-                "chunk_vector":self.emb(item),
+                "chunk_vector":chunk_vector,
                 "created_time":int(time.time()*1000),
-                } for i,item in enumerate(content_chunks)]
+                } for i,(item,chunk_vector) in enumerate(zip(content_chunks,self.emb_batch(content_chunks)))]
             
             self.retrieval.build_from_dicts(self.retrieval_cluster,self.retrieval_db,"text_content_chunk",text_content_chunks)    
 
@@ -244,6 +244,11 @@ field(created_time,long,sort)
     def emb(self,s:str):        
         return self.llm.emb(self.llm.default_emb_model_name,LLMRequest(instruction=s))[0].output[0:1024] 
 
+    def emb_batch(self,texts:List[str]):
+        if not texts:
+            return []
+        return [item.output[0:1024] for item in self.llm.emb(self.llm.default_emb_model_name,LLMRequest(instruction=texts))]
+
 
     def split_text_into_chunks(self,s:str):
         # self.llm.apply_sql_func(
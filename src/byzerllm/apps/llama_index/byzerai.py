@@ -63,6 +63,16 @@ class ByzerAI(CustomLLM):
         completion_response = CompletionResponse(text=m[0].output, raw=None)
         return completion_response_to_chat_response(completion_response)
 
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        conversations = [{
+            "role":message.role,
+            "content":message.content
+        } for message in messages]
+        m = await self._model.async_chat_oai(conversations=conversations)
+        completion_response = CompletionResponse(text=m[0].output, raw=None)
+        return completion_response_to_chat_response(completion_response)
+
     @llm_chat_callback()
     def stream_chat(
         self, messages: Sequence[ChatMessage], **kwargs: Any
@@ -90,6 +100,14 @@ class ByzerAI(CustomLLM):
         completion_response = CompletionResponse(text=m[0].output, raw=None)
         return completion_response
 
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:        
+        m = await self._model.async_chat_oai(conversations=[{"role":"user","content":prompt}])
+        completion_response = CompletionResponse(text=m[0].output, raw=None)
+        return completion_response
+
     @llm_completion_callback()
     def stream_complete(
         self, prompt: str, formatted: bool = False, **kwargs: Any
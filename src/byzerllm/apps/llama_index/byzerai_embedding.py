@@ -4,8 +4,7 @@ from typing import TYPE_CHECKING, List, Optional
 from llama_index.core.embeddings.base import DEFAULT_EMBED_BATCH_SIZE, BaseEmbedding
 from llama_index.bridge.pydantic import PrivateAttr
 
-from byzerllm.utils.client import ByzerLLM
-from byzerllm.utils.langutil import asyncfy_with_semaphore
+from byzerllm.utils.client import ByzerLLM,LLMRequest
 
 class ByzerAIEmbedding(BaseEmbedding):
     
@@ -28,15 +27,18 @@ class ByzerAIEmbedding(BaseEmbedding):
         return self._llm.emb_query(query)[0].output[0:1024]
 
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        return asyncfy_with_semaphore(self._get_query_embedding, query)
+        return (await self._llm.async_emb_query(query))[0].output[0:1024]
             
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
-        return asyncfy_with_semaphore(self._get_query_embedding, text)
+        return await self._aget_query_embedding(text)
 
     def _get_text_embedding(self, text: str) -> List[float]:
         return self._get_query_embedding(text)
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Get text embeddings."""
-        return [self._get_text_embedding(text) for text in texts]
+        return [item.output[0:1024] for item in self._llm.emb(None,LLMRequest(instruction=texts))]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [item.output[0:1024] for item in await self._llm.async_emb(None,LLMRequest(instruction=texts))]
@@ -5,18 +5,25 @@ import os
 import time
 import types
 import copy
+import threading
 import asyncio
+import contextlib
+import uuid
 from typing import Any,Any,Dict, List,Tuple,Generator,Optional,Union
 from pyjava.api.mlsql import DataServer
 from byzerllm.utils.metrics import Metric
 from byzerllm import BlockRow,get_real_tokenizer
+from .assisted_generation import AssistedGenerationStats
 from byzerllm.utils import (VLLMStreamServer,
+                            StreamServerStreamer,
+                            get_or_create_stream_server,
                             StreamOutputs,
                             SingleOutput,
                             SingleOutputMeta,
                             compute_max_new_tokens,
                             tokenize_stopping_sequences,
-                            StopSequencesCriteria)
+                            StopSequencesCriteria,
+                            StopSequenceMatcher)
                             
 
 try:
@@ -59,7 +66,7 @@ def stream_chat(self,tokenizer,ins:str, his:List[Dict[str,str]]=[],
         top_p:float=0.95,
         temperature:float=0.1,**kwargs):
  
-    if self.get_meta()[0]["message_format"]:
+    if self.get_meta()[0].get("message_format",False):
         config = copy.deepcopy(self.generation_config)
         config.max_length = max_length
         config.temperature = temperature
@@ -86,6 +93,15 @@ def stream_chat(self,tokenizer,ins:str, his:List[Dict[str,str]]=[],
             "prob": -1.0
         }})] 
 
+    stream = get_bool(kwargs,"stream",False)
+
+    if getattr(self,"batch_scheduler",None) is not None:
+        request = build_batch_request(self,tokenizer,ins,max_length=max_length,top_p=top_p,temperature=temperature,**kwargs)
+        if stream:
+            return submit_stream_request(self,tokenizer,request,kwargs)
+        self.batch_scheduler.submit(request).result()
+        return batch_response(tokenizer,request)
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu") 
     timeout_s = float(kwargs.get("timeout_s",60*5)) 
     skip_check_min_length = int(kwargs.get("stopping_sequences_skip_check_min_length",0))       
@@ -124,21 +140,49 @@ def stream_chat(self,tokenizer,ins:str, his:List[Dict[str,str]]=[],
     
     if self.generation_config and self.generation_config.bos_token_id:
         other_params["bos_token_id"] = self.generation_config.bos_token_id
+
+    draft_model = getattr(self,"draft_model",None)
+    if draft_model is not None:
+        other_params["assistant_model"] = draft_model
     
+    if stream:
+        request_id = kwargs["request_id"] if "request_id" in kwargs else str(uuid.uuid4())
+        streamer = start_stream(request_id,tokenizer,tokens["input_ids"].shape[1])
+        def run():
+            try:
+                generate_with_prefix_cache(self,
+                    input_ids=tokens["input_ids"],
+                    max_new_tokens= max_new_tokens,        
+                    temperature=temperature,
+                    top_p=top_p,        
+                    max_time=timeout_s,
+                    stopping_criteria=stopping_criteria,
+                    streamer=streamer,
+                    **other_params
+                )
+            except Exception as inst:
+                print(f"generate failed for stream request {request_id}: {inst}",flush=True)
+                streamer.end()
+        threading.Thread(target=run,daemon=True).start()
+        return [("",{"metadata":{"request_id":request_id,"stream_server":"VLLM_STREAM_SERVER"}})]
+
+    assisted_stats = AssistedGenerationStats(self,draft_model,self.decode_time) if draft_model is not None else contextlib.nullcontext()
     start_time = time.monotonic()        
-    response = self.generate(
-        input_ids=tokens["input_ids"],
-        max_new_tokens= max_new_tokens,        
-        temperature=temperature,
-        top_p=top_p,        
-        max_time=timeout_s,
-        stopping_criteria=stopping_criteria,
-        **other_params
-    )    
+    with assisted_stats:
+        (response,num_cached_tokens) = generate_with_prefix_cache(self,
+            input_ids=tokens["input_ids"],
+            max_new_tokens= max_new_tokens,        
+            temperature=temperature,
+            top_p=top_p,        
+            max_time=timeout_s,
+            stopping_criteria=stopping_criteria,
+            **other_params
+        )    
     time_taken = time.monotonic() - start_time    
     new_tokens = response[0][tokens["input_ids"].shape[1]:]
     print(f"generate took {time_taken} s to complete. tokens/s:{len(new_tokens)/time_taken}",flush=True)
     answer = tokenizer.decode(new_tokens, skip_special_tokens=True)
+    assisted_meta = assisted_stats.metadata(len(new_tokens)) if draft_model is not None else {}
     
     return [(answer,{"metadata":{
             "request_id":"",
@@ -146,10 +190,114 @@ def stream_chat(self,tokenizer,ins:str, his:List[Dict[str,str]]=[],
             "generated_tokens_count":len(new_tokens),
             "time_cost":time_taken,
             "first_token_time": -1.0,
-            "speed":float(generated_tokens_count)/time_taken*1000,
-            "prob": -1.0
+            "speed":float(len(new_tokens))/time_taken,
+            "prob": -1.0,
+            "prefix_cache_hit_tokens":num_cached_tokens,
+            **assisted_meta
         }})] 
 
+def generate_with_prefix_cache(self,input_ids:torch.Tensor,**kwargs)->Tuple[torch.Tensor,int]:
+    '''
+    generate from the longest cached prefix of the prompt if the prefix cache is enabled, 
+    return the output token ids and the number of the cached prompt tokens.
+    '''
+    prefix_cache = getattr(self,"prefix_cache",None)
+    # the assisted generation does not start from the cached past_key_values correctly
+    if prefix_cache is None or "assistant_model" in kwargs:
+        return (self.generate(input_ids=input_ids,**kwargs),0)
+    prompt = input_ids[0].tolist()
+    (num_cached_tokens,past_key_values) = prefix_cache.get(prompt)
+    output = self.generate(input_ids=input_ids,
+                           past_key_values=past_key_values,
+                           use_cache=True,
+                           return_dict_in_generate=True,
+                           **kwargs)
+    prefix_cache.put(prompt,output.past_key_values)
+    return (output.sequences,num_cached_tokens)
+
+def start_stream(request_id:str,tokenizer,input_tokens_count:int,skip_prompt:bool=True)->StreamServerStreamer:
+    '''
+    add the "RUNNING" item of the request to the stream server and return the streamer which 
+    sends the generated text to it.
+    '''
+    server = get_or_create_stream_server("VLLM_STREAM_SERVER")
+    ray.get(server.add_item.remote(request_id,"RUNNING"))
+    return StreamServerStreamer(tokenizer,request_id,input_tokens_count=input_tokens_count,
+                                server_name="VLLM_STREAM_SERVER",skip_prompt=skip_prompt)
+
+def submit_stream_request(self,tokenizer,request,kwargs:Dict[str,Any]):
+    request_id = kwargs["request_id"] if "request_id" in kwargs else str(uuid.uuid4())
+    # the scheduler only puts the new tokens to the streamer
+    request.streamer = start_stream(request_id,tokenizer,len(request.input_ids),skip_prompt=False)
+    self.batch_scheduler.submit(request)
+    return [("",{"metadata":{"request_id":request_id,"stream_server":"VLLM_STREAM_SERVER"}})]
+
+def build_batch_request(self,tokenizer,ins:str,
+        max_length:int=4090, 
+        top_p:float=0.95,
+        temperature:float=0.1,**kwargs):
+    from .batch_scheduler import BatchRequest
+    input_ids = tokenizer(ins, return_token_type_ids=False)["input_ids"]
+    max_new_tokens = max_length - len(input_ids)
+    if max_new_tokens <= 0:
+        raise Exception(f"Input is too long ({len(input_ids)}). Try to reduce the length of history or use a larger `max_length` value (now:{max_length})")
+    if "max_new_tokens" in kwargs:
+        max_new_tokens = min(max_new_tokens,int(kwargs["max_new_tokens"]))
+
+    eos_token_ids = []
+    if self.generation_config and self.generation_config.eos_token_id is not None:
+        eos_token_id = self.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id,list) else [eos_token_id]
+
+    stopping_criteria = None
+    if "stopping_sequences" in kwargs:
+        skip_check_min_length = int(kwargs.get("stopping_sequences_skip_check_min_length",0))
+        matcher = StopSequenceMatcher(tokenizer,tokenize_stopping_sequences(tokenizer,kwargs["stopping_sequences"].split(",")),
+                                      skip_check_min_length=skip_check_min_length)
+        state = matcher.new_state()
+        def stopping_criteria(output_ids:List[int])->bool:
+            return matcher.update(state,output_ids[len(state.token_ids):])
+
+    do_sample = get_bool(kwargs,"do_sample",bool(getattr(self.generation_config,"do_sample",False)))
+    return BatchRequest(input_ids=input_ids,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=do_sample,
+                        temperature=temperature,
+                        top_p=top_p,
+                        repetition_penalty=float(kwargs.get("repetition_penalty",1.0)),
+                        eos_token_ids=eos_token_ids,
+                        stopping_criteria=stopping_criteria,
+                        timeout_s=float(kwargs.get("timeout_s",60*5)))
+
+def batch_response(tokenizer,request):
+    answer = tokenizer.decode(request.output_ids, skip_special_tokens=True)
+    time_cost = (request.finish_time - request.submit_time) * 1000
+    generated_tokens_count = len(request.output_ids)
+    return [(answer,{"metadata":{
+            "request_id":"",
+            "input_tokens_count": len(request.input_ids),
+            "generated_tokens_count":generated_tokens_count,
+            "time_cost":time_cost,
+            "first_token_time": (request.first_token_time - request.submit_time) * 1000,
+            "speed":float(generated_tokens_count)/time_cost*1000 if time_cost > 0 else 0.0,
+            "prob": -1.0,
+            "finish_reason":request.finish_reason
+        }})]
+
+async def async_batch_stream_chat(self,tokenizer,ins:str, his:List[Dict[str,str]]=[],  
+        max_length:int=4090, 
+        top_p:float=0.95,
+        temperature:float=0.1,**kwargs):
+    '''
+    submit the request to the batch scheduler without blocking the event loop, 
+    so the concurrent requests of the worker are batched together.
+    '''
+    request = build_batch_request(self,tokenizer,ins,max_length=max_length,top_p=top_p,temperature=temperature,**kwargs)
+    if get_bool(kwargs,"stream",False):
+        return await asyncio.to_thread(submit_stream_request,self,tokenizer,request,kwargs)
+    await asyncio.wrap_future(self.batch_scheduler.submit(request))
+    return batch_response(tokenizer,request)
+
 async def async_get_meta(model):     
      model:AsyncLLMEngine = model     
      config = await model.get_model_config()
@@ -166,7 +314,8 @@ async def async_get_meta(model):
               "support_stream": True,
               "support_chat_template": support_chat_template,
               "max_model_len":config.max_model_len,
-              "architectures":getattr(config.hf_config, "architectures", [])
+              "architectures":getattr(config.hf_config, "architectures", []),
+              "tokenizer_path":getattr(config, "tokenizer", None)
               }]
 
 async def async_vllm_chat(model,tokenizer,ins:str, his:List[Tuple[str,str]]=[],  
@@ -232,7 +381,23 @@ async def async_vllm_chat(model,tokenizer,ins:str, his:List[Tuple[str,str]]=[],
         server = ray.get_actor("VLLM_STREAM_SERVER")
         async def writer():
             results_generator = model.generate(ins, sampling_params,request_id) 
+            # only send the new text of every step to the stream server,
+            # fallback to the full text if the stream server do not support add_delta
+            support_delta = True
+            pre_text_lengths = {}
             async for request_output in results_generator:     
+                if support_delta:
+                    v = StreamOutputs(outputs=[SingleOutput(text=item.text[pre_text_lengths.get(index,0):],metadata=SingleOutputMeta(
+                        input_tokens_count=len(request_output.prompt_token_ids),
+                        generated_tokens_count=len(item.token_ids),
+                    )) for index,item in enumerate(request_output.outputs)])
+                    try:
+                        await server.add_delta.remote(request_output.request_id, v)
+                        pre_text_lengths = {index:len(item.text) for index,item in enumerate(request_output.outputs)}
+                        continue
+                    except Exception:
+                        support_delta = False
+                
                 v = StreamOutputs(outputs=[SingleOutput(text=item.text,metadata=SingleOutputMeta(
                     input_tokens_count=len(request_output.prompt_token_ids),
                     generated_tokens_count=len(item.token_ids),
@@ -289,10 +454,7 @@ def init_model(model_dir,infer_params:Dict[str,str]={},sys_conf:Dict[str,str]={}
         global INFERENCE_NAME
         INFERENCE_NAME = infer_params.get("udfName","auto")
 
-        try:
-            ray.get_actor("VLLM_STREAM_SERVER")
-        except ValueError:            
-            ray.remote(VLLMStreamServer).options(name="VLLM_STREAM_SERVER",lifetime="detached",max_concurrency=1000).remote()
+        get_or_create_stream_server("VLLM_STREAM_SERVER")
                         
         worker_use_ray: bool = get_bool(infer_params,"backend.worker_use_ray",True)
         engine_use_ray: bool = get_bool(infer_params,"backend.engine_use_ray",False)
@@ -402,6 +564,47 @@ def init_model(model_dir,infer_params:Dict[str,str]={},sys_conf:Dict[str,str]={}
     extra_meta = {}
     if has_chat:
         extra_meta["message_format"] = True
+    else:
+        # the text is streamed by `StreamServerStreamer`, the chat method of the model can not stream
+        extra_meta["support_stream"] = True
+        get_or_create_stream_server("VLLM_STREAM_SERVER")
+
+    # continuous batching of the concurrent requests, see `BatchScheduler`
+    batch_scheduler = None
+    if get_bool(infer_params,"backend.continuous_batching",False) and not has_chat:
+        from .batch_scheduler import BatchScheduler
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else (model.generation_config.pad_token_id or 0)
+        batch_scheduler = BatchScheduler(model,
+                                         max_batch_size=get_int(infer_params,"backend.max_batch_size",8),
+                                         max_batch_tokens=get_int(infer_params,"backend.max_batch_tokens",8192),
+                                         pad_token_id=pad_token_id)
+        extra_meta["continuous_batching"] = True
+
+    # the past_key_values of the shared prompt prefix (e.g. the system prompt), see `PrefixKVCache`
+    prefix_cache = None
+    if get_bool(infer_params,"backend.prefix_cache",False) and not has_chat:
+        from .prefix_cache import PrefixKVCache
+        prefix_cache = PrefixKVCache(max_bytes=get_int(infer_params,"backend.prefix_cache_max_bytes",2*1024**3),
+                                     block_size=get_int(infer_params,"backend.prefix_cache_block_size",64))
+        extra_meta["prefix_cache"] = True
+
+    # assisted generation: the draft model proposes the tokens and the model verifies them in one forward.
+    # the draft model should use the same tokenizer as the model
+    draft_model = None
+    decode_time = None
+    draft_model_dir = infer_params.get("backend.draft_model_dir",None)
+    if draft_model_dir and not has_chat:
+        from .assisted_generation import measure_decode_time,install_stats_hooks
+        print(f"load draft model {draft_model_dir} for assisted generation",flush=True)
+        # the proposed tokens are verified by the model, so the draft model follows its dtype and device
+        draft_model = AutoModelForCausalLM.from_pretrained(draft_model_dir,trust_remote_code=True,
+                                                           device_map={"":str(model.device)},
+                                                           torch_dtype=model.dtype).eval()
+        if "backend.num_assistant_tokens" in infer_params:
+            draft_model.generation_config.num_assistant_tokens = get_int(infer_params,"backend.num_assistant_tokens",20)
+        decode_time = measure_decode_time(model)
+        install_stats_hooks(model,draft_model)
+        extra_meta["draft_model"] = draft_model_dir
 
     def get_meta(self): 
         config = self.config           
@@ -410,11 +613,18 @@ def init_model(model_dir,infer_params:Dict[str,str]={},sys_conf:Dict[str,str]={}
             "backend":"transformers",
             "max_model_len":getattr(config, "model_max_length", -1),
             "architectures":getattr(config, "architectures", []),
+            "tokenizer_path":pretrained_model_dir,
             **extra_meta
         }]    
 
     model.stream_chat = types.MethodType(stream_chat, model)
     model.get_meta = types.MethodType(get_meta, model)     
+    model.prefix_cache = prefix_cache
+    model.draft_model = draft_model
+    model.decode_time = decode_time
+    if batch_scheduler is not None:
+        model.batch_scheduler = batch_scheduler
+        model.async_stream_chat = types.MethodType(async_batch_stream_chat, model)
     return (model,tokenizer)
 
 
@@ -0,0 +1,126 @@
+from typing import Any,Dict,List,Optional
+import statistics
+import threading
+import weakref
+import time
+import torch
+
+
+# the stats of the running `generate` by thread. The hooks are installed on the models only once,
+# since adding/removing the hooks of a model while other threads run its forward is not safe, 
+# and they route the forward calls of every thread to its own stats.
+_ACTIVE_STATS:Dict[int,"AssistedGenerationStats"] = {}
+_HOOKED_MODULES = weakref.WeakSet()
+_HOOKS_LOCK = threading.Lock()
+
+
+def _pre_forward_hook(module,args):
+    stats = _ACTIVE_STATS.get(threading.get_ident(),None)
+    if stats is not None and module is stats.model:
+        stats.forward_start = time.monotonic()
+
+
+def _forward_hook(module,args,output):
+    stats = _ACTIVE_STATS.get(threading.get_ident(),None)
+    if stats is None:
+        return
+    if module is stats.model:
+        stats.forward_times.append(time.monotonic() - stats.forward_start)
+    elif module is stats.draft_model:
+        stats.num_draft_forwards += 1
+
+
+def install_stats_hooks(*modules):
+    '''
+    install the hooks of `AssistedGenerationStats`, it is better to call it when the models are loaded 
+    and before they serve any request
+    '''
+    with _HOOKS_LOCK:
+        for module in modules:
+            if module in _HOOKED_MODULES:
+                continue
+            module.register_forward_pre_hook(_pre_forward_hook)
+            module.register_forward_hook(_forward_hook)
+            _HOOKED_MODULES.add(module)
+
+
+class AssistedGenerationStats:
+    '''
+    Count the forward calls of the model and the draft model during one `generate(assistant_model=...)`.
+
+    Every forward of the draft model proposes one token, and every forward of the model verifies the proposed
+    tokens and adds one token of its own, so:
+
+        accepted tokens = generated tokens - verification steps
+        accept rate = accepted tokens / proposed tokens
+
+    The speedup is estimated by the time the model would take to generate the same tokens one by one,
+    which is the first forward (the prompt) plus `decode_time` per token. `decode_time` is measured by
+    `measure_decode_time` when the model is loaded, if it is not set the median time of the verification forwards
+    is used, which is slower than a forward of one token, so the speedup is overestimated.
+
+    Only the forward calls in the thread which enters the context are counted, so the concurrent requests 
+    on the same model do not mix, and `generate` should run in that thread.
+
+    ```python
+    with AssistedGenerationStats(model,draft_model) as stats:
+        output = model.generate(input_ids,assistant_model=draft_model)
+    stats.metadata(num_generated_tokens)
+    ```
+    '''
+    def __init__(self,model,draft_model,decode_time:Optional[float]=None):
+        self.model = model
+        self.draft_model = draft_model
+        self.decode_time = decode_time
+        self.forward_times:List[float] = []
+        self.num_draft_forwards = 0
+        self.forward_start = 0.0
+        self.start_time = 0.0
+        self.time_cost = 0.0
+
+    def __enter__(self):
+        install_stats_hooks(self.model,self.draft_model)
+        _ACTIVE_STATS[threading.get_ident()] = self
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.time_cost = time.monotonic() - self.start_time
+        _ACTIVE_STATS.pop(threading.get_ident(),None)
+
+    def metadata(self,num_generated_tokens:int)->Dict[str,Any]:
+        num_steps = len(self.forward_times)
+        num_accepted = max(0,num_generated_tokens - num_steps)
+        estimated_speedup = -1.0
+        if num_steps > 1 and self.time_cost > 0:
+            decode_time = self.decode_time if self.decode_time else statistics.median(self.forward_times[1:])
+            baseline = self.forward_times[0] + (num_generated_tokens - 1) * decode_time
+            estimated_speedup = baseline / self.time_cost
+        return {
+            "draft_tokens_count":self.num_draft_forwards,
+            "draft_accepted_tokens_count":num_accepted,
+            "draft_accept_rate":num_accepted / self.num_draft_forwards if self.num_draft_forwards > 0 else 0.0,
+            "verify_steps":num_steps,
+            "estimated_speedup":estimated_speedup
+        }
+
+
+def measure_decode_time(model,num_tokens:int=16,prompt_length:int=16)->float:
+    '''
+    the median seconds of a forward of one token when the model generates without the draft model
+    '''
+    forward_times = []
+    state = {}
+    def pre_forward(module,args):
+        state["start"] = time.monotonic()
+    def post_forward(module,args,output):
+        forward_times.append(time.monotonic() - state["start"])
+    handles = [model.register_forward_pre_hook(pre_forward),model.register_forward_hook(post_forward)]
+    try:
+        with torch.no_grad():
+            model.generate(torch.ones((1,prompt_length),dtype=torch.long,device=model.device),
+                           max_new_tokens=num_tokens,min_new_tokens=num_tokens,do_sample=False,pad_token_id=0)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return statistics.median(forward_times[1:]) if len(forward_times) > 1 else 0.0
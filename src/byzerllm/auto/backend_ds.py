@@ -3,6 +3,8 @@ from transformers import AutoTokenizer, AutoModelForCausalLM,BitsAndBytesConfig
 import ray
 import torch
 import deepspeed
+import threading
+import uuid
 import os
 from ray.air.util.torch_dist import (
     ActorHandle,
@@ -11,6 +13,7 @@ from ray.air.util.torch_dist import (
     get_address_and_port,
 )
 from ray.train.constants import DEFAULT_NCCL_SOCKET_IFNAME
+from byzerllm.utils import StreamServerStreamer,get_or_create_stream_server
 
 class ParallelConfig:
     """Configuration for the distributed execution.
@@ -104,16 +107,27 @@ class Worker:
     def execute_model(self,ins:str, his:List[Tuple[str,str]]=[],  
         max_length:int=4096, 
         top_p:float=0.95,
-        temperature:float=0.1,**kwargs):
+        temperature:float=0.1,stream_request_id:Optional[str]=None,**kwargs):
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         tokens = self.tokenizer(ins, return_token_type_ids=False,return_tensors="pt").to(device)
-        response = self.model.generate(
-            input_ids=tokens["input_ids"],
-            max_new_tokens=max_length,
-            repetition_penalty=1.05,
-            temperature=temperature,
-            attention_mask=tokens.attention_mask        
-        )
+        # all the ranks generate the same tokens, only the first one sends them to the stream server
+        streamer = None
+        if stream_request_id is not None and self.rank == 0:
+            streamer = StreamServerStreamer(self.tokenizer,stream_request_id,
+                                            input_tokens_count=tokens["input_ids"].shape[1],skip_prompt=True)
+        try:
+            response = self.model.generate(
+                input_ids=tokens["input_ids"],
+                max_new_tokens=max_length,
+                repetition_penalty=1.05,
+                temperature=temperature,
+                attention_mask=tokens.attention_mask,
+                streamer=streamer        
+            )
+        finally:
+            if streamer is not None:
+                streamer.end()
+                streamer.join()
         answer = self.tokenizer.decode(response[0][tokens["input_ids"].shape[1]:], skip_special_tokens=True)
         return [(answer,"")]  
            
@@ -154,8 +168,35 @@ class DeepSpeedInference:
         max_length:int=1024, 
         top_p:float=0.95,
         temperature:float=0.1,**kwargs):        
+        if str(kwargs.get("stream","false")).lower() == "true":
+            request_id = kwargs["request_id"] if "request_id" in kwargs else str(uuid.uuid4())
+            server = get_or_create_stream_server("VLLM_STREAM_SERVER")
+            ray.get(server.add_item.remote(request_id,"RUNNING"))
+            # return at once, the text is fetched from the stream server by the request_id
+            threading.Thread(target=self._run_stream_workers,args=(server,request_id,ins,his,max_length,top_p,temperature),
+                             daemon=True).start()
+            return [("",{"metadata":{"request_id":request_id,"stream_server":"VLLM_STREAM_SERVER"}})]
         output = self._run_workers("execute_model",ins,his,max_length,top_p,temperature)
         return output
+
+    def _run_stream_workers(self,server,request_id:str,*args):
+        try:
+            self._run_workers("execute_model",*args,stream_request_id=request_id)
+        except Exception as inst:
+            # the streamer of rank 0 may never end, e.g. a worker is dead, 
+            # so mark the request done here, otherwise the client waits for it forever
+            print(f"deepspeed inference failed for stream request {request_id}: {inst}",flush=True)
+            try:
+                ray.get(server.mark_done.remote(request_id))
+            except Exception as e:
+                print(f"Fail to mark stream request {request_id} done: {e}",flush=True)
+
+    def get_meta(self):
+        return [{
+            "model_deploy_type": "proprietary",
+            "backend":"ray/deepspeed",
+            "support_stream": True
+        }]
               
     def _run_workers(
         self,
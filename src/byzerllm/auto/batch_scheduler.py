@@ -0,0 +1,296 @@
+from typing import Any,Dict,List,Optional,Callable,Tuple
+from collections import deque
+import concurrent.futures
+import threading
+import time
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+
+class BatchRequest:
+    '''
+    A generation request of the `BatchScheduler`. The output token ids and the timings
+    are filled by the scheduler, and `future` is resolved with the request itself when it is finished.
+
+    stopping_criteria: called with the output token ids after every step, return True to stop.
+    streamer: a transformers style streamer, `put` is called with every new token and `end` when the request is finished.
+    '''
+    def __init__(self,input_ids:List[int],
+                 max_new_tokens:int,
+                 do_sample:bool=False,
+                 temperature:float=1.0,
+                 top_p:float=1.0,
+                 repetition_penalty:float=1.0,
+                 eos_token_ids:List[int]=[],
+                 stopping_criteria:Optional[Callable[[List[int]],bool]]=None,
+                 streamer:Optional[Any]=None,
+                 timeout_s:float=300):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.eos_token_ids = set(eos_token_ids)
+        self.stopping_criteria = stopping_criteria
+        self.streamer = streamer
+        self.timeout_s = timeout_s
+
+        self.output_ids:List[int] = []
+        self.finish_reason:Optional[str] = None
+        self.submit_time = time.monotonic()
+        self.start_time:Optional[float] = None
+        self.first_token_time:Optional[float] = None
+        self.finish_time:Optional[float] = None
+        self.future = concurrent.futures.Future()
+
+    @property
+    def num_reserved_tokens(self)->int:
+        return len(self.input_ids) + self.max_new_tokens
+
+
+def _get_layers(cache)->List[Tuple[torch.Tensor,torch.Tensor]]:
+    '''
+    the (key, value) tensors of every layer, in the shape of (batch, heads, seq_len, head_dim)
+    '''
+    if hasattr(cache,"layers"):
+        return [(layer.keys,layer.values) for layer in cache.layers]
+    if hasattr(cache,"key_cache"):
+        return list(zip(cache.key_cache,cache.value_cache))
+    return [(k,v) for (k,v) in cache]
+
+
+def _make_cache(layers:List[Tuple[torch.Tensor,torch.Tensor]]):
+    if DynamicCache is None:
+        return tuple(layers)
+    cache = DynamicCache()
+    for (i,(k,v)) in enumerate(layers):
+        cache.update(k,v,i)
+    return cache
+
+
+def _left_pad(t:torch.Tensor,length:int,dim:int)->torch.Tensor:
+    pad = length - t.shape[dim]
+    if pad <= 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = pad
+    return torch.cat([torch.zeros(shape,dtype=t.dtype,device=t.device),t],dim=dim)
+
+
+class BatchScheduler:
+    '''
+    Continuous batching for the transformers models.
+
+    The requests submitted from any thread or coroutine are queued, and a background thread
+    steps all the running sequences together as one left padded batch. Between two decode steps
+    the finished sequences are evicted and the waiting requests are admitted (prefilled and merged
+    into the batch), as long as the batch has less than `max_batch_size` sequences and the prompt plus
+    max_new_tokens of all the sequences do not exceed `max_batch_tokens`.
+
+    ```python
+    request = BatchRequest(input_ids=[...],max_new_tokens=128)
+    scheduler.submit(request).result()
+    request.output_ids
+    ```
+    '''
+    def __init__(self,model,max_batch_size:int=8,max_batch_tokens:int=8192,pad_token_id:int=0):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.pad_token_id = pad_token_id
+        self.device = getattr(model,"device",torch.device("cpu"))
+
+        self.cond = threading.Condition()
+        self.queue:deque = deque()
+        self.thread:Optional[threading.Thread] = None
+
+        # the state of the running batch, only accessed by the scheduler thread
+        self.active:List[BatchRequest] = []
+        self.cache = None
+        self.attention_mask:Optional[torch.Tensor] = None
+
+        self.num_steps = 0
+        self.num_finished = 0
+        self.max_running = 0
+
+    def submit(self,request:BatchRequest)->concurrent.futures.Future:
+        with self.cond:
+            self.queue.append(request)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop,daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+        return request.future
+
+    def stats(self)->Dict[str,Any]:
+        with self.cond:
+            return {"running":len(self.active),
+                    "waiting":len(self.queue),
+                    "steps":self.num_steps,
+                    "finished":self.num_finished,
+                    "max_running":self.max_running,
+                    "max_batch_size":self.max_batch_size,
+                    "max_batch_tokens":self.max_batch_tokens}
+
+    def _admit(self)->List[BatchRequest]:
+        '''
+        should be called with the lock
+        '''
+        new_requests = []
+        used = sum(r.num_reserved_tokens for r in self.active)
+        while self.queue and len(self.active) + len(new_requests) < self.max_batch_size:
+            request = self.queue[0]
+            # a request larger than the budget can still run alone
+            if (self.active or new_requests) and used + request.num_reserved_tokens > self.max_batch_tokens:
+                break
+            self.queue.popleft()
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            new_requests.append(request)
+            used += request.num_reserved_tokens
+        return new_requests
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.active:
+                    self.cond.wait()
+                new_requests = self._admit()
+            try:
+                with torch.no_grad():
+                    if new_requests:
+                        self._prefill(new_requests)
+                        new_requests = []
+                    if self.active:
+                        self._decode()
+            except Exception as inst:
+                with self.cond:
+                    failed = self.active + new_requests
+                    self.active = []
+                    self.cache = None
+                    self.attention_mask = None
+                for request in failed:
+                    if request.streamer is not None:
+                        request.streamer.end()
+                    if not request.future.done():
+                        request.future.set_exception(inst)
+
+    def _prefill(self,requests:List[BatchRequest]):
+        now = time.monotonic()
+        for request in requests:
+            request.start_time = now
+        max_len = max(len(r.input_ids) for r in requests)
+        input_ids = torch.tensor([[self.pad_token_id] * (max_len - len(r.input_ids)) + r.input_ids for r in requests],
+                                 dtype=torch.long,device=self.device)
+        attention_mask = torch.tensor([[0] * (max_len - len(r.input_ids)) + [1] * len(r.input_ids) for r in requests],
+                                      dtype=torch.long,device=self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        output = self.model(input_ids=input_ids,
+                            attention_mask=attention_mask,
+                            position_ids=position_ids,
+                            past_key_values=_make_cache([]) if DynamicCache is not None else None,
+                            use_cache=True)
+        tokens = self._sample(requests,output.logits[:,-1,:])
+        self._merge(requests,_get_layers(output.past_key_values),attention_mask)
+        self._append_tokens(requests,tokens)
+
+    def _merge(self,requests:List[BatchRequest],layers:List[Tuple[torch.Tensor,torch.Tensor]],attention_mask:torch.Tensor):
+        if not self.active:
+            merged_layers = layers
+            merged_mask = attention_mask
+        else:
+            length = max(self.attention_mask.shape[1],attention_mask.shape[1])
+            merged_layers = [(torch.cat([_left_pad(k1,length,2),_left_pad(k2,length,2)],dim=0),
+                              torch.cat([_left_pad(v1,length,2),_left_pad(v2,length,2)],dim=0))
+                             for ((k1,v1),(k2,v2)) in zip(_get_layers(self.cache),layers)]
+            merged_mask = torch.cat([_left_pad(self.attention_mask,length,1),_left_pad(attention_mask,length,1)],dim=0)
+        with self.cond:
+            self.active = self.active + requests
+            self.max_running = max(self.max_running,len(self.active))
+        self.cache = _make_cache(merged_layers)
+        self.attention_mask = merged_mask
+
+    def _decode(self):
+        input_ids = torch.tensor([[r.output_ids[-1]] for r in self.active],dtype=torch.long,device=self.device)
+        self.attention_mask = torch.cat([self.attention_mask,
+                                         torch.ones((len(self.active),1),dtype=self.attention_mask.dtype,device=self.device)],dim=1)
+        position_ids = self.attention_mask.sum(-1,keepdim=True) - 1
+        output = self.model(input_ids=input_ids,
+                            attention_mask=self.attention_mask,
+                            position_ids=position_ids,
+                            past_key_values=self.cache,
+                            use_cache=True)
+        self.cache = output.past_key_values
+        self.num_steps += 1
+        self._append_tokens(self.active,self._sample(self.active,output.logits[:,-1,:]))
+
+    def _append_tokens(self,requests:List[BatchRequest],tokens:List[int]):
+        now = time.monotonic()
+        for (request,token) in zip(requests,tokens):
+            request.output_ids.append(token)
+            if request.streamer is not None:
+                request.streamer.put(torch.tensor([token]))
+            if request.first_token_time is None:
+                request.first_token_time = now
+            if token in request.eos_token_ids:
+                request.finish_reason = "stop"
+            elif request.stopping_criteria is not None and request.stopping_criteria(request.output_ids):
+                request.finish_reason = "stop"
+            elif len(request.output_ids) >= request.max_new_tokens:
+                request.finish_reason = "length"
+            elif now - request.start_time > request.timeout_s:
+                request.finish_reason = "timeout"
+        if any(r.finish_reason is not None for r in self.active):
+            self._evict()
+
+    def _evict(self):
+        keep = [i for (i,r) in enumerate(self.active) if r.finish_reason is None]
+        finished = [r for r in self.active if r.finish_reason is not None]
+        if keep:
+            index = torch.tensor(keep,dtype=torch.long,device=self.device)
+            attention_mask = self.attention_mask.index_select(0,index)
+            # drop the columns which are padding for all the remaining sequences
+            start = int((attention_mask.sum(0) > 0).nonzero()[0])
+            self.attention_mask = attention_mask[:,start:]
+            self.cache = _make_cache([(k.index_select(0,index)[:,:,start:,:],v.index_select(0,index)[:,:,start:,:])
+                                      for (k,v) in _get_layers(self.cache)])
+        else:
+            self.cache = None
+            self.attention_mask = None
+        with self.cond:
+            self.active = [self.active[i] for i in keep]
+            self.num_finished += len(finished)
+        now = time.monotonic()
+        for request in finished:
+            request.finish_time = now
+            if request.streamer is not None:
+                request.streamer.end()
+            request.future.set_result(request)
+
+    def _sample(self,requests:List[BatchRequest],logits:torch.Tensor)->List[int]:
+        logits = logits.float()
+        tokens = []
+        for (i,request) in enumerate(requests):
+            scores = logits[i]
+            if request.repetition_penalty != 1.0:
+                ids = torch.tensor(list(set(request.input_ids + request.output_ids)),dtype=torch.long,device=scores.device)
+                selected = scores.index_select(0,ids)
+                selected = torch.where(selected < 0,selected * request.repetition_penalty,selected / request.repetition_penalty)
+                scores = scores.index_copy(0,ids,selected)
+            if not request.do_sample or request.temperature <= 1e-5:
+                tokens.append(int(scores.argmax()))
+                continue
+            probs = torch.softmax(scores / request.temperature,dim=-1)
+            if request.top_p < 1.0:
+                (sorted_probs,sorted_indices) = torch.sort(probs,descending=True)
+                # keep the smallest set of tokens whose cumulative probability reaches top_p
+                remove = sorted_probs.cumsum(-1) - sorted_probs > request.top_p
+                sorted_probs[remove] = 0
+                probs = torch.zeros_like(probs).scatter(0,sorted_indices,sorted_probs)
+            tokens.append(int(torch.multinomial(probs / probs.sum(),1)))
+        return tokens
@@ -0,0 +1,115 @@
+from typing import Any,Dict,List,Optional,Tuple
+from collections import OrderedDict
+import threading
+import hashlib
+import torch
+
+from .batch_scheduler import _get_layers,_make_cache
+
+
+class PrefixKVCache:
+    '''
+    An LRU of the past_key_values of the prompts, bounded by the bytes of the key/value tensors.
+
+    The prompt is split into blocks of `block_size` tokens and every block boundary is indexed by the
+    chained hash of the tokens before it, so a new prompt which shares a prefix (e.g. a long system prompt)
+    with a cached one starts from the longest cached block boundary, and only the rest tokens are prefilled.
+
+    ```python
+    (num_cached_tokens,past_key_values) = cache.get(prompt_ids)
+    output = model.generate(input_ids=...,past_key_values=past_key_values,return_dict_in_generate=True)
+    cache.put(prompt_ids,output.past_key_values)
+    ```
+    '''
+    def __init__(self,max_bytes:int=2*1024**3,block_size:int=64):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        # key -> (layers, length, hashes, nbytes)
+        self.entries:OrderedDict = OrderedDict()
+        # block hash -> (key, length)
+        self.index:Dict[str,Tuple[str,int]] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+
+    def _block_hashes(self,token_ids:List[int])->List[Tuple[int,str]]:
+        '''
+        (length, hash) of the block boundaries, the last token is never cached since its logits are needed
+        '''
+        hashes = []
+        h = ""
+        for end in range(self.block_size,len(token_ids),self.block_size):
+            block = ",".join(str(t) for t in token_ids[end - self.block_size:end])
+            h = hashlib.md5(f"{h}:{block}".encode("utf-8")).hexdigest()
+            hashes.append((end,h))
+        return hashes
+
+    def get(self,token_ids:List[int])->Tuple[int,Optional[Any]]:
+        '''
+        return the number of the cached tokens and the past_key_values of them, or (0, None) if not found
+        '''
+        with self.lock:
+            for (length,h) in reversed(self._block_hashes(token_ids)):
+                if h not in self.index:
+                    continue
+                (key,_) = self.index[h]
+                self.entries.move_to_end(key)
+                layers = self.entries[key][0]
+                self.hits += 1
+                self.hit_tokens += length
+                break
+            else:
+                self.misses += 1
+                return (0,None)
+        return (length,_make_cache([(k[:,:,:length,:],v[:,:,:length,:]) for (k,v) in layers]))
+
+    def put(self,token_ids:List[int],past_key_values:Any):
+        '''
+        cache the prompt tokens of the past_key_values (which may contain the generated tokens as well)
+        up to the last block boundary
+        '''
+        hashes = self._block_hashes(token_ids)
+        if not hashes or past_key_values is None:
+            return
+        (length,key) = hashes[-1]
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+        layers = [(k[:1,:,:length,:].clone(),v[:1,:,:length,:].clone()) for (k,v) in _get_layers(past_key_values)]
+        nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for (k,v) in layers)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (layers,length,[h for (_,h) in hashes],nbytes)
+            self.total_bytes += nbytes
+            for (end,h) in hashes:
+                self.index[h] = (key,end)
+            while self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        (key,(_,_,hashes,nbytes)) = self.entries.popitem(last=False)
+        self.total_bytes -= nbytes
+        for h in hashes:
+            if h in self.index and self.index[h][0] == key:
+                del self.index[h]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+            self.total_bytes = 0
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits":self.hits,"misses":self.misses,
+                    "hit_rate":self.hits / total if total > 0 else 0.0,
+                    "hit_tokens":self.hit_tokens,
+                    "entries":len(self.entries),
+                    "bytes":self.total_bytes,"max_bytes":self.max_bytes}
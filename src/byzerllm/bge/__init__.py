@@ -3,6 +3,7 @@ from typing import Dict,List,Tuple
 
 def _encode(self,texts: List[str],extract_params={}):        
     embeddings = [emb.tolist() for emb in self.encode(texts,
+                                                      batch_size=int(extract_params.get("batch_size",32)),
                                                       normalize_embeddings=extract_params.get("normalize_embeddings",True))]
     return embeddings
     
@@ -12,7 +12,11 @@ def embed_rerank(self, sentence_pairs: Union[List[Tuple[str, str]], Tuple[str, s
     if not isinstance(scores, List):
         return (sentence_pairs, scores)
     else:
-        return sorted(list(zip(sentence_pairs, scores)), key=lambda x: x[1], reverse=True)
+        result = sorted(list(zip(sentence_pairs, scores)), key=lambda x: x[1], reverse=True)
+        top_k = extract_params.get("top_k", None)
+        if top_k is not None:
+            result = result[0:int(top_k)]
+        return result
 
 
 def init_model(model_dir, infer_params, sys_conf={}):
@@ -0,0 +1,59 @@
+from byzerllm.auto.assisted_generation import AssistedGenerationStats,measure_decode_time
+from transformers import LlamaConfig,LlamaForCausalLM
+import threading
+import copy
+import torch
+
+def get_tiny_model():
+    config = LlamaConfig(vocab_size=128,hidden_size=32,intermediate_size=64,
+                         num_hidden_layers=2,num_attention_heads=4,num_key_value_heads=2,max_position_embeddings=256)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+def test_assisted_generation_stats():
+    model = get_tiny_model()
+    # the same weights, so all the proposed tokens are accepted
+    draft_model = copy.deepcopy(model)
+    draft_model.generation_config.assistant_confidence_threshold = 0
+    draft_model.generation_config.num_assistant_tokens = 4
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+    input_ids = torch.tensor([list(range(3,20))])
+
+    expected = model.generate(input_ids,max_new_tokens=20,min_new_tokens=20,do_sample=False,pad_token_id=0)
+    with AssistedGenerationStats(model,draft_model,measure_decode_time(model)) as stats:
+        output = model.generate(input_ids,assistant_model=draft_model,max_new_tokens=20,min_new_tokens=20,do_sample=False,pad_token_id=0)
+    assert output.tolist() == expected.tolist()
+
+    metadata = stats.metadata(20)
+    assert metadata["verify_steps"] == 4
+    assert metadata["draft_accepted_tokens_count"] == 16
+    assert metadata["draft_accept_rate"] == 1.0
+    assert metadata["estimated_speedup"] > 0
+    # the hooks are installed only once
+    with AssistedGenerationStats(model,draft_model) as stats:
+        model.generate(input_ids,assistant_model=draft_model,max_new_tokens=20,min_new_tokens=20,do_sample=False,pad_token_id=0)
+    assert len(model._forward_hooks) == 1 and len(draft_model._forward_hooks) == 1
+
+def test_assisted_generation_stats_concurrent():
+    model = get_tiny_model()
+    draft_model = copy.deepcopy(model)
+    draft_model.generation_config.assistant_confidence_threshold = 0
+    draft_model.generation_config.num_assistant_tokens = 4
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+    input_ids = torch.tensor([list(range(3,20))])
+
+    results = []
+    def run():
+        with AssistedGenerationStats(model,draft_model) as stats:
+            model.generate(input_ids,assistant_model=draft_model,max_new_tokens=20,min_new_tokens=20,do_sample=False,pad_token_id=0)
+        results.append(stats.metadata(20))
+    def run_without_draft():
+        model.generate(input_ids,max_new_tokens=20,min_new_tokens=20,do_sample=False,pad_token_id=0)
+    threads = [threading.Thread(target=run) for _ in range(3)] + [threading.Thread(target=run_without_draft) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the forwards of the other requests on the same model are not counted
+    assert [(r["verify_steps"],r["draft_tokens_count"]) for r in results] == [(4,16)] * 3
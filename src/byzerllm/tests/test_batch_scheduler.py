@@ -0,0 +1,47 @@
+from byzerllm.auto.batch_scheduler import BatchScheduler,BatchRequest
+from transformers import LlamaConfig,LlamaForCausalLM
+import random
+import torch
+
+def get_tiny_model():
+    config = LlamaConfig(vocab_size=128,hidden_size=32,intermediate_size=64,
+                         num_hidden_layers=2,num_attention_heads=4,num_key_value_heads=2,max_position_embeddings=256)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+def test_batch_scheduler_same_as_generate():
+    model = get_tiny_model()
+    random.seed(1)
+    prompts = [[random.randint(3,127) for _ in range(random.randint(2,20))] for _ in range(7)]
+    max_new_tokens = [random.randint(3,15) for _ in prompts]
+
+    expected = []
+    for (prompt,n) in zip(prompts,max_new_tokens):
+        output = model.generate(torch.tensor([prompt]),max_new_tokens=n,min_new_tokens=n,do_sample=False,pad_token_id=0)
+        expected.append(output[0][len(prompt):].tolist())
+
+    # the small batch forces the requests to be admitted while others are running
+    scheduler = BatchScheduler(model,max_batch_size=3,max_batch_tokens=60)
+    requests = [BatchRequest(prompt,n) for (prompt,n) in zip(prompts,max_new_tokens)]
+    futures = [scheduler.submit(request) for request in requests]
+    for future in futures:
+        future.result(timeout=60)
+
+    assert [request.output_ids for request in requests] == expected
+    assert all(request.finish_reason == "length" for request in requests)
+    assert scheduler.stats()["max_running"] == 3
+
+def test_batch_scheduler_stop():
+    model = get_tiny_model()
+    request = BatchRequest([5,6,7],max_new_tokens=10)
+    BatchScheduler(model).submit(request).result(timeout=60)
+    eos = request.output_ids[2]
+
+    first = BatchRequest([5,6,7],max_new_tokens=10,eos_token_ids=[eos])
+    second = BatchRequest([5,6,7],max_new_tokens=10,stopping_criteria=lambda ids: len(ids) >= 2)
+    scheduler = BatchScheduler(model)
+    scheduler.submit(first)
+    scheduler.submit(second)
+    assert first.future.result(timeout=60).output_ids == request.output_ids[:3]
+    assert second.future.result(timeout=60).output_ids == request.output_ids[:2]
+    assert first.finish_reason == "stop"
@@ -0,0 +1,170 @@
+from byzerllm.utils.client.cache_utils import MetaCache,ResponseCache,FuncImplCache,EmbeddingCache,RenderCache,TokenizerRegistry
+import threading
+import pytest
+import os
+import sys
+import time
+
+def test_meta_cache_ttl():
+    cache = MetaCache(ttl=0.1)
+    assert cache.get("default","chat") is None
+    cache.put("default","chat",{"backend":"ray/vllm"})
+    assert cache.get("default","chat") == {"backend":"ray/vllm"}
+    time.sleep(0.2)
+    assert cache.get("default","chat") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+def test_meta_cache_peek_is_not_counted():
+    cache = MetaCache()
+    assert cache.peek("default","chat") is None
+    cache.put("default","chat",{"backend":"ray/vllm"})
+    assert cache.peek("default","chat") == {"backend":"ray/vllm"}
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["misses"] == 0
+
+def test_meta_cache_invalidate():
+    cache = MetaCache()
+    cache.put("default","chat",{})
+    cache.put("default","emb",{})
+    cache.put("other","chat",{})
+    cache.invalidate("default","chat")
+    assert cache.get("default","chat") is None
+    assert cache.get("other","chat") == {}
+    cache.invalidate("default")
+    assert cache.get("default","emb") is None
+
+def test_response_cache_key():
+    k1 = ResponseCache.make_key("chat",{"instruction":"hi","history":[],"temperature":0.1,"gen.request_id":"a"})
+    k2 = ResponseCache.make_key("chat",{"temperature":"0.1","history":[],"instruction":"hi","gen.request_id":"b"})
+    k3 = ResponseCache.make_key("chat2",{"instruction":"hi","history":[],"temperature":0.1})
+    assert k1 == k2
+    assert k1 != k3
+
+def test_response_cache_lru():
+    cache = ResponseCache(max_size=2)
+    cache.put("a",{"predict":"1"})
+    cache.put("b",{"predict":"2"})
+    assert cache.get("a") == {"predict":"1"}
+    cache.put("c",{"predict":"3"})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"predict":"1"}
+    assert cache.get("c") == {"predict":"3"}
+
+def test_response_cache_disk(tmp_path):
+    db_path = os.path.join(str(tmp_path),"response_cache.db")
+    cache = ResponseCache(max_size=1,ttl=0.2,db_path=db_path)
+    cache.put("a",{"predict":"1","metadata":{}})
+    cache.put("b",{"predict":"2","metadata":{}})
+    
+    new_cache = ResponseCache(db_path=db_path)
+    assert new_cache.get("a") == {"predict":"1","metadata":{}}
+    assert new_cache.stats()["disk_hits"] == 1
+    time.sleep(0.3)
+    assert cache.get("a") is None
+    assert ResponseCache(db_path=db_path).get("b") is None
+
+def test_func_impl_cache_disk(tmp_path):
+    db_path = os.path.join(str(tmp_path),"impl_cache.db")
+    source = "def add(a,b):\n    return a+b\n"
+    variables = {}
+    exec(source,variables)
+    fingerprint = FuncImplCache.make_fingerprint("(a, b)",{"title":"Sum"})
+
+    cache = FuncImplCache(db_path=db_path)
+    cache.put("chat__m.add",fingerprint,"add",source,variables["add"])
+
+    new_cache = FuncImplCache(db_path=db_path)
+    assert new_cache.get("chat__m.add",fingerprint)(1,2) == 3
+
+    new_fingerprint = FuncImplCache.make_fingerprint("(a, b, c)",{"title":"Sum"})
+    assert new_cache.get("chat__m.add",new_fingerprint) is None
+    assert FuncImplCache(db_path=db_path).get("chat__m.add",fingerprint) is None
+
+def test_func_impl_cache_remove():
+    cache = FuncImplCache()
+    cache.put("chat__m.add","f","add","",lambda a,b: a+b)
+    cache.put("chat__m.sub","f","sub","",lambda a,b: a-b)
+    cache.remove(lambda k: k.endswith("m.add"))
+    assert cache.keys() == ["chat__m.sub"]
+
+def test_embedding_cache_key():
+    k1 = EmbeddingCache.make_key("emb",{"instruction":"hello","embedding":True,"max_length":4096,"gen.request_id":"a"})
+    k2 = EmbeddingCache.make_key("emb",{"max_length":"4096","embedding":True,"instruction":"hello"})
+    k3 = EmbeddingCache.make_key("emb",{"instruction":"hello","embedding":True,"max_length":1024})
+    k4 = EmbeddingCache.make_key("emb2",{"instruction":"hello","embedding":True,"max_length":4096})
+    assert k1 == k2
+    assert len(set([k1,k3,k4])) == 3
+
+def test_embedding_cache_lru():
+    cache = EmbeddingCache(max_size=2)
+    cache.put("a",[0.1,0.2])
+    cache.put("b",[0.3,0.4])
+    assert cache.get("a").tolist() == pytest.approx([0.1,0.2])
+    cache.put("c",[0.5,0.6])
+    assert cache.get("b") is None
+    assert cache.stats()["hit_rate"] == 0.5
+
+def test_embedding_cache_disk(tmp_path):
+    cache_dir = os.path.join(str(tmp_path),"emb_cache")
+    cache = EmbeddingCache(cache_dir=cache_dir)
+    cache.put_many([("a",[1.0,2.0]),("b",[3.0,4.0]),("c",[1.0,2.0,3.0])])
+
+    reader = EmbeddingCache(cache_dir=cache_dir,read_only=True)
+    assert reader.get("b").tolist() == [3.0,4.0]
+    assert reader.get("c").tolist() == [1.0,2.0,3.0]
+    # the vectors appended after the reader mapped the file
+    cache.put("d",[5.0,6.0])
+    assert reader.get("d").tolist() == [5.0,6.0]
+    assert reader.stats()["disk_hits"] == 3
+    assert reader.stats()["disk_size"] == 4
+
+    reader.put("e",[7.0,8.0])
+    assert EmbeddingCache(cache_dir=cache_dir).get("e") is None
+
+    cache.clear()
+    assert EmbeddingCache(cache_dir=cache_dir).get("a") is None
+
+def test_embedding_cache_disk_without_fcntl(tmp_path,monkeypatch):
+    # windows has no fcntl
+    monkeypatch.setattr("sys.platform","win32")
+    monkeypatch.setitem(sys.modules,"fcntl",None)
+    cache = EmbeddingCache(cache_dir=os.path.join(str(tmp_path),"emb_cache"))
+    cache.put("a",[1.0,2.0])
+    assert EmbeddingCache(cache_dir=cache.cache_dir).get("a").tolist() == [1.0,2.0]
+    cache.clear()
+    assert cache.get("a") is None
+
+def test_render_cache_invalidate():
+    cache = RenderCache(max_size=2)
+    cache.put(("session","ns","qwen","s1"),"a")
+    cache.put(("chat_template","ns","llama","md5"),"b")
+    assert cache.get(("session","ns","qwen","s1")) == "a"
+
+    cache.invalidate("ns","qwen")
+    assert cache.get(("session","ns","qwen","s1")) is None
+    assert cache.get(("chat_template","ns","llama","md5")) == "b"
+
+    cache.put(("session","ns","qwen","s2"),"c")
+    cache.put(("session","ns","qwen","s3"),"d")
+    assert cache.stats()["size"] == 2
+
+def test_tokenizer_registry_loads_once():
+    registry = TokenizerRegistry()
+    calls = []
+    def loader():
+        calls.append(1)
+        time.sleep(0.1)
+        return "tokenizer"
+    threads = [threading.Thread(target=registry.get_or_load,args=("default","chat",loader)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert registry.get_or_load("default","chat",loader) == "tokenizer"
+
+    registry.put("default","emb",None)
+    registry.invalidate("default","chat")
+    assert not registry.contains("default","chat")
+    assert registry.contains("default","emb")
@@ -0,0 +1,58 @@
+from byzerllm.utils.client.lease_utils import WorkerLeaseManager,PinnedLeaseNotSupportedError
+from pyjava.udf.udf_master import UDFMaster
+import pytest
+import ray
+
+@pytest.fixture(scope="module")
+def ray_context():
+    ray.init(num_cpus=4,include_dashboard=False,ignore_reinit_error=True)
+    yield
+    ray.shutdown()
+
+def init_func(model_refs,conf):
+    return None
+
+def apply_func(model,v):
+    return v
+
+@ray.remote
+class OldUDFMaster:
+    '''
+    the udf master of pyjava<0.6.21, `get` takes no index and there is no `get_worker_max_concurrency`
+    '''
+    def get(self):
+        return [0,None]
+
+    def stat(self):
+        return {"total_workers":2}
+
+def test_pinned_lease_with_udf_master(ray_context):
+    conf = {"workerMaxConcurrency":"3","num_cpus":"0","standalone":"true"}
+    master = UDFMaster.options(name="lease_test_model").remote(2,conf,init_func,apply_func)
+    ray.get(master.create_workers.remote(conf))
+
+    manager = WorkerLeaseManager()
+    assert manager.get_worker_info("default","lease_test_model") == (2,3)
+    [index,worker] = manager.acquire_pinned("default","lease_test_model",1)
+    assert index == 1
+    assert ray.get(worker.stat.remote())["active_task"] == 0
+    # the pinned lease does not take a slot of the udf master
+    assert ray.get(master.stat.remote())["busy_workers"] == 0
+    assert manager.supports_pinned("default","lease_test_model")
+    ray.kill(master)
+
+def test_pinned_lease_not_supported(ray_context):
+    master = OldUDFMaster.options(name="lease_test_old_model").remote()
+    manager = WorkerLeaseManager()
+    with pytest.raises(PinnedLeaseNotSupportedError):
+        manager.get_worker_info("default","lease_test_old_model")
+    assert not manager.supports_pinned("default","lease_test_old_model")
+    with pytest.raises(PinnedLeaseNotSupportedError):
+        manager.acquire_pinned("default","lease_test_old_model",1)
+
+    # the get of the old udf master fails with the index
+    manager = WorkerLeaseManager()
+    with pytest.raises(PinnedLeaseNotSupportedError):
+        manager.acquire_pinned("default","lease_test_old_model",1)
+    assert not manager.supports_pinned("default","lease_test_old_model")
+    ray.kill(master)
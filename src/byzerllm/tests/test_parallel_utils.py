@@ -0,0 +1,85 @@
+from byzerllm.utils.client import parallel_utils
+import asyncio
+import random
+import time
+import pytest
+
+class FakeLLM:
+    def __init__(self,fail_times:int=0):
+        self.fail_times = fail_times
+        self.calls = 0
+
+    def chat_oai(self,conversations,**kwargs):
+        self.calls += 1
+        time.sleep(random.random() * 0.05)
+        if conversations[0]["content"] == "bad":
+            raise Exception("bad request")
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise Exception("temporary error")
+        return [conversations[0]["content"]]
+
+    async def async_chat_oai(self,conversations,**kwargs):
+        await asyncio.sleep(random.random() * 0.05)
+        if conversations[0]["content"] == "bad":
+            raise Exception("bad request")
+        return [conversations[0]["content"]]
+
+def test_map_chat_oai_order_and_progress():
+    conversations_list = [[{"role":"user","content":str(i)}] for i in range(20)]
+    progress = []
+    results = parallel_utils.map_chat_oai(FakeLLM(fail_times=2),conversations_list,max_concurrency=4,
+                                          max_retries=2,retry_backoff=0.01,
+                                          progress_callback=lambda done,total,index,result: progress.append(done))
+    assert results == [[str(i)] for i in range(20)]
+    assert sorted(progress) == list(range(1,21))
+
+def test_map_chat_oai_exceptions():
+    conversations_list = [[{"role":"user","content":"ok"}],[{"role":"user","content":"bad"}]]
+    results = parallel_utils.map_chat_oai(FakeLLM(),conversations_list,return_exceptions=True)
+    assert results[0] == ["ok"]
+    assert isinstance(results[1],Exception)
+    with pytest.raises(Exception):
+        parallel_utils.map_chat_oai(FakeLLM(),conversations_list)
+
+def test_async_map_chat_oai():
+    conversations_list = [[{"role":"user","content":str(i)}] for i in range(10)] + [[{"role":"user","content":"bad"}]]
+    results = asyncio.run(parallel_utils.async_map_chat_oai(FakeLLM(),conversations_list,max_concurrency=3,return_exceptions=True))
+    assert results[:10] == [[str(i)] for i in range(10)]
+    assert isinstance(results[10],Exception)
+
+class FakeResponse:
+    def __init__(self,output):
+        self.output = output
+
+class SlowFirstLLM:
+    def __init__(self):
+        self.default_model_name = "chat"
+        self.calls = 0
+        self.aborted = []
+
+    def chat_oai(self,conversations,model=None,llm_config={},**kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            time.sleep(1)
+            return [FakeResponse("slow")]
+        return [FakeResponse("fast")]
+
+    def abort(self,request_id,model=None):
+        self.aborted.append(request_id)
+
+def test_hedged_chat_oai():
+    llm = SlowFirstLLM()
+    start = time.monotonic()
+    t = parallel_utils.hedged_chat_oai(llm,[{"role":"user","content":"hi"}],hedge_delay=0.1)
+    assert t[0].output == "fast"
+    assert time.monotonic() - start < 0.8
+    assert len(llm.aborted) == 1
+
+def test_hedged_chat_oai_no_hedge_when_fast():
+    llm = SlowFirstLLM()
+    llm.calls = 1
+    t = parallel_utils.hedged_chat_oai(llm,[{"role":"user","content":"hi"}],hedge_delay=0.5)
+    assert t[0].output == "fast"
+    assert llm.calls == 2
+    assert llm.aborted == []
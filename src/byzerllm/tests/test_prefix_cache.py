@@ -0,0 +1,46 @@
+from byzerllm.auto.prefix_cache import PrefixKVCache
+from transformers import LlamaConfig,LlamaForCausalLM
+import random
+import torch
+
+def get_tiny_model():
+    config = LlamaConfig(vocab_size=128,hidden_size=32,intermediate_size=64,
+                         num_hidden_layers=2,num_attention_heads=4,num_key_value_heads=2,max_position_embeddings=256)
+    torch.manual_seed(0)
+    return LlamaForCausalLM(config).eval()
+
+def generate(model,cache,prompt):
+    (num_cached_tokens,past_key_values) = cache.get(prompt)
+    output = model.generate(torch.tensor([prompt]),past_key_values=past_key_values,max_new_tokens=8,min_new_tokens=8,
+                            do_sample=False,pad_token_id=0,use_cache=True,return_dict_in_generate=True)
+    cache.put(prompt,output.past_key_values)
+    return (output.sequences[0][len(prompt):].tolist(),num_cached_tokens)
+
+def test_prefix_cache_same_as_generate():
+    model = get_tiny_model()
+    random.seed(1)
+    system_prompt = [random.randint(3,127) for _ in range(40)]
+    prompts = [system_prompt + [random.randint(3,127) for _ in range(random.randint(1,20))] for _ in range(4)]
+
+    cache = PrefixKVCache(block_size=16)
+    results = [generate(model,cache,prompt) for prompt in prompts]
+    for (prompt,(output_ids,_)) in zip(prompts,results):
+        expected = model.generate(torch.tensor([prompt]),max_new_tokens=8,min_new_tokens=8,do_sample=False,pad_token_id=0)
+        assert output_ids == expected[0][len(prompt):].tolist()
+
+    # the first prompt is not cached, the others start from the 32 tokens of the system prompt
+    assert [num_cached_tokens for (_,num_cached_tokens) in results] == [0,32,32,32]
+    assert cache.stats()["hits"] == 3
+
+def test_prefix_cache_evict():
+    model = get_tiny_model()
+    cache = PrefixKVCache(block_size=16)
+    generate(model,cache,list(range(3,40)))
+    nbytes = cache.stats()["bytes"]
+
+    cache = PrefixKVCache(max_bytes=nbytes,block_size=16)
+    generate(model,cache,list(range(3,40)))
+    generate(model,cache,list(range(50,90)))
+    assert cache.stats()["entries"] == 1
+    assert cache.get(list(range(3,40)))[0] == 0
+    assert cache.get(list(range(50,90)))[0] == 32
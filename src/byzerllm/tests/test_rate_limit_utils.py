@@ -0,0 +1,81 @@
+from byzerllm.utils.client.rate_limit_utils import RateLimiter,RateLimiterRegistry,RateLimitTimeoutError,count_result_tokens,count_stream_tokens
+from byzerllm.utils import SingleOutputMeta
+import threading
+import asyncio
+import pytest
+import time
+
+def test_max_concurrency_fifo():
+    limiter = RateLimiter("chat",max_concurrency=1)
+    limiter.acquire()
+    order = []
+    def run(i):
+        limiter.acquire()
+        order.append(i)
+        limiter.release()
+    threads = []
+    for i in range(3):
+        t = threading.Thread(target=run,args=(i,))
+        t.start()
+        threads.append(t)
+        time.sleep(0.05)
+    assert order == []
+    limiter.release()
+    for t in threads:
+        t.join(5)
+    assert order == [0,1,2]
+
+def test_queue_timeout():
+    limiter = RateLimiter("chat",max_concurrency=1,queue_timeout=0.2)
+    limiter.acquire()
+    with pytest.raises(RateLimitTimeoutError):
+        limiter.acquire()
+    assert limiter.stats()["waiting"] == 0
+
+def test_requests_per_second_async():
+    limiter = RateLimiter("chat",requests_per_second=10)
+    async def run():
+        for _ in range(5):
+            await limiter.async_acquire()
+            limiter.release()
+    start = time.monotonic()
+    asyncio.run(run())
+    # the bucket holds 10 requests, so there is no wait
+    assert time.monotonic() - start < 0.5
+
+def test_tokens_per_minute():
+    limiter = RateLimiter("chat",tokens_per_minute=600,queue_timeout=0.2)
+    limiter.acquire()
+    limiter.release(count_result_tokens([{"metadata":{"input_tokens_count":500,"generated_tokens_count":200}}]))
+    # 100 tokens in debt, refilled at 10 tokens per second
+    with pytest.raises(RateLimitTimeoutError):
+        limiter.acquire()
+
+def test_stream_holds_the_slot():
+    registry = RateLimiterRegistry()
+    limiter = RateLimiter("chat",max_concurrency=1,tokens_per_minute=600,queue_timeout=0.1)
+    limiter.acquire()
+    # the stream request returns at once, the slot is held until the stream is consumed
+    registry.hold_stream(limiter,["r1","r2"])
+    with pytest.raises(RateLimitTimeoutError):
+        limiter.acquire()
+
+    registry.release_stream("r1",count_stream_tokens(SingleOutputMeta(input_tokens_count=300,generated_tokens_count=100)))
+    assert limiter.stats()["running"] == 1
+    registry.release_stream("r2",count_stream_tokens(SingleOutputMeta(input_tokens_count=300,generated_tokens_count=100)))
+    assert limiter.stats()["running"] == 0
+    # the generated tokens of the streams are charged, 200 tokens in debt
+    assert limiter.stats()["available_tokens"] < -190
+    registry.release_stream("r1",100)
+    assert limiter.stats()["available_tokens"] < -190
+
+def test_stream_hold_timeout():
+    registry = RateLimiterRegistry(stream_hold_timeout=0.1)
+    limiter = RateLimiter("chat",max_concurrency=1)
+    registry.set("chat",limiter)
+    limiter.acquire()
+    registry.hold_stream(limiter,["r1"])
+    time.sleep(0.2)
+    # the stream is never read
+    assert registry.get("chat") is limiter
+    assert limiter.stats()["running"] == 0
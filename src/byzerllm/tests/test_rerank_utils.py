@@ -0,0 +1,26 @@
+from byzerllm.utils.client.rerank_utils import RerankScoreCache,parse_rerank_output,select_top_k
+
+def test_rerank_score_cache():
+    k1 = RerankScoreCache.make_key("rerank","what is panda?","hi",{"max_length":512})
+    k2 = RerankScoreCache.make_key("rerank","what is panda?","hi",{"max_length":"512"})
+    k3 = RerankScoreCache.make_key("rerank","what is panda?","hello",{"max_length":512})
+    assert k1 == k2
+    assert k1 != k3
+
+    cache = RerankScoreCache(max_size=1)
+    cache.put(k1,0.5)
+    assert cache.get(k1) == 0.5
+    cache.put(k3,0.1)
+    assert cache.get(k1) is None
+    assert cache.stats()["hit_rate"] == 0.5
+
+def test_parse_rerank_output():
+    assert parse_rerank_output((["q","a"],1.5)) == {"a":1.5}
+    assert parse_rerank_output(([["q","a"]],1.5)) == {"a":1.5}
+    assert parse_rerank_output([[["q","b"],2.0],[["q","a"],-1.0]]) == {"a":-1.0,"b":2.0}
+
+def test_select_top_k():
+    scores = [0.1,0.9,0.5,0.7]
+    assert select_top_k(scores,2) == [(1,0.9),(3,0.7)]
+    assert [i for (i,_) in select_top_k(scores)] == [1,3,2,0]
+    assert select_top_k([],3) == []
@@ -0,0 +1,82 @@
+from byzerllm.utils.client.routing_utils import ModelGroup,RoutingPolicy,AffinityRouter,conversation_affinity_key
+from byzerllm.utils.client.lease_utils import ModelNotFoundError
+import pytest
+import ray
+
+def test_least_outstanding():
+    group = ModelGroup("qwen",["qwen_a","qwen_b"])
+    a = group.choose()
+    b = group.choose()
+    assert {a,b} == {"qwen_a","qwen_b"}
+    group.release(a)
+    assert group.choose() == a
+
+def test_weighted_round_robin():
+    group = ModelGroup("qwen",["qwen_a","qwen_b"],policy=RoutingPolicy.WeightedRoundRobin,weights=[3,1])
+    chosen = []
+    for _ in range(8):
+        replica = group.choose()
+        group.release(replica)
+        chosen.append(replica)
+    assert chosen.count("qwen_a") == 6
+    assert chosen.count("qwen_b") == 2
+
+def test_eject_failed_replica():
+    group = ModelGroup("qwen",["qwen_a","qwen_b"],policy=RoutingPolicy.PowerOfTwo,eject_seconds=60)
+    calls = []
+    def func(replica):
+        calls.append(replica)
+        if replica == "qwen_a":
+            raise ModelNotFoundError(f"Failed to look up actor with name '{replica}'")
+        return replica
+    
+    for _ in range(5):
+        assert group.run(func) == "qwen_b"
+    assert calls.count("qwen_a") <= 1
+    assert group.stats()["replicas"][0]["ejected"]
+    assert all(r["outstanding"] == 0 for r in group.stats()["replicas"])
+
+def test_non_replica_failure_is_not_retried():
+    group = ModelGroup("qwen",["qwen_a","qwen_b"])
+    calls = []
+    def func(replica):
+        calls.append(replica)
+        raise Exception("bad request")
+    with pytest.raises(Exception):
+        group.run(func)
+    assert len(calls) == 1
+    assert not any(r["ejected"] for r in group.stats()["replicas"])
+
+def test_worker_error_is_not_replica_failure():
+    group = ModelGroup("qwen",["qwen_a","qwen_b"])
+    calls = []
+    def func(replica):
+        calls.append(replica)
+        # how ray re-raises the ValueError of the worker, e.g. the prompt is too long
+        raise ray.exceptions.RayTaskError("async_apply","traceback",ValueError("prompt is too long")).as_instanceof_cause()
+    with pytest.raises(ValueError):
+        group.run(func)
+    assert len(calls) == 1
+    assert not any(r["ejected"] for r in group.stats()["replicas"])
+
+def test_conversation_affinity_key():
+    first_turn = [{"role":"system","content":"You are a helpful assistant"},{"role":"user","content":"hi"}]
+    second_turn = first_turn + [{"role":"assistant","content":"hello"},{"role":"user","content":"how are you"}]
+    assert conversation_affinity_key(first_turn) == conversation_affinity_key(second_turn)
+    assert conversation_affinity_key(first_turn) != conversation_affinity_key([{"role":"user","content":"hi"}])
+
+def test_affinity_router_consistent_hashing():
+    router = AffinityRouter()
+    keys = [f"session_{i}" for i in range(200)]
+    before = {key:router.preferred_workers("chat",4,key)[0] for key in keys}
+    assert before == {key:router.preferred_workers("chat",4,key)[0] for key in keys}
+    assert len(set(before.values())) == 4
+
+    preferred = router.preferred_workers("chat",4,"session_0")
+    assert sorted(preferred) == [0,1,2,3]
+    assert len(router.preferred_workers("chat",4,"session_0",limit=2)) == 2
+
+    # only the keys on the new worker are moved
+    after = {key:router.preferred_workers("chat",5,key)[0] for key in keys}
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == 4 for key in moved)
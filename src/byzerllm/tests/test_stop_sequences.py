@@ -0,0 +1,55 @@
+from byzerllm.utils import StopSequenceMatcher,StopSequencesCriteria,tokenize_stopping_sequences
+import torch
+
+class GreedyTokenizer:
+    '''
+    longest match over a tiny vocab, so "a:" is one token but ":" alone is another
+    '''
+    vocab = ["a:","a","b",":","\n","User","User:"," ",".","。","0"]
+
+    def encode(self,text,add_special_tokens=False):
+        ids = []
+        while text:
+            token = max([v for v in self.vocab if text.startswith(v)],key=len)
+            ids.append(self.vocab.index(token))
+            text = text[len(token):]
+        return ids
+
+    def decode(self,ids,skip_special_tokens=True):
+        return "".join(self.vocab[int(i)] for i in ids)
+
+def test_stop_sequence_matcher():
+    tokenizer = GreedyTokenizer()
+    matcher = StopSequenceMatcher(tokenizer,tokenize_stopping_sequences(tokenizer,["b b","\nUser:"]),text_fallback=False)
+    state = matcher.new_state()
+    assert not matcher.update(state,tokenizer.encode("b a b"))
+    assert not matcher.update(state,tokenizer.encode(" "))
+    assert matcher.update(state,tokenizer.encode("b"))
+
+    state = matcher.new_state()
+    assert matcher.update(state,tokenizer.encode("a\nUser:"))
+
+def test_stop_sequence_matcher_text_fallback():
+    tokenizer = GreedyTokenizer()
+    # ":" is merged into "a:" when "a" is generated before it
+    matcher = StopSequenceMatcher(tokenizer,tokenize_stopping_sequences(tokenizer,[":"]))
+    assert matcher.text_stops == [(":",1)]
+    state = matcher.new_state()
+    assert not matcher.update(state,tokenizer.encode("b"))
+    assert matcher.update(state,tokenizer.encode("a:"))
+
+    matcher = StopSequenceMatcher(tokenizer,tokenize_stopping_sequences(tokenizer,[":"]),skip_check_min_length=3)
+    state = matcher.new_state()
+    assert not matcher.update(state,tokenizer.encode("a:"))
+
+def test_stop_sequences_criteria_batch():
+    tokenizer = GreedyTokenizer()
+    stops = [torch.tensor(item) for item in tokenize_stopping_sequences(tokenizer,["\nUser:"])]
+    criteria = StopSequencesCriteria(tokenizer,stops=stops,input_start=2)
+    prompt = tokenizer.encode("ab")
+    input_ids = torch.tensor([prompt + tokenizer.encode("b\n"),prompt + tokenizer.encode("\nUser:")])
+    assert criteria(input_ids,None).tolist() == [False,True]
+
+    criteria = StopSequencesCriteria(tokenizer,stops=stops,input_start=2)
+    assert criteria(torch.tensor([prompt + tokenizer.encode("b")]),None) is False
+    assert criteria(torch.tensor([prompt + tokenizer.encode("b\nUser:")]),None) is True
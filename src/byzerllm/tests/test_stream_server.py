@@ -0,0 +1,60 @@
+from byzerllm.utils import VLLMStreamServer,BlockVLLMStreamServer,StreamOutputs,SingleOutput
+import asyncio
+import threading
+import time
+
+def test_vllm_stream_server_wait_for_change():
+    async def run():
+        server = VLLMStreamServer()
+        await server.add_item("req","RUNNING")
+        async def writer():
+            for i in range(3):
+                await asyncio.sleep(0.1)
+                await server.add_item("req",f"t{i}")
+            await server.mark_done("req")
+        asyncio.create_task(writer())
+        
+        outputs = []
+        while True:
+            v = await server.get_item("req",wait_for_change=True,timeout=5)
+            if v is None:
+                break
+            outputs.append(v)
+        return outputs
+    
+    start = time.monotonic()
+    assert asyncio.run(run()) == ["RUNNING","t0","t1","t2"]
+    assert time.monotonic() - start < 2
+
+def test_block_stream_server_wait_for_change():
+    server = BlockVLLMStreamServer()
+    server.add_item("req","RUNNING")
+    def writer():
+        for i in range(3):
+            time.sleep(0.1)
+            server.add_item("req",f"t{i}")
+        server.mark_done("req")
+    threading.Thread(target=writer,daemon=True).start()
+
+    start = time.monotonic()
+    outputs = []
+    while True:
+        v = server.get_item("req",wait_for_change=True,timeout=5)
+        if v is None:
+            break
+        outputs.append(v)
+    assert outputs == ["RUNNING","t0","t1","t2"]
+    assert time.monotonic() - start < 2
+
+def test_block_stream_server_delta():
+    server = BlockVLLMStreamServer()
+    server.add_item("req","RUNNING")
+    for t in ["Hel","lo"," world"]:
+        server.add_delta("req",StreamOutputs(outputs=[SingleOutput(text=t)]))
+    
+    assert server.get_item("req").outputs[0].text == "Hello world"
+    assert server.get_delta("req",offsets=[5]).outputs[0].text == " world"
+    assert server.get_delta("req",offsets=[11]).outputs[0].text == ""
+    server.mark_done("req")
+    assert server.get_delta("req",offsets=[0]).outputs[0].text == "Hello world"
+    assert server.get_delta("req",offsets=[0]) is None
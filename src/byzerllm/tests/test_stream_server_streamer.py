@@ -0,0 +1,39 @@
+from byzerllm.utils import StreamServerStreamer,get_or_create_stream_server
+import torch
+import ray
+
+class ByteTokenizer:
+    '''
+    one token per utf-8 byte, so a chinese character is split into 3 tokens
+    '''
+    def __init__(self):
+        self.decoded_tokens = []
+
+    def encode(self,text):
+        return list(text.encode("utf-8"))
+
+    def decode(self,ids,skip_special_tokens=True):
+        self.decoded_tokens.append(len(ids))
+        return bytes(ids).decode("utf-8",errors="replace")
+
+def test_stream_server_streamer():
+    ray.init(num_cpus=2,include_dashboard=False,ignore_reinit_error=True)
+    try:
+        server = get_or_create_stream_server("TEST_STREAM_SERVER")
+        tokenizer = ByteTokenizer()
+        text = "你好, byzer-llm! " * 20
+        streamer = StreamServerStreamer(tokenizer,"r1",input_tokens_count=3,server_name="TEST_STREAM_SERVER")
+        streamer.put(torch.tensor([[1,2,3]]))
+        for token_id in tokenizer.encode(text):
+            streamer.put(torch.tensor([token_id]))
+        streamer.end()
+        streamer.join(10)
+
+        output = ray.get(server.get_item.remote("r1"))
+        assert output.outputs[0].text == text
+        assert output.outputs[0].metadata.generated_tokens_count == len(tokenizer.encode(text))
+        # only the new tokens and a few tokens before them are decoded in every step
+        assert max(tokenizer.decoded_tokens) <= 6
+        ray.kill(server)
+    finally:
+        ray.shutdown()
@@ -0,0 +1,48 @@
+from byzerllm.utils.client.trace_utils import Tracer,HistogramRegistry,JsonLinesExporter
+import json
+import os
+
+def test_tracer_nested_spans():
+    tracer = Tracer()
+    with tracer.span("query",model="chat") as span:
+        assert span is None
+
+    spans = []
+    tracer.add_exporter(spans.append)
+    with tracer.span("chat_oai",model="chat") as root:
+        with tracer.span("query",model="chat",batch_size=1):
+            pass
+    
+    assert [s.name for s in spans] == ["query","chat_oai"]
+    assert spans[0].trace_id == root.trace_id
+    assert spans[0].parent_span_id == root.span_id
+    assert spans[0].attributes["batch_size"] == 1
+
+def test_tracer_error_span():
+    tracer = Tracer()
+    spans = []
+    tracer.add_exporter(spans.append)
+    try:
+        with tracer.span("query",model="chat"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    assert spans[0].error == "ValueError: boom"
+
+def test_histogram_registry(tmp_path):
+    registry = HistogramRegistry()
+    for i in range(1,101):
+        registry.observe("chat","query",i / 100)
+    assert registry.percentile("chat","query",50) == 0.5
+    assert registry.percentile("chat","query",99) == 0.99
+    [stats] = registry.stats()
+    assert stats["count"] == 100
+
+    path = os.path.join(str(tmp_path),"spans.jsonl")
+    tracer = Tracer()
+    tracer.add_exporter(JsonLinesExporter(path))
+    with tracer.span("emb",model="emb"):
+        pass
+    with open(path) as f:
+        [line] = f.readlines()
+    assert json.loads(line)["attributes"]["model"] == "emb"
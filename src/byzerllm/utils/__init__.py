@@ -6,6 +6,8 @@ from transformers import PreTrainedTokenizer,StoppingCriteria
 import torch
 import hashlib
 import threading
+import asyncio
+import bisect
 from typing import TYPE_CHECKING,TypeVar,Dict, List, Optional, Union,Any,Tuple,get_type_hints,Annotated,get_args,Callable
 import typing
 from ray.util.client.common import ClientActorHandle, ClientObjectRef
@@ -126,10 +128,119 @@ def  tokenize_stopping_sequences(tokenizer,stop_words):
         stop_words_ids.append(w)    
     return stop_words_ids
 
+class StopSequenceState:
+    '''
+    The matching state of one sequence: the state of the automaton and the token ids fed so far.
+    '''
+    def __init__(self):
+        self.state = 0
+        self.token_ids:List[int] = []
+        self.matched = False
+
+
+class StopSequenceMatcher:
+    '''
+    Match the stop sequences on the token ids incrementally. The token ids of all the stop sequences
+    are built into an Aho-Corasick automaton, so every new token costs one transition no matter how many stop 
+    sequences there are, and no text is decoded in the generation loop.
+
+    The model may generate the text of a stop sequence with other tokens than the tokenized stop sequence, 
+    e.g. `\nUser:` is tokenized differently after some characters. Such stop sequences are found when 
+    the matcher is created, and only for them the tail of the text is decoded, and only when the new token 
+    contains the last character of the stop sequence.
+
+    ```python
+    matcher = StopSequenceMatcher(tokenizer,tokenize_stopping_sequences(tokenizer,["Human:"]))
+    state = matcher.new_state()
+    matcher.update(state,[token_id])
+    ```
+    '''
+    # the text which may be generated before the stop sequences
+    PROBES = ["a"," ","\n",".","。","0"]
+
+    def __init__(self,tokenizer,stops:List[List[int]],skip_check_min_length:int=0,text_fallback:bool=True):
+        self.tokenizer = tokenizer
+        self.stops = [[int(t) for t in stop] for stop in stops if len(stop) > 0]
+        self.skip_check_min_length = skip_check_min_length
+        self.token_texts:Dict[int,str] = {}
+
+        self.goto:List[Dict[int,int]] = [{}]
+        self.fail:List[int] = [0]
+        self.output:List[bool] = [False]
+        for stop in self.stops:
+            state = 0
+            for token_id in stop:
+                if token_id not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][token_id] = len(self.goto) - 1
+                state = self.goto[state][token_id]
+            self.output[state] = True
+
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for (token_id,next_state) in self.goto[state].items():
+                self.fail[next_state] = self._next(self.fail[state],token_id) if state != 0 else 0
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+                queue.append(next_state)
+
+        self.text_stops:List[Tuple[str,int]] = []
+        if text_fallback:
+            for stop in self.stops:
+                stop_word = tokenizer.decode(stop,skip_special_tokens=True)
+                if stop_word and self._is_ambiguous(stop,stop_word):
+                    self.text_stops.append((stop_word,len(stop)))
+
+    def _is_ambiguous(self,stop:List[int],stop_word:str)->bool:
+        for probe in self.PROBES:
+            token_ids = tokenize_string(self.tokenizer,probe + stop_word)
+            if list(token_ids[-len(stop):]) != stop:
+                return True
+        return False
+
+    def _next(self,state:int,token_id:int)->int:
+        while state != 0 and token_id not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(token_id,0)
+
+    def _token_text(self,token_id:int)->str:
+        if token_id not in self.token_texts:
+            self.token_texts[token_id] = self.tokenizer.decode([token_id],skip_special_tokens=True)
+        return self.token_texts[token_id]
+
+    def new_state(self)->StopSequenceState:
+        return StopSequenceState()
+
+    def update(self,state:StopSequenceState,token_ids:List[int])->bool:
+        '''
+        feed the new generated token ids of the sequence, return True if the sequence ends with a stop sequence.
+        '''
+        for token_id in token_ids:
+            token_id = int(token_id)
+            state.token_ids.append(token_id)
+            state.state = self._next(state.state,token_id)
+            if self.output[state.state] and len(state.token_ids) >= self.skip_check_min_length:
+                state.matched = True
+            elif self.text_stops and len(state.token_ids) >= self.skip_check_min_length:
+                text = self._token_text(token_id)
+                for (stop_word,num_tokens) in self.text_stops:
+                    if stop_word[-1] in text or "\ufffd" in text:
+                        tail = self.tokenizer.decode(state.token_ids[-(num_tokens + 10):],skip_special_tokens=True)
+                        if tail.endswith(stop_word):
+                            state.matched = True
+                            break
+        return state.matched
+
+
 class StopSequencesCriteria(StoppingCriteria):
     """
-     skip_check_min_length is used to skip the the stop sequence check if the input_ids is short
+     skip_check_min_length is used to skip the the stop sequence check if the generated tokens are short
      than the min_length. 
+
+     The stop sequences are matched by `StopSequenceMatcher` on the generated tokens of every sequence in the batch.
+     For a batch of one sequence a bool is returned, otherwise a BoolTensor of the sequences.
     """
     def __init__(self, tokenizer,stops = [],input_start=0, skip_check_min_length=0):
     
@@ -137,17 +248,21 @@ class StopSequencesCriteria(StoppingCriteria):
       self.stops = stops
       self.input_start = input_start
       self.skip_check_min_length = skip_check_min_length
-      self.stop_words= [tokenizer.decode(item,skip_special_tokens=True) for item in stops]
+      self.matcher = StopSequenceMatcher(tokenizer,[item.tolist() if hasattr(item,"tolist") else list(item) for item in stops],
+                                         skip_check_min_length=skip_check_min_length)
+      self.states:List[StopSequenceState] = []
       self.tokenizer = tokenizer   
 
-    def to_str(self,s):
-        return self.tokenizer.decode(s,skip_special_tokens=True)     
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):                   
-      for index,stop in enumerate(self.stops):                        
-        if  self.to_str(input_ids[0][-(len(stop)+10):]).endswith(self.stop_words[index]):
-            return True
-      return False
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+      if len(self.states) != input_ids.shape[0]:
+          self.states = [self.matcher.new_state() for _ in range(input_ids.shape[0])]
+      done = []
+      for (row,state) in zip(input_ids,self.states):
+          start = self.input_start + len(state.token_ids)
+          done.append(self.matcher.update(state,row[start:].tolist()))
+      if len(done) == 1:
+          return done[0]
+      return torch.tensor(done,dtype=torch.bool,device=input_ids.device)
 
 def load_json_str(json_str:str):        
     return json.loads(json_str) 
@@ -179,16 +294,82 @@ class StreamOutputs:
     def __init__(self, outputs:List[SingleOutput]):
         self.outputs = outputs        
 
+class StreamDeltas:
+    '''
+    The append-only text deltas of a stream request. Writers append the new text of every step
+    instead of the full text, and readers fetch the text after their offset, so the bytes moved 
+    through the object store are linear to the generated text.
+    '''
+    def __init__(self):
+        self.chunks:List[List[str]] = []
+        self.starts:List[List[int]] = []
+        self.lengths:List[int] = []
+        self.metadata:List[SingleOutputMeta] = []
+
+    def append(self, item:StreamOutputs):
+        for index,output in enumerate(item.outputs):
+            if index >= len(self.chunks):
+                self.chunks.append([])
+                self.starts.append([])
+                self.lengths.append(0)
+                self.metadata.append(output.metadata)
+            if output.text:
+                self.starts[index].append(self.lengths[index])
+                self.chunks[index].append(output.text)
+                self.lengths[index] += len(output.text)
+            self.metadata[index] = output.metadata
+
+    def text_from(self, index:int, offset:int=0)->str:
+        if offset >= self.lengths[index]:
+            return ""
+        pos = max(bisect.bisect_right(self.starts[index],offset) - 1,0)
+        head = self.chunks[index][pos][offset - self.starts[index][pos]:]
+        return head + "".join(self.chunks[index][pos+1:])
+
+    def to_outputs(self, offsets:Optional[List[int]]=None)->StreamOutputs:
+        offsets = offsets or []
+        return StreamOutputs(outputs=[SingleOutput(text=self.text_from(index,offsets[index] if index < len(offsets) else 0),
+                                                   metadata=self.metadata[index]) for index in range(len(self.chunks))])
+
+def slice_stream_item(item:Any, offsets:Optional[List[int]]=None)->Any:
+    '''
+    convert the item stored in stream server to StreamOutputs, 
+    and only keep the text after the offsets.
+    '''
+    if isinstance(item,StreamDeltas):
+        return item.to_outputs(offsets)
+    if isinstance(item,StreamOutputs) and offsets:
+        return StreamOutputs(outputs=[SingleOutput(text=output.text[offsets[index]:] if index < len(offsets) else output.text,
+                                                   metadata=output.metadata) for index,output in enumerate(item.outputs)])
+    return item
+
 class BlockVLLMStreamServer:
     def __init__(self):
         self.cache = {}
         self.cache_status = {} 
         self.lock = threading.Lock()
+        # notified when a item is added or a request is marked done,
+        # so `get_item(wait_for_change=True)` can wake up without polling
+        self.condition = threading.Condition(self.lock)
+        self.changed = set()
 
     def add_item(self, request_id, item):
         with self.lock:            
             self.cache[request_id]=item
             self.cache_status[request_id]=int(time.time()*1000)
+            self.changed.add(request_id)
+            self.condition.notify_all()
+
+    def add_delta(self, request_id, item:StreamOutputs):
+        with self.lock:
+            v = self.cache.get(request_id, None)
+            if not isinstance(v,StreamDeltas):
+                v = StreamDeltas()
+                self.cache[request_id] = v
+            v.append(item)
+            self.cache_status[request_id]=int(time.time()*1000)
+            self.changed.add(request_id)
+            self.condition.notify_all()
     
     def mark_done(self, request_id):
         if len(self.cache_status) > 30:
@@ -198,27 +379,62 @@ class BlockVLLMStreamServer:
                     if now - self.cache_status[k] > 10*60*60*1000:
                         del self.cache_status[k]
                         del self.cache[k] 
+                        self.changed.discard(k)
         with self.lock:            
             self.cache_status[request_id] = 0
-
-    def get_item(self, request_id):                
+            self.changed.add(request_id)
+            self.condition.notify_all()
+
+    def get_item(self, request_id, wait_for_change:bool=False, timeout:float=1.0):
+        '''
+        get the latest item of the request. If `wait_for_change` is True, block until 
+        the item is changed since last `get_item` or the request is done, or `timeout` seconds passed.
+        '''
+        return self.get_delta(request_id,offsets=None,wait_for_change=wait_for_change,timeout=timeout)
+
+    def get_delta(self, request_id, offsets:Optional[List[int]]=None, wait_for_change:bool=False, timeout:float=1.0):
+        '''
+        the same as `get_item`, but the text of every output only contains the text after `offsets`
+        '''
         with self.lock:
+            # the request is finished and consumed (or unknown), do not wait
+            if wait_for_change and request_id in self.cache and request_id not in self.changed:
+                self.condition.wait_for(lambda: request_id in self.changed,timeout=timeout)
+            self.changed.discard(request_id)
             v = self.cache.get(request_id, None)     
             if request_id in self.cache_status and self.cache_status[request_id] == 0:
                 del self.cache[request_id]
                 del self.cache_status[request_id]
-            return v     
+            return slice_stream_item(v,offsets)     
 
 class VLLMStreamServer:
     def __init__(self):
         self.cache = {}
         self.cache_status = {} 
         self.lock = threading.Lock()
+        # request_id -> asyncio.Event, set when the item of the request is changed
+        self.events = {}
+
+    def _notify(self, request_id):
+        if request_id not in self.events:
+            self.events[request_id] = asyncio.Event()
+        self.events[request_id].set()
 
     async def add_item(self, request_id, item):
         with self.lock:            
             self.cache[request_id]=item
             self.cache_status[request_id]=int(time.time()*1000)
+        self._notify(request_id)
+
+    async def add_delta(self, request_id, item:StreamOutputs):
+        with self.lock:
+            v = self.cache.get(request_id, None)
+            if not isinstance(v,StreamDeltas):
+                v = StreamDeltas()
+                self.cache[request_id] = v
+            v.append(item)
+            self.cache_status[request_id]=int(time.time()*1000)
+        self._notify(request_id)
     
     async def mark_done(self, request_id):
         if len(self.cache_status) > 30:
@@ -228,16 +444,147 @@ class VLLMStreamServer:
                     if now - self.cache_status[k] > 10*60*60*1000:
                         del self.cache_status[k]
                         del self.cache[k] 
+                        self.events.pop(k,None)
         with self.lock:            
             self.cache_status[request_id] = 0
-
-    async def get_item(self, request_id):                
+        self._notify(request_id)
+
+    async def get_item(self, request_id, wait_for_change:bool=False, timeout:float=1.0):
+        '''
+        get the latest item of the request. If `wait_for_change` is True, wait until 
+        the item is changed since last `get_item` or the request is done, or `timeout` seconds passed.
+        '''
+        return await self.get_delta(request_id,offsets=None,wait_for_change=wait_for_change,timeout=timeout)
+
+    async def get_delta(self, request_id, offsets:Optional[List[int]]=None, wait_for_change:bool=False, timeout:float=1.0):
+        '''
+        the same as `get_item`, but the text of every output only contains the text after `offsets`
+        '''
+        # the request is finished and consumed (or unknown), do not wait
+        if wait_for_change and request_id in self.cache:
+            if request_id not in self.events:
+                self.events[request_id] = asyncio.Event()
+            event = self.events[request_id]
+            try:
+                await asyncio.wait_for(event.wait(),timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+        
         with self.lock:
             v = self.cache.get(request_id, None)     
             if request_id in self.cache_status and self.cache_status[request_id] == 0:
                 del self.cache[request_id]
                 del self.cache_status[request_id]
-            return v
+                self.events.pop(request_id,None)
+            return slice_stream_item(v,offsets)
+
+
+def get_or_create_stream_server(name:str="VLLM_STREAM_SERVER"):
+    import ray
+    try:
+        return ray.get_actor(name)
+    except ValueError:
+        return ray.remote(VLLMStreamServer).options(name=name,lifetime="detached",max_concurrency=1000).remote()
+
+
+class StreamServerStreamer:
+    '''
+    A streamer for `model.generate(streamer=...)` of transformers, which sends the generated text 
+    to the stream server with the same protocol as the vLLM backend(`add_delta` and `mark_done`), 
+    so `stream_chat_oai` works with the transformers models.
+
+    The text is sent by a background thread and the tokens generated while a call is in flight are 
+    merged into the next delta, so the generation is never blocked by the stream server.
+    The caller should add the "RUNNING" item of the request before returning the request id.
+    '''
+    def __init__(self,tokenizer,request_id:str,input_tokens_count:int=0,
+                 server_name:str="VLLM_STREAM_SERVER",skip_prompt:bool=True):
+        import ray
+        self.tokenizer = tokenizer
+        self.request_id = request_id
+        self.input_tokens_count = input_tokens_count
+        self.server = ray.get_actor(server_name)
+        self.skip_prompt = skip_prompt
+        self.prompt_skipped = False
+        self.token_ids:List[int] = []
+        # token_ids[prefix_offset:read_offset] is the decoded context of the new tokens
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+        self.pending = ""
+        self.done = False
+        self.condition = threading.Condition()
+        self.sender = threading.Thread(target=self._send_loop,daemon=True)
+        self.sender.start()
+
+    def put(self,value):
+        if self.skip_prompt and not self.prompt_skipped:
+            self.prompt_skipped = True
+            return
+        if len(value.shape) > 1:
+            value = value[0]
+        self.token_ids.extend(value.tolist())
+        new_text = self._decode_new_text()
+        # wait for the rest bytes of a multi-byte character
+        if not new_text or new_text.endswith("\ufffd"):
+            return
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self._add_text(self.text + new_text)
+
+    def end(self):
+        self._add_text(self.text + self._decode_new_text(),done=True)
+
+    def _decode_new_text(self)->str:
+        '''
+        decode the new tokens after the last decoded ones, together with the previous tokens as the context
+        (the space or the bytes of a character depend on them), so every step only decodes a few tokens
+        instead of all the generated tokens.
+        '''
+        prefix_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:self.read_offset],skip_special_tokens=True)
+        text = self.tokenizer.decode(self.token_ids[self.prefix_offset:],skip_special_tokens=True)
+        return text[len(prefix_text):] if len(text) > len(prefix_text) else ""
+
+    def join(self,timeout:Optional[float]=None):
+        self.sender.join(timeout)
+
+    def _add_text(self,text:str,done:bool=False):
+        with self.condition:
+            # the decoded text may be changed by the new tokens in rare cases, only send the text after the old one
+            if text.startswith(self.text):
+                self.pending += text[len(self.text):]
+                self.text = text
+            self.done = self.done or done
+            self.condition.notify_all()
+
+    def _send_loop(self):
+        import ray
+        support_delta = True
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.done)
+                (delta,text,done) = (self.pending,self.text,self.done)
+                self.pending = ""
+                generated_tokens_count = len(self.token_ids)
+            metadata = SingleOutputMeta(input_tokens_count=self.input_tokens_count,
+                                        generated_tokens_count=generated_tokens_count)
+            try:
+                if support_delta and delta:
+                    try:
+                        ray.get(self.server.add_delta.remote(self.request_id,StreamOutputs(outputs=[SingleOutput(text=delta,metadata=metadata)])))
+                    except Exception:
+                        # fallback to the full text if the stream server do not support add_delta
+                        support_delta = False
+                if not support_delta:
+                    ray.get(self.server.add_item.remote(self.request_id,StreamOutputs(outputs=[SingleOutput(text=text,metadata=metadata)])))
+                if done:
+                    ray.get(self.server.mark_done.remote(self.request_id))
+            except Exception as inst:
+                print(f"Fail to send the stream output of request {self.request_id}: {inst}",flush=True)
+            if done:
+                return
+
         
 def get_type_name(t):
     name = str(t)
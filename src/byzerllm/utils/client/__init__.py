@@ -4,6 +4,12 @@ from pyjava.udf import UDFBuilder
 import ray
 from ray.util.client.common import ClientActorHandle, ClientObjectRef
 from byzerllm.utils.client import code_utils 
+from byzerllm.utils.client.cache_utils import META_CACHE,RENDER_CACHE,TOKENIZER_REGISTRY,ResponseCache,FuncImplCache,EmbeddingCache
+from byzerllm.utils.client.lease_utils import LEASE_MANAGER
+from byzerllm.utils.client.trace_utils import Tracer,Span,HistogramRegistry,JsonLinesExporter
+from byzerllm.utils.client.routing_utils import ModelGroup,RoutingPolicy,AFFINITY_ROUTER,conversation_affinity_key
+from byzerllm.utils.client.rate_limit_utils import RateLimiter,RATE_LIMITERS,count_result_tokens,count_stream_tokens
+from byzerllm.utils.client.rerank_utils import RerankScoreCache,parse_rerank_output,select_top_k
 from byzerllm.utils import (function_calling_format,
                             response_class_format,
                             response_class_format_after_chat,
@@ -13,7 +19,8 @@ from byzerllm.utils import (function_calling_format,
                             sys_response_class_format,
                             sys_function_calling_format,
                             sys_function_impl_format,
-                            exec_capture_output
+                            exec_capture_output,
+                            generate_str_md5
                             )
 from langchain.prompts import PromptTemplate
 import json
@@ -27,6 +34,9 @@ import inspect
 import pydantic
 import copy
 import traceback
+import collections
+import threading
+import os
 
 
 logger = logging.getLogger(__name__)
@@ -356,6 +366,15 @@ class ByzerLLM:
         self.mapping_role_mapping = {}
         self.mapping_extra_generation_params = {}
         self.mapping_clean_func = {}
+
+        # model name -> ModelGroup, the requests of the model are routed to the replicas in the group
+        self.mapping_model_group = {}
+        # model name -> affinity routing config, see `setup_affinity_routing`
+        self.mapping_affinity_routing = {}
+
+        # request id -> (model,worker) of the latest requests, used by `abort`
+        self.request_workers = collections.OrderedDict()
+        self.request_workers_lock = threading.Lock()
    
         self.mapping_function_calling_format_func = {}
         self.mapping_response_class_format_func = {}
@@ -369,8 +388,39 @@ class ByzerLLM:
         self.mapping_sys_impl_func_format_func = {}
 
         
-        self.func_impl_cache = {}
-        self.meta_cache = {}
+        self.func_impl_cache = FuncImplCache(db_path=kwargs.get("impl_cache_path",None))
+
+        # load the tokenizers in the client process (see `TOKENIZER_REGISTRY`), so the context length check
+        # in `_query` do not need a remote tokenize call for every request.
+        self.enable_local_tokenizer = kwargs.get("enable_local_tokenizer",True)
+
+        # the max seconds the stream server holds a `get_item` call when there is no new output
+        self.stream_wait_timeout = kwargs.get("stream_wait_timeout",1.0)
+
+        # send the requests as plain python objects instead of json strings 
+        # if the worker supports it, see `_encode_input_value`
+        self.enable_binary_protocol = kwargs.get("enable_binary_protocol",True)
+
+        # embed a list of texts with one request if the worker supports it, see `emb`.
+        # The models which can not answer the meta request are recorded in `mapping_batch_embedding_unsupported`
+        self.enable_batch_embedding = kwargs.get("enable_batch_embedding",True)
+        self.mapping_batch_embedding_unsupported = {}
+
+        # opt-in exact-match cache for the chat responses, see `setup_response_cache`
+        self.response_cache = None
+
+        # opt-in content-addressed cache for the embeddings, see `setup_emb_cache`
+        self.emb_cache = None
+
+        # opt-in reuse of the rendered prefix of the session, see `setup_render_cache`
+        self.enable_render_cache = False
+
+        # the scores of the (query, passage) pairs reranked by `emb_rerank`, see `setup_rerank_cache`
+        self.rerank_cache = RerankScoreCache()
+
+        # latency spans of every phase of the requests, see `setup_tracing`
+        self.tracer = Tracer()
+        self.latency_histogram = None
 
         self.byzer_engine_url = None
         if "byzer_engine_url" in kwargs:
@@ -485,6 +535,208 @@ class ByzerLLM:
         self.sys_conf["workerMaxConcurrency"] = num
         return self        
 
+    def setup_worker_lease_window(self,lease_window:float)->'ByzerLLM':
+        '''
+        hold the worker lease for `lease_window` seconds after a request is finished,
+        so the next request of the same model can reuse it without asking the udf master.
+        Notice that this setting is shared by all ByzerLLM instances in the process, and 
+        the held leases can not be used by other processes until they are expired. 
+        Default is 0 which means give back the lease immediately.
+        '''
+        LEASE_MANAGER.set_lease_window(lease_window)
+        return self
+
+    def setup_model_group(self,model:str,replicas:List[str],
+                          policy:str=RoutingPolicy.LeastOutstanding,
+                          weights:Optional[List[float]]=None,
+                          eject_seconds:float=30,
+                          max_outstanding:Optional[int]=None,
+                          max_retries:int=1)->'ByzerLLM':
+        '''
+        route the requests of `model` to the deployments in `replicas`, e.g. 
+        `llm.setup_model_group("qwen",["qwen_a","qwen_b"])` then `llm.chat_oai(conversations,model="qwen")`.
+        The other settings(template, role mapping, etc.) should be set on the group name.
+
+        Args:
+            policy: least_outstanding, power_of_two or weighted_round_robin, see `RoutingPolicy`
+            weights: the weights of the replicas for weighted_round_robin
+            eject_seconds: the replica which is dead or not found will not be used for these seconds
+            max_outstanding: the replicas with this number of outstanding requests in this process are skipped 
+            max_retries: retry on another replica when the replica is dead or not found
+        '''
+        self.mapping_model_group[model] = ModelGroup(model,replicas,policy=policy,weights=weights,
+                                                     eject_seconds=eject_seconds,
+                                                     max_outstanding=max_outstanding,
+                                                     max_retries=max_retries)
+        return self
+
+    def get_model_group_stats(self,model:str)->Dict[str,Any]:
+        if model not in self.mapping_model_group:
+            return {}
+        return self.mapping_model_group[model].stats()
+
+    def setup_rate_limit(self,model:str,
+                         max_concurrency:Optional[int]=None,
+                         tokens_per_minute:Optional[int]=None,
+                         requests_per_second:Optional[float]=None,
+                         queue_timeout:float=60)->'ByzerLLM':
+        '''
+        limit the requests of the model sent from this process. The limiter is shared by all ByzerLLM 
+        instances in the process. The waiting requests are admitted in FIFO order, and `RateLimitTimeoutError` 
+        is raised if a request waits more than `queue_timeout` seconds.
+
+        Args:
+            max_concurrency: the max number of running requests
+            tokens_per_minute: the max prompt+generated tokens per minute, counted from the response metadata
+            requests_per_second: the max requests per second
+        Set all of them to None to remove the limiter.
+        '''
+        if max_concurrency is None and tokens_per_minute is None and requests_per_second is None:
+            RATE_LIMITERS.set(model,None)
+            return self
+        RATE_LIMITERS.set(model,RateLimiter(model,max_concurrency=max_concurrency,
+                                            tokens_per_minute=tokens_per_minute,
+                                            requests_per_second=requests_per_second,
+                                            queue_timeout=queue_timeout))
+        return self
+
+    def get_rate_limit_stats(self,model:str)->Dict[str,Any]:
+        limiter = RATE_LIMITERS.get(model)
+        if limiter is None:
+            return {}
+        return limiter.stats()
+
+    def setup_affinity_routing(self,model:str,
+                               num_prefix_messages:int=2,
+                               num_candidates:int=2,
+                               max_active_tasks:Optional[int]=None)->'ByzerLLM':
+        '''
+        route the turns of the same conversation to the same worker of the model, so the worker(e.g. vLLM) 
+        can reuse the prefix cache of the history. The affinity key is `llm_config["session_id"]` if it's set, 
+        otherwise the hash of the first `num_prefix_messages` messages of the conversation.
+
+        The workers are chosen by consistent hashing of the affinity key. If the preferred worker has 
+        `max_active_tasks`(default is the workerMaxConcurrency of the model) running tasks, 
+        the next one of the `num_candidates` workers is tried, and at last fallback to the udf master.
+        '''
+        self.mapping_affinity_routing[model] = {
+            "num_prefix_messages":num_prefix_messages,
+            "num_candidates":num_candidates,
+            "max_active_tasks":max_active_tasks
+        }
+        return self
+
+    def setup_tracing(self,exporter:Optional[Callable[[Span],None]]=None,
+                      json_lines_path:Optional[str]=None)->'ByzerLLM':
+        '''
+        record the latency of every phase of chat_oai/_query/emb as spans, e.g. 
+        `prepare`,`render_template`,`tokenize_check`,`lease_wait`,`worker_execute`,`decode`,`post_process`.
+        
+        The spans are always aggregated in a histogram registry, use `get_latency_stats` to get 
+        the p50/p90/p99 per model and per phase. 
+
+        Args:
+            exporter: a callable which accepts a `Span`, it's called when every span is finished
+            json_lines_path: append the spans to this file as OpenTelemetry style json lines
+        '''
+        if self.latency_histogram is None:
+            self.latency_histogram = HistogramRegistry()
+            self.tracer.add_exporter(self.latency_histogram)
+        if exporter is not None:
+            self.tracer.add_exporter(exporter)
+        if json_lines_path is not None:
+            self.tracer.add_exporter(JsonLinesExporter(json_lines_path))
+        return self
+
+    def get_latency_stats(self)->List[Dict[str,Any]]:
+        if self.latency_histogram is None:
+            return []
+        return self.latency_histogram.stats()
+
+    def setup_impl_cache(self,db_path:Optional[str]=None)->'ByzerLLM':
+        '''
+        persist the functions generated by `impl` in the sqlite file `db_path`, 
+        so they can be reused by other processes and later runs. 
+        None means keep them in memory only.
+        '''
+        self.func_impl_cache = FuncImplCache(db_path=db_path)
+        return self
+
+    def setup_response_cache(self,max_size:int=1024,ttl:Optional[float]=None,db_path:Optional[str]=None)->'ByzerLLM':
+        '''
+        enable the exact-match response cache for chat_oai. If the model, the rendered instruction, the history 
+        and the generation params are all the same as a cached request, the cached response will be returned 
+        without calling the model, and `metadata["cache_hit"]` of the response is True.
+
+        Args:
+            max_size: the max number of responses in memory
+            ttl: the seconds the responses are kept, None means never expire
+            db_path: the sqlite file to persist the responses, None means memory only
+        
+        The stream requests are never cached. Notice that the responses of sampling with high temperature 
+        will also be cached, use it for the deterministic prompts.
+        '''
+        self.response_cache = ResponseCache(max_size=max_size,ttl=ttl,db_path=db_path)
+        return self
+
+    def clear_response_cache(self):
+        if self.response_cache is not None:
+            self.response_cache.clear()
+
+    def get_response_cache_stats(self)->Dict[str,Any]:
+        if self.response_cache is None:
+            return {}
+        return self.response_cache.stats()
+
+    def setup_emb_cache(self,max_size:int=10000,cache_dir:Optional[str]=None,read_only:bool=False)->'ByzerLLM':
+        '''
+        enable the embedding cache for emb/emb_query. The texts embedded by the same model with the same 
+        params are only sent to the model once, and `metadata["cache_hit"]` of the response is True.
+
+        Args:
+            max_size: the max number of embeddings in memory
+            cache_dir: the directory to persist the embeddings as memory-mapped float32 files, 
+                       it can be shared by the processes on the same node. None means memory only
+            read_only: open `cache_dir` without writing to it, e.g. in the processes which only search
+        '''
+        self.emb_cache = EmbeddingCache(max_size=max_size,cache_dir=cache_dir,read_only=read_only)
+        return self
+
+    def clear_emb_cache(self):
+        if self.emb_cache is not None:
+            self.emb_cache.clear()
+
+    def get_emb_cache_stats(self)->Dict[str,Any]:
+        if self.emb_cache is None:
+            return {}
+        return self.emb_cache.stats()
+
+    def setup_render_cache(self,enable:bool=True,max_size:Optional[int]=None)->'ByzerLLM':
+        '''
+        reuse the rendered prefix of the conversation in the next turn of the same `llm_config["session_id"]`,
+        so only the new messages are rendered. The new conversations should append to the old ones.
+        max_size: the max number of the entries of the process-wide render cache.
+        '''
+        self.enable_render_cache = enable
+        if max_size is not None:
+            RENDER_CACHE.max_size = max_size
+        return self
+
+    def get_render_cache_stats(self)->Dict[str,Any]:
+        return RENDER_CACHE.stats()
+
+    def setup_rerank_cache(self,max_size:int=100000)->'ByzerLLM':
+        '''
+        set the max number of the cached rerank scores, 0 disables the cache.
+        '''
+        self.rerank_cache = RerankScoreCache(max_size=max_size) if max_size > 0 else None
+        return self
+
+    def get_rerank_cache_stats(self)->Dict[str,Any]:
+        if self.rerank_cache is None:
+            return {}
+        return self.rerank_cache.stats()
+
     def setup_num_workers(self,num_workers:int)->'ByzerLLM':
         self.sys_conf["maxConcurrency"] = num_workers
         return self
@@ -501,6 +753,21 @@ class ByzerLLM:
         self.mapping_max_output_length[model] = max_output_length
         return self
     
+    def setup_local_tokenizer(self,model:str,tokenizer:Any)->'ByzerLLM':
+        '''
+        setup the tokenizer used by the context length check of the model. 
+        The tokenizer is registered in the process-wide `TOKENIZER_REGISTRY`.
+
+        Args:
+            model (str): the udf name of the model
+            tokenizer (Any): a tokenizer object or a tokenizer name/path which can be loaded by `AutoTokenizer`
+        '''
+        if isinstance(tokenizer,str):
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer,trust_remote_code=True)
+        TOKENIZER_REGISTRY.put(self._get_namespace(),model,tokenizer)
+        return self
+    
     def setup_role_mapping(self,model:str,role_mapping:Dict[str,str])->'ByzerLLM':
         self.mapping_role_mapping[model] = role_mapping
         return self
@@ -662,6 +929,8 @@ class ByzerLLM:
         convert(train_params,self.conf()) 
 
     def undeploy(self,udf_name:str):                  
+        self.clear_meta_cache(udf_name)
+        LEASE_MANAGER.invalidate(self._get_namespace(),udf_name)
         try:
             model = ray.get_actor(udf_name)
             ray.kill(model)        
@@ -671,31 +940,45 @@ class ByzerLLM:
     def generate_instruction_from_history(self,model:str,conversations:List[Dict[str,str]],role_mapping:Dict[str,str]={        
         "user_role":"User:",        
         "assistant_role":"Assistant:",
-    }):                
+    },session_id:Optional[str]=None):                
+        '''
+        render the conversations to the instruction. The instructions rendered by the remote chat template 
+        are cached in the process-wide `RENDER_CACHE`.
+        If the render cache is enabled (see `setup_render_cache`) and `session_id` is set, 
+        the rendered prefix of the last turn of the session is reused and only the new messages are rendered.
+        '''
         meta = self.get_meta(model=model)
         if self.mapping_auto_use_apply_chat_template.get(model,False) and meta.get("support_chat_template",False) :
-            return self.apply_chat_template(model,json.dumps(conversations,ensure_ascii=False))
-
-        new_his = []    
-        for item in conversations:
-            if item["role"] == "system":
-                value = item["content"]
-                if "system_msg_func" in role_mapping:
-                    value = role_mapping["system_msg_func"](t=role_mapping["system_msg"],v=item["content"])
+            s = json.dumps(conversations,ensure_ascii=False)
+            key = ("chat_template",self._get_namespace(),model,generate_str_md5(s))
+            fin_ins = RENDER_CACHE.get(key)
+            if fin_ins is None:
+                fin_ins = self.apply_chat_template(model,s)
+                RENDER_CACHE.put(key,fin_ins)
+            return fin_ins
+
+        new_his = []
+        start = 0
+        use_cache = self.enable_render_cache and session_id is not None and len(conversations) > 0
+        if use_cache:
+            key = ("session",self._get_namespace(),model,str(session_id))
+            cached = RENDER_CACHE.get(key)
+            # (the rendered messages, the number of the messages, the first and the last message, the role mapping).
+            # only the first and the last message are checked, the messages of a session should only be appended
+            if cached is not None:
+                (prefix,num_messages,first_message,last_message,cached_role_mapping) = cached
+                if 0 < num_messages <= len(conversations) and conversations[num_messages - 1] == last_message \
+                        and conversations[0] == first_message and cached_role_mapping == role_mapping:
+                    new_his = list(prefix)
+                    start = num_messages
+
+        for item in conversations[start:]:
+            value = self._render_message(item,role_mapping)
+            if value is not None:
                 new_his.append(value)
-                continue
-            
-            if item["role"] == "user":
-                value =  f"{role_mapping['user_role']}{item['content']}"
-                if "user_role_func" in role_mapping:
-                        value = role_mapping["user_role_func"](t=role_mapping["user_role"],v=item["content"])         
-                new_his.append(value)  
-            
-            if item["role"] == "assistant":
-                value =  f"{role_mapping['assistant_role']}{item['content']}"
-                if "user_role_func" in role_mapping:
-                        value = role_mapping["assistant_role_func"](t=role_mapping["assistant_role"],v=item["content"])         
-                new_his.append(value)              
+
+        if use_cache:
+            RENDER_CACHE.put(key,(tuple(new_his),len(conversations),dict(conversations[0]),dict(conversations[-1]),dict(role_mapping)))
         
         if conversations[-1]["role"] == "user":            
             new_his.append(f"{role_mapping['assistant_role']}")
@@ -703,6 +986,27 @@ class ByzerLLM:
         fin_ins = "\n".join(new_his)
         return fin_ins     
 
+    def _render_message(self,item:Dict[str,Any],role_mapping:Dict[str,str])->Optional[str]:
+        if item["role"] == "system":
+            value = item["content"]
+            if "system_msg_func" in role_mapping:
+                value = role_mapping["system_msg_func"](t=role_mapping["system_msg"],v=item["content"])
+            return value
+        
+        if item["role"] == "user":
+            value =  f"{role_mapping['user_role']}{item['content']}"
+            if "user_role_func" in role_mapping:
+                    value = role_mapping["user_role_func"](t=role_mapping["user_role"],v=item["content"])         
+            return value
+        
+        if item["role"] == "assistant":
+            value =  f"{role_mapping['assistant_role']}{item['content']}"
+            if "user_role_func" in role_mapping:
+                    value = role_mapping["assistant_role_func"](t=role_mapping["assistant_role"],v=item["content"])         
+            return value
+        
+        return None
+
     def is_model_exist(self,udf_name:str)->bool:
         try:
             ray.get_actor(udf_name)
@@ -716,6 +1020,8 @@ class ByzerLLM:
                infer_params:Dict[str,Any]):        
         from byzerllm import common_init_model
         self.setup("UDF_CLIENT",udf_name)
+        self.clear_meta_cache(udf_name)
+        LEASE_MANAGER.invalidate(self._get_namespace(),udf_name)
 
         infer_backend = self.sys_conf["infer_backend"]
         
@@ -748,10 +1054,18 @@ class ByzerLLM:
                 model_dir=model_path,
                 tokenizer_dir=f"{model_path}/pretrained_tokenizer")
                 return infer
+            from byzerllm.utils.text_generator import decode_input_value,encode_output_value,with_binary_protocol
             def predict_func(model,v):
-                data = [json.loads(item) for item in v]
-                results=[{"predict":model.text_to_voice(item["instruction"]).tolist(),"labels":""} for item in data]
-                return {"value":[json.dumps(results,ensure_ascii=False,indent=4)]}
+                (data,is_binary) = decode_input_value(v)
+                results = []
+                for item in data:
+                    if item.get("meta",False):
+                        results.append({"predict":with_binary_protocol([{"model_deploy_type":"proprietary"}]),"metadata":{},"input":item})
+                        continue
+                    # the audio array is sent as is in the binary protocol
+                    audio = model.text_to_voice(item["instruction"])
+                    results.append({"predict":audio if is_binary else audio.tolist(),"metadata":{},"input":item})
+                return encode_output_value(results,is_binary)
             UDFBuilder.build(self.ray_context,init_model,predict_func)
             return                
         
@@ -782,8 +1096,10 @@ class ByzerLLM:
         if not model:
             model = self.default_model_name
 
-        if model in self.meta_cache:
-            return self.meta_cache[model]    
+        namespace = self._get_namespace()
+        cached_meta = META_CACHE.get(namespace,model)
+        if cached_meta is not None:
+            return cached_meta
 
         default_config = self.mapping_extra_generation_params.get(model,{})
 
@@ -796,8 +1112,57 @@ class ByzerLLM:
         if len(t) != 0 and len(t[0].output) != 0 :
             res = t[0].output[0]
 
-        self.meta_cache[model] = res            
-        return self.meta_cache[model]
+        META_CACHE.put(namespace,model,res)
+        return res
+
+    async def async_get_meta(self,model:str,llm_config:Dict[str,Any]={}):
+        if not model and not self.default_model_name:
+            raise Exception("model name is required")
+        
+        if not model:
+            model = self.default_model_name
+
+        namespace = self._get_namespace()
+        cached_meta = META_CACHE.get(namespace,model)
+        if cached_meta is not None:
+            return cached_meta
+
+        default_config = self.mapping_extra_generation_params.get(model,{})
+
+        v = [{"instruction":"","meta":True, **{**default_config,**llm_config} }]        
+        res = await self._async_query(model,v) 
+        
+        t = [LLMResponse(output=item["predict"],metadata=item.get("metadata",{}),input=item["input"]) for item in res]        
+        
+        res = {}
+        if len(t) != 0 and len(t[0].output) != 0 :
+            res = t[0].output[0]
+
+        META_CACHE.put(namespace,model,res)
+        return res
+
+    def _get_namespace(self)->str:
+        try:
+            return ray.get_runtime_context().namespace
+        except Exception:
+            return "default"
+
+    def clear_meta_cache(self,model:Optional[str]=None)->'ByzerLLM':
+        '''
+        invalidate the shared meta cache of the model in current ray namespace.
+        If model is None, all models in current namespace will be invalidated.
+        '''
+        META_CACHE.invalidate(self._get_namespace(),model)
+        RENDER_CACHE.invalidate(self._get_namespace(),model)
+        TOKENIZER_REGISTRY.invalidate(self._get_namespace(),model)
+        if model is None:
+            self.mapping_batch_embedding_unsupported = {}
+        else:
+            self.mapping_batch_embedding_unsupported.pop(model,None)
+        return self
+
+    def get_meta_cache_stats(self)->Dict[str,Any]:
+        return META_CACHE.stats()
         
     def tokenize(self,model:str,s:str,llm_config:Dict[str,Any]={})->List[str]:
         
@@ -812,6 +1177,77 @@ class ByzerLLM:
         v = [{"instruction":s,"tokenizer":True, **{**default_config,**llm_config} }]        
         res = self._query(model,v) 
         return [LLMResponse(output=item["predict"],metadata=item.get("metadata",{}),input=item["input"]) for item in res]
+
+    async def async_tokenize(self,model:str,s:str,llm_config:Dict[str,Any]={})->List[str]:
+        
+        if not model and not self.default_model_name:
+            raise Exception("model name is required")
+        
+        if not model:
+            model = self.default_model_name
+
+        default_config = self.mapping_extra_generation_params.get(model,{})
+
+        v = [{"instruction":s,"tokenizer":True, **{**default_config,**llm_config} }]        
+        res = await self._async_query(model,v) 
+        return [LLMResponse(output=item["predict"],metadata=item.get("metadata",{}),input=item["input"]) for item in res]
+    
+    def get_local_tokenizer(self,model:str):
+        '''
+        get the tokenizer of the model which is loaded in the client process.
+        The tokenizer is loaded only once per model in the process by the `tokenizer_path` reported by `get_meta`.
+        The path is on the worker node, so it is only loaded if it exists in this node, and never from the hub.
+        Return None if the tokenizer can not be loaded locally.
+        '''
+        return TOKENIZER_REGISTRY.get_or_load(self._get_namespace(),model,lambda: self._load_local_tokenizer(model))
+
+    def _load_local_tokenizer(self,model:str):
+        try:
+            meta = self.get_meta(model=model)
+            tokenizer_path = meta.get("tokenizer_path",None)
+            if tokenizer_path and os.path.isdir(tokenizer_path):
+                from transformers import AutoTokenizer
+                return AutoTokenizer.from_pretrained(tokenizer_path,trust_remote_code=True,local_files_only=True)
+        except Exception as inst:
+            if self.verbose:
+                print(f"Fail to load tokenizer of model[{model}] locally, fallback to remote tokenizer: {inst}",flush=True)
+        return None
+
+    def _count_tokens(self,model:str,s:List[str])->List[Optional[int]]:
+        '''
+        count the tokens of the strings in one pass. None means the count is not available.
+        '''
+        tokenizer = self.get_local_tokenizer(model) if self.enable_local_tokenizer else None
+        if tokenizer is not None:
+            return [len(ids) for ids in tokenizer(s,return_token_type_ids=False)["input_ids"]]
+        
+        result = []
+        for item in s:
+            try:
+                result.append(len(self.tokenize(model,item,{})[0].output[0]))
+            except Exception as inst:
+                result.append(None)
+        return result
+
+    async def _async_count_tokens(self,model:str,s:List[str])->List[Optional[int]]:
+        tokenizer = None
+        if self.enable_local_tokenizer:
+            if not TOKENIZER_REGISTRY.contains(self._get_namespace(),model):
+                # loading the tokenizer may take a while, do not block the event loop
+                await self.async_get_meta(model=model)
+                await asyncio.to_thread(self.get_local_tokenizer,model)
+            tokenizer = self.get_local_tokenizer(model)
+        
+        if tokenizer is not None:
+            return [len(ids) for ids in tokenizer(s,return_token_type_ids=False)["input_ids"]]
+        
+        result = []
+        for item in s:
+            try:
+                result.append(len((await self.async_tokenize(model,item,{}))[0].output[0]))
+            except Exception as inst:
+                result.append(None)
+        return result
     
     def apply_chat_template(self,model:str,s:str,llm_config:Dict[str,Any]={}):
         if not model and not self.default_model_name:
@@ -831,20 +1267,45 @@ class ByzerLLM:
         return self.emb(model=model,request=LLMRequest(instruction=v))
 
 
-    def emb(self, model, request:LLMRequest ,extract_params:Dict[str,Any]={}):
-        
-        if not model and not self.default_emb_model_name:
-            raise Exception("model name is required")
-        
-        if not model:
-            model = self.default_emb_model_name
+    def _support_batch_embedding(self,model:str)->bool:
+        if not self.enable_batch_embedding or model in self.mapping_batch_embedding_unsupported:
+            return False
+        try:
+            meta = self.get_meta(model=model)
+        except Exception:
+            self.mapping_batch_embedding_unsupported[model] = True
+            return False
+        return meta.get("support_batch_embedding",False)
+
+    async def _async_support_batch_embedding(self,model:str)->bool:
+        if not self.enable_batch_embedding or model in self.mapping_batch_embedding_unsupported:
+            return False
+        try:
+            meta = await self.async_get_meta(model=model)
+        except Exception:
+            self.mapping_batch_embedding_unsupported[model] = True
+            return False
+        return meta.get("support_batch_embedding",False)
 
+    def _build_emb_input_value(self, model, request:LLMRequest ,extract_params:Dict[str,Any]={},batch:bool=False):
+        '''
+        If `batch` is True, the texts are sent in one item with `embedding_batch`, and the worker 
+        embeds them with `embed_documents` and returns a N x D array. 
+        The micro batch size of the worker can be set by `gen.batch_size` in extract_params.
+        '''
         default_config = self.mapping_extra_generation_params.get(model,{})            
 
         if isinstance(request,list):
             request = LLMRequest(instruction=request)
 
-        if isinstance(request.instruction,str):
+        if batch and not isinstance(request.instruction,str):
+            v = [{
+            "instruction":list(request.instruction),
+            "embedding":True,
+            "embedding_batch":True,
+            ** default_config,
+            ** extract_params}]
+        elif isinstance(request.instruction,str):
             v = [{
             "instruction":request.instruction,
             "embedding":True,
@@ -861,23 +1322,140 @@ class ByzerLLM:
             "top_p":request.top_p,
             "temperature":request.temperature,            
             ** default_config, 
-            ** extract_params} for x in request.instruction]    
+            ** extract_params} for x in request.instruction]
+        return v
+
+    def _to_emb_responses(self,res:List[Dict[str,Any]])->List[LLMResponse]:
+        responses = []
+        for item in res:
+            if not item["input"].get("embedding_batch",False):
+                responses.append(LLMResponse(output=item["predict"],metadata=item.get("metadata",{}),input=item["input"]))
+                continue
+            # split the N x D array of the batch embedding into one response per text
+            inputs = {k:v for k,v in item["input"].items() if k not in ["instruction","embedding_batch"]}
+            for text,embedding in zip(item["input"]["instruction"],item["predict"]):
+                responses.append(LLMResponse(output=embedding.tolist() if hasattr(embedding,"tolist") else embedding,
+                                             metadata=item.get("metadata",{}),
+                                             input={**inputs,"instruction":text}))
+        return responses
+
+    def emb(self, model, request:LLMRequest ,extract_params:Dict[str,Any]={}):
+        
+        if not model and not self.default_emb_model_name:
+            raise Exception("model name is required")
+        
+        if not model:
+            model = self.default_emb_model_name
+
+        with self.tracer.span("emb",model=model):
+            if self.emb_cache is not None:
+                return self._cached_emb(model,request,extract_params)
+            return self._query_emb(model,request,extract_params)
+
+    def _query_emb(self,model:str,request:LLMRequest,extract_params:Dict[str,Any]={})->List[LLMResponse]:
+        batch = not isinstance(request,LLMRequest) or not isinstance(request.instruction,str)
+        batch = batch and self._support_batch_embedding(model)
+        v = self._build_emb_input_value(model,request,extract_params,batch=batch)
         res = self._query(model,v) 
-      
-        return [LLMResponse(output=item["predict"],metadata=item.get("metadata",{}),input=item["input"]) for item in res]
+        return self._to_emb_responses(res)
+
+    def _lookup_emb_cache(self,model:str,request:LLMRequest,extract_params:Dict[str,Any]={}):
+        '''
+        return (request, keys, results), the results of the missed texts are None
+        '''
+        if isinstance(request,list):
+            request = LLMRequest(instruction=request)
+        v = self._build_emb_input_value(model,request,extract_params)
+        keys = [EmbeddingCache.make_key(model,item) for item in v]
+        results = []
+        for (item,key) in zip(v,keys):
+            value = self.emb_cache.get(key)
+            results.append(None if value is None else LLMResponse(output=value.tolist(),metadata={"cache_hit":True},input=item))
+        return (request,keys,results)
+
+    def _get_missed_emb_request(self,request:LLMRequest,missed:List[int])->LLMRequest:
+        if isinstance(request.instruction,str):
+            return request
+        return dataclasses.replace(request,instruction=[request.instruction[i] for i in missed])
+
+    def _fill_emb_cache(self,keys:List[str],results:List[Optional[LLMResponse]],missed:List[int],res:List[LLMResponse]):
+        if len(res) != len(missed):
+            raise Exception(f"The number of embeddings ({len(res)}) is not equal to the number of texts ({len(missed)})")
+        self.emb_cache.put_many([(keys[i],item.output) for (i,item) in zip(missed,res)])
+        for (i,item) in zip(missed,res):
+            item.metadata = {**item.metadata,"cache_hit":False}
+            results[i] = item
+        return results
+
+    def _cached_emb(self,model:str,request:LLMRequest,extract_params:Dict[str,Any]={})->List[LLMResponse]:
+        (request,keys,results) = self._lookup_emb_cache(model,request,extract_params)
+        missed = [i for (i,result) in enumerate(results) if result is None]
+        if not missed:
+            return results
+        res = self._query_emb(model,self._get_missed_emb_request(request,missed),extract_params)
+        return self._fill_emb_cache(keys,results,missed,res)
+
+    async def async_emb_query(self,v:str,model:str=None):
+        return await self.async_emb(model=model,request=LLMRequest(instruction=v))
+
+    async def async_emb(self, model, request:LLMRequest ,extract_params:Dict[str,Any]={}):
+        
+        if not model and not self.default_emb_model_name:
+            raise Exception("model name is required")
+        
+        if not model:
+            model = self.default_emb_model_name
+
+        with self.tracer.span("emb",model=model):
+            if self.emb_cache is not None:
+                return await self._async_cached_emb(model,request,extract_params)
+            return await self._async_query_emb(model,request,extract_params)
+
+    async def _async_query_emb(self,model:str,request:LLMRequest,extract_params:Dict[str,Any]={})->List[LLMResponse]:
+        batch = not isinstance(request,LLMRequest) or not isinstance(request.instruction,str)
+        batch = batch and await self._async_support_batch_embedding(model)
+        v = self._build_emb_input_value(model,request,extract_params,batch=batch)
+        res = await self._async_query(model,v) 
+        return self._to_emb_responses(res)
+
+    async def _async_cached_emb(self,model:str,request:LLMRequest,extract_params:Dict[str,Any]={})->List[LLMResponse]:
+        (request,keys,results) = self._lookup_emb_cache(model,request,extract_params)
+        missed = [i for (i,result) in enumerate(results) if result is None]
+        if not missed:
+            return results
+        res = await self._async_query_emb(model,self._get_missed_emb_request(request,missed),extract_params)
+        return self._fill_emb_cache(keys,results,missed,res)
 
     def emb_rerank(self, model: str = None, sentence_pairs: Union[List[Tuple[str, str]], Tuple[str, str]] = [],
-                   extract_params: Dict[str, Any] = {}) -> Union[Tuple[Tuple[str, str], float], List[Tuple[Tuple[str, str], float]]]:
+                   extract_params: Dict[str, Any] = {},
+                   query: Optional[str] = None, passages: Optional[List[str]] = None,
+                   top_k: Optional[int] = None, batch_size: int = 32, max_concurrency: int = 4) -> Union[Tuple[Tuple[str, str], float], List[Tuple[Tuple[str, str], float]]]:
+        '''
+        rerank the sentence pairs, or the passages of a query if `query` is set:
+
+        ```python
+        t = llm.emb_rerank(query="what is panda?",passages=passages,top_k=5)
+        [(item.metadata["index"],item.output) for item in t]
+        ```
+        In the query mode the passages are scored in micro batches of `batch_size` which are sent to 
+        the workers concurrently, the scores are cached (see `setup_rerank_cache`), and only the top_k 
+        passages are returned in descending order of the score. Every LLMResponse has the score as output 
+        and the index of the passage in `metadata["index"]`.
+        '''
 
         if not model and not self.default_rerank_model_name:
             raise Exception("rerank model name is required")
 
-        if not sentence_pairs or len(sentence_pairs) == 0:
-            raise Exception("rerank rerank param sentence_pairs is required")
-
         if not model:
             model = self.default_rerank_model_name
 
+        if query is not None:
+            return self._rerank_passages(model,query,passages or [],top_k=top_k,batch_size=batch_size,
+                                         max_concurrency=max_concurrency,extract_params=extract_params)
+
+        if not sentence_pairs or len(sentence_pairs) == 0:
+            raise Exception("rerank rerank param sentence_pairs is required")
+
         default_config = self.mapping_extra_generation_params.get(model, {})
 
         v = [{
@@ -891,6 +1469,51 @@ class ByzerLLM:
         return [LLMResponse(output=item["predict"], metadata=item.get("metadata", {}), input=item["input"]) for item in
                 res]
 
+    def _rerank_passages(self,model:str,query:str,passages:List[str],top_k:Optional[int]=None,
+                         batch_size:int=32,max_concurrency:int=4,
+                         extract_params:Dict[str,Any]={})->List[LLMResponse]:
+        if batch_size <= 0:
+            raise ValueError(f"batch_size should be greater than 0, got {batch_size}")
+        params = {**self.mapping_extra_generation_params.get(model,{}),**extract_params}
+        keys = [RerankScoreCache.make_key(model,query,passage,params) for passage in passages]
+        scores = [None if self.rerank_cache is None else self.rerank_cache.get(key) for key in keys]
+        cache_hits = [score is not None for score in scores]
+
+        # the duplicated passages are only scored once
+        missed = list(dict.fromkeys([passage for (passage,score) in zip(passages,scores) if score is None]))
+        batches = [missed[i:i+batch_size] for i in range(0,len(missed),batch_size)]
+
+        def score_batch(batch:List[str])->Dict[str,float]:
+            v = [{"instruction":[[query,passage] for passage in batch],
+                  "embedding":True,
+                  "embed_rerank":True,
+                  **params}]
+            res = self._query(model,v)
+            return parse_rerank_output(res[0]["predict"])
+
+        if max_concurrency > 1 and len(batches) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrency,len(batches))) as executor:
+                batch_scores = list(executor.map(score_batch,batches))
+        else:
+            batch_scores = [score_batch(batch) for batch in batches]
+
+        missed_scores = {}
+        for item in batch_scores:
+            missed_scores.update(item)
+
+        for i,passage in enumerate(passages):
+            if scores[i] is None:
+                if passage not in missed_scores:
+                    raise Exception(f"The rerank model returns no score for passage {i}")
+                scores[i] = missed_scores[passage]
+                if self.rerank_cache is not None:
+                    self.rerank_cache.put(keys[i],scores[i])
+
+        return [LLMResponse(output=score,
+                            metadata={"index":index,"cache_hit":cache_hits[index]},
+                            input={"query":query,"passage":passages[index]}) for (index,score) in select_top_k(scores,top_k)]
+
     def _generate_ins(self,model:str,request:LLMRequest,role_mapping:Dict[str,str]):
          if not role_mapping["user_role"]:
              return request.instruction
@@ -1064,45 +1687,34 @@ class ByzerLLM:
         if meta.get("backend",None) != "ray/vllm":
             raise Exception("abort only support ray/vllm backend")
         
-        self.chat_oai(conversations=[
-            {
-                "role":"user",
-                "content":f"{request_id}"
-            }
-        ],llm_config={"gen.request_id":request_id,"gen.abort":True})    
-
-    def chat_oai(self,
-                 conversations,
-                 tools:List[Union[Callable,str]]=[], 
-                 tool_choice:Optional[Union[Callable,str]]=None,
-                 execute_tool:bool=False,  
-                 impl_func:Optional[Callable]=None,
-                 execute_impl_func:bool=False,
-                 impl_func_params:Optional[Dict[str,Any]]=None,
-                 func_params:Optional[Dict[str,Any]]=None,
-                 response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
-                 response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
-                 enable_default_sys_message:bool=False,                 
-                 model:Optional[str] = None,
-                 role_mapping=None,llm_config:Dict[str,Any]={}
-                 )->Union[List[LLMResponse],List[LLMFunctionCallResponse],List[LLMClassResponse]]:        
-        
-        if not self.default_model_name and not model:
-            raise Exception("Use llm.setup_default_model_name to setup default model name or setup the model parameter")
-        
-        if not model:
-            model = self.default_model_name
-            
-        if role_mapping is None:
-            role_mapping = self.mapping_role_mapping.get(model, self.default_role_mapping)
-        
-        if response_class and (tools or tool_choice):
-            raise Exception("function calling is enabled,response_class should not be set.")
-        
-        if impl_func and not response_class:
-            raise Exception("impl_func is enabled,response_class should be set.")
-        
-
+        v = [{"instruction":request_id,"history":[],"gen.request_id":request_id,"gen.abort":True}]
+        with self.request_workers_lock:
+            target = self.request_workers.pop(request_id,None)
+        
+        if target is not None:
+            # send the abort to the worker which runs the request directly, 
+            # the other workers do not know the request
+            (worker_model,worker) = target
+            ray.get(worker.async_apply.remote(self._encode_input_value(worker_model,v)))
+            return
+        
+        self._query(model,v)
+
+    def _prepare_chat_oai(self,
+                          model:str,
+                          conversations,
+                          tools:List[Union[Callable,str]]=[], 
+                          tool_choice:Optional[Union[Callable,str]]=None,
+                          impl_func:Optional[Callable]=None,
+                          response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
+                          response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
+                          enable_default_sys_message:bool=False,
+                          role_mapping=None,
+                          session_id:Optional[str]=None):
+        '''
+        render the conversations to the final instruction and history which will be sent to the model.
+        return (temp_conversations,final_ins,history)
+        '''
         if enable_default_sys_message:
             first_message = conversations[0]
             if first_message["role"] == "user":
@@ -1118,7 +1730,9 @@ class ByzerLLM:
         is_saas_model =  meta.get("model_deploy_type",None) == "saas"
         is_message_format = meta.get("message_format",False)
 
-        temp_conversations = copy.deepcopy(conversations)
+        # copy on write: only the last message may be changed, the other messages are shared with `conversations`
+        temp_conversations = list(conversations)
+        temp_conversations[-1] = copy.deepcopy(conversations[-1])
         last_message = temp_conversations[-1]
         
         # function calling
@@ -1144,19 +1758,30 @@ class ByzerLLM:
                 # clean metadata field in conversation 
                 # which may used by agent.
                 if "metadata" in item:
-                    del item["metadata"]
+                    item = {k:v for k,v in item.items() if k != "metadata"}
                 history.append(item)
             
         else:
-            final_ins = self.generate_instruction_from_history(model,temp_conversations, role_mapping)         
+            with self.tracer.span("render_template",model=model):
+                final_ins = self.generate_instruction_from_history(model,temp_conversations, role_mapping,session_id=session_id)         
             history = []
-
-        default_config = self.mapping_extra_generation_params.get(model,{})
-        v = [{"instruction":final_ins,"history":history,**default_config,**llm_config }]         
-        res = self._query(model,v) 
-        clean_func = self.mapping_clean_func.get(model,lambda s: s)        
-        responses = [LLMResponse(output=clean_func(item["predict"]),metadata=item.get("metadata",{}),input=item["input"]) for item in res]        
         
+        return (temp_conversations,final_ins,history)
+
+    def _post_process_chat_oai(self,
+                               model:str,
+                               responses:List[LLMResponse],
+                               temp_conversations,
+                               tools:List[Union[Callable,str]]=[], 
+                               execute_tool:bool=False,  
+                               impl_func:Optional[Callable]=None,
+                               execute_impl_func:bool=False,
+                               impl_func_params:Optional[Dict[str,Any]]=None,
+                               func_params:Optional[Dict[str,Any]]=None,
+                               response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
+                               response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
+                               role_mapping=None,llm_config:Dict[str,Any]={}
+                               )->Union[List[LLMResponse],List[LLMFunctionCallResponse],List[LLMClassResponse]]:
         ## handle impl_func response
         if impl_func and response_class and execute_impl_func:
             final_result = []
@@ -1200,10 +1825,379 @@ class ByzerLLM:
 
             return final_result
         
-        return responses    
+        return responses
+
+    def chat_oai(self,
+                 conversations,
+                 tools:List[Union[Callable,str]]=[], 
+                 tool_choice:Optional[Union[Callable,str]]=None,
+                 execute_tool:bool=False,  
+                 impl_func:Optional[Callable]=None,
+                 execute_impl_func:bool=False,
+                 impl_func_params:Optional[Dict[str,Any]]=None,
+                 func_params:Optional[Dict[str,Any]]=None,
+                 response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
+                 response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
+                 enable_default_sys_message:bool=False,                 
+                 model:Optional[str] = None,
+                 role_mapping=None,llm_config:Dict[str,Any]={}
+                 )->Union[List[LLMResponse],List[LLMFunctionCallResponse],List[LLMClassResponse]]:        
+        
+        if not self.default_model_name and not model:
+            raise Exception("Use llm.setup_default_model_name to setup default model name or setup the model parameter")
+        
+        if not model:
+            model = self.default_model_name
+            
+        if role_mapping is None:
+            role_mapping = self.mapping_role_mapping.get(model, self.default_role_mapping)
+        
+        if response_class and (tools or tool_choice):
+            raise Exception("function calling is enabled,response_class should not be set.")
+        
+        if impl_func and not response_class:
+            raise Exception("impl_func is enabled,response_class should be set.")
+        
+        with self.tracer.span("chat_oai",model=model):
+            with self.tracer.span("prepare",model=model):
+                (temp_conversations,final_ins,history) = self._prepare_chat_oai(model,conversations,
+                                                                                 tools=tools,tool_choice=tool_choice,
+                                                                                 impl_func=impl_func,
+                                                                                 response_class=response_class,
+                                                                                 response_after_chat=response_after_chat,
+                                                                                 enable_default_sys_message=enable_default_sys_message,
+                                                                                 role_mapping=role_mapping,
+                                                                                 session_id=llm_config.get("session_id",None))
+
+            default_config = self.mapping_extra_generation_params.get(model,{})
+            v = [{"instruction":final_ins,"history":history,**default_config,**llm_config }]         
+            res = self._cached_query(model,v,affinity_key=self._get_affinity_key(model,conversations,llm_config)) 
+            clean_func = self.mapping_clean_func.get(model,lambda s: s)        
+            responses = [LLMResponse(output=clean_func(item["predict"]),metadata=item.get("metadata",{}),input=item["input"]) for item in res]        
+        
+            with self.tracer.span("post_process",model=model):
+                return self._post_process_chat_oai(model,responses,temp_conversations,
+                                                   tools=tools,execute_tool=execute_tool,
+                                                   impl_func=impl_func,execute_impl_func=execute_impl_func,
+                                                   impl_func_params=impl_func_params,func_params=func_params,
+                                                   response_class=response_class,response_after_chat=response_after_chat,
+                                                   role_mapping=role_mapping,llm_config=llm_config)
+
+    async def async_chat_oai(self,
+                 conversations,
+                 tools:List[Union[Callable,str]]=[], 
+                 tool_choice:Optional[Union[Callable,str]]=None,
+                 execute_tool:bool=False,  
+                 impl_func:Optional[Callable]=None,
+                 execute_impl_func:bool=False,
+                 impl_func_params:Optional[Dict[str,Any]]=None,
+                 func_params:Optional[Dict[str,Any]]=None,
+                 response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
+                 response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
+                 enable_default_sys_message:bool=False,                 
+                 model:Optional[str] = None,
+                 role_mapping=None,llm_config:Dict[str,Any]={}
+                 )->Union[List[LLMResponse],List[LLMFunctionCallResponse],List[LLMClassResponse]]:
+        '''
+        the async version of `chat_oai`. The remote calls are awaited instead of blocking the event loop.
+        '''
+        if not self.default_model_name and not model:
+            raise Exception("Use llm.setup_default_model_name to setup default model name or setup the model parameter")
+        
+        if not model:
+            model = self.default_model_name
+            
+        if role_mapping is None:
+            role_mapping = self.mapping_role_mapping.get(model, self.default_role_mapping)
+        
+        if response_class and (tools or tool_choice):
+            raise Exception("function calling is enabled,response_class should not be set.")
+        
+        if impl_func and not response_class:
+            raise Exception("impl_func is enabled,response_class should be set.")
+
+        with self.tracer.span("chat_oai",model=model):
+            # warm up the meta cache, so `_prepare_chat_oai` will not block on `get_meta`
+            await self.async_get_meta(model=model)
+        
+            prepare_func = functools.partial(self._prepare_chat_oai,model,conversations,
+                                             tools=tools,tool_choice=tool_choice,
+                                             impl_func=impl_func,
+                                             response_class=response_class,
+                                             response_after_chat=response_after_chat,
+                                             enable_default_sys_message=enable_default_sys_message,
+                                             role_mapping=role_mapping,
+                                             session_id=llm_config.get("session_id",None))
+        
+            # apply chat template is a remote call, run it in a thread
+            with self.tracer.span("prepare",model=model):
+                if self.mapping_auto_use_apply_chat_template.get(model,False):
+                    (temp_conversations,final_ins,history) = await asyncio.to_thread(prepare_func)
+                else:
+                    (temp_conversations,final_ins,history) = prepare_func()
+
+            default_config = self.mapping_extra_generation_params.get(model,{})
+            v = [{"instruction":final_ins,"history":history,**default_config,**llm_config }]         
+            res = await self._async_cached_query(model,v,affinity_key=self._get_affinity_key(model,conversations,llm_config)) 
+            clean_func = self.mapping_clean_func.get(model,lambda s: s)        
+            responses = [LLMResponse(output=clean_func(item["predict"]),metadata=item.get("metadata",{}),input=item["input"]) for item in res]
+
+            post_process_func = functools.partial(self._post_process_chat_oai,model,responses,temp_conversations,
+                                               tools=tools,execute_tool=execute_tool,
+                                               impl_func=impl_func,execute_impl_func=execute_impl_func,
+                                               impl_func_params=impl_func_params,func_params=func_params,
+                                               response_class=response_class,response_after_chat=response_after_chat,
+                                               role_mapping=role_mapping,llm_config=llm_config)
+        
+            # response_after_chat will chat with the model again
+            with self.tracer.span("post_process",model=model):
+                if response_class and response_after_chat:
+                    return await asyncio.to_thread(post_process_func)
+                return post_process_func()
+
+    def batch_chat_oai(self,
+                       conversations_list:List[List[Dict[str,Any]]],
+                       tools:List[Union[Callable,str]]=[], 
+                       tool_choice:Optional[Union[Callable,str]]=None,
+                       execute_tool:bool=False,  
+                       impl_func:Optional[Callable]=None,
+                       execute_impl_func:bool=False,
+                       impl_func_params:Optional[Dict[str,Any]]=None,
+                       func_params:Optional[Dict[str,Any]]=None,
+                       response_class:Optional[Union[pydantic.BaseModel,str]] = None, 
+                       response_after_chat:Optional[Union[pydantic.BaseModel,str]] = False,
+                       enable_default_sys_message:bool=False,                 
+                       model:Optional[str] = None,
+                       role_mapping=None,llm_config:Dict[str,Any]={},
+                       batch_size:Optional[int]=None,
+                       max_concurrency:int=1
+                       )->List[Union[LLMResponse,LLMFunctionCallResponse,LLMClassResponse]]:
+        '''
+        chat with many conversations in batch. The conversations are rendered first, then 
+        sent to the model with as few `_query` calls as possible.
+
+        Args:
+            conversations_list: a list of conversations, every conversation is the same as the parameter `conversations` in `chat_oai`
+            batch_size: the max number of conversations in one `_query` call. None means send all the conversations in one call.
+            max_concurrency: the max number of `_query` calls which can be sent concurrently. 
+                             Set it to the number of the workers of the model to make full use of them.
+            The other parameters are the same as `chat_oai`. If `gen.request_id` is set in llm_config, 
+            the request id of the i-th conversation is `{request_id}-{i}`.
+
+        Returns:
+            the results in the same order of conversations_list, every item is the same as `chat_oai(...)[0]`
+        '''
+        if not self.default_model_name and not model:
+            raise Exception("Use llm.setup_default_model_name to setup default model name or setup the model parameter")
+        
+        if not model:
+            model = self.default_model_name
+            
+        if role_mapping is None:
+            role_mapping = self.mapping_role_mapping.get(model, self.default_role_mapping)
+        
+        if response_class and (tools or tool_choice):
+            raise Exception("function calling is enabled,response_class should not be set.")
+        
+        if impl_func and not response_class:
+            raise Exception("impl_func is enabled,response_class should be set.")
+
+        if not conversations_list:
+            return []
+
+        prepared = [self._prepare_chat_oai(model,conversations,
+                                           tools=tools,tool_choice=tool_choice,
+                                           impl_func=impl_func,
+                                           response_class=response_class,
+                                           response_after_chat=response_after_chat,
+                                           enable_default_sys_message=enable_default_sys_message,
+                                           role_mapping=role_mapping) for conversations in conversations_list]
+        
+        default_config = self.mapping_extra_generation_params.get(model,{})
+        v = [{"instruction":final_ins,"history":history,**default_config,**llm_config } for (_,final_ins,history) in prepared]
+        # the request id should be unique, so every conversation gets its own one derived from the shared llm_config
+        for key in ["gen.request_id","generation.request_id"]:
+            if llm_config.get(key,None):
+                for (i,item) in enumerate(v):
+                    item[key] = f"{llm_config[key]}-{i}"
+
+        if not batch_size or batch_size <= 0:
+            batch_size = len(v)
+        
+        batches = [v[i:i+batch_size] for i in range(0,len(v),batch_size)]
+
+        if max_concurrency > 1 and len(batches) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrency,len(batches))) as executor:
+                batch_results = list(executor.map(lambda batch: self._cached_query(model,batch),batches))
+        else:
+            batch_results = [self._cached_query(model,batch) for batch in batches]
+        
+        res = [item for batch_result in batch_results for item in batch_result]
+        if len(res) != len(v):
+            raise Exception(f"The number of results ({len(res)}) is not equal to the number of conversations ({len(v)})")
+
+        clean_func = self.mapping_clean_func.get(model,lambda s: s)
+        final_result = []
+        for ((temp_conversations,_,_),item) in zip(prepared,res):
+            response = LLMResponse(output=clean_func(item["predict"]),metadata=item.get("metadata",{}),input=item["input"])
+            final_result.append(self._post_process_chat_oai(model,[response],temp_conversations,
+                                           tools=tools,execute_tool=execute_tool,
+                                           impl_func=impl_func,execute_impl_func=execute_impl_func,
+                                           impl_func_params=impl_func_params,func_params=func_params,
+                                           response_class=response_class,response_after_chat=response_after_chat,
+                                           role_mapping=role_mapping,llm_config=llm_config)[0])
+        return final_result
+        
+    def _lookup_response_cache(self,model:str,input_value:List[Dict[str,Any]]):
+        '''
+        return (keys,results), the result is None if the request is not cached.
+        '''
+        keys = [None if item.get("generation.stream",False) else ResponseCache.make_key(model,item) for item in input_value]
+        results = [None if key is None else self.response_cache.get(key) for key in keys]
+        for result in results:
+            if result is not None:
+                result["metadata"] = {**result.get("metadata",{}),"cache_hit":True}
+        return (keys,results)
+
+    def _fill_response_cache(self,keys:List[Optional[str]],results:List[Any],missed:List[int],res:List[Dict[str,Any]]):
+        if len(res) != len(missed):
+            raise Exception(f"The number of results ({len(res)}) is not equal to the number of requests ({len(missed)})")
+        for (i,item) in zip(missed,res):
+            if keys[i] is not None:
+                self.response_cache.put(keys[i],item)
+            item["metadata"] = {**item.get("metadata",{}),"cache_hit":False}
+            results[i] = item
+        return results
+
+    def _cached_query(self,model:str,input_value:List[Dict[str,Any]],affinity_key:Optional[str]=None):
+        '''
+        the same as `_query`, but the requests hit in the response cache will not be sent to the model.
+        '''
+        if self.response_cache is None:
+            return self._query(model,input_value,affinity_key=affinity_key)
+        (keys,results) = self._lookup_response_cache(model,input_value)
+        missed = [i for (i,result) in enumerate(results) if result is None]
+        if not missed:
+            return results
+        res = self._query(model,[input_value[i] for i in missed],affinity_key=affinity_key)
+        return self._fill_response_cache(keys,results,missed,res)
+
+    async def _async_cached_query(self,model:str,input_value:List[Dict[str,Any]],affinity_key:Optional[str]=None):
+        if self.response_cache is None:
+            return await self._async_query(model,input_value,affinity_key=affinity_key)
+        (keys,results) = self._lookup_response_cache(model,input_value)
+        missed = [i for (i,result) in enumerate(results) if result is None]
+        if not missed:
+            return results
+        res = await self._async_query(model,[input_value[i] for i in missed],affinity_key=affinity_key)
+        return self._fill_response_cache(keys,results,missed,res)
+
+    def _get_affinity_key(self,model:str,conversations:List[Dict[str,Any]],llm_config:Dict[str,Any]={})->Optional[str]:
+        if model not in self.mapping_affinity_routing:
+            return None
+        if llm_config.get("session_id",None):
+            return str(llm_config["session_id"])
+        return conversation_affinity_key(conversations,self.mapping_affinity_routing[model]["num_prefix_messages"])
+
+    def _iter_stream_outputs(self,server,request_id:str):
+        '''
+        yield (generated_text,metadata) of the first output of the stream request when it is changed.
         
-    def stream_chat_oai(self,conversations, model:Optional[str]=None, role_mapping=None,llm_config:Dict[str,Any]={}): 
+        Try to fetch only the new text with `get_delta`, and fallback to `get_item` with 
+        `wait_for_change` or polling if the stream server is started by old version.
+        '''
+        mode = "delta"
+        pre_generated_text = None
+        generated_text = ""
+        metadata = None
+        try:
+            while True:
+                try:
+                    if mode == "delta":
+                        final_output = ray.get(server.get_delta.remote(request_id,offsets=[len(generated_text)],
+                                                                       wait_for_change=True,timeout=self.stream_wait_timeout))
+                    elif mode == "wait":
+                        final_output = ray.get(server.get_item.remote(request_id,wait_for_change=True,timeout=self.stream_wait_timeout))
+                    else:
+                        final_output = ray.get(server.get_item.remote(request_id))
+                except Exception as inst:
+                    if mode == "poll":
+                        raise inst
+                    mode = "wait" if mode == "delta" else "poll"
+                    continue
+            
+                if isinstance(final_output,str):
+                    if mode == "poll":
+                        time.sleep(0.01)
+                    continue
+            
+                if final_output is None:
+                    break
+            
+                text_outputs = final_output.outputs
+                if mode == "delta":
+                    generated_text += text_outputs[0].text
+                else:
+                    generated_text = text_outputs[0].text
+            
+                if pre_generated_text is not None and generated_text == pre_generated_text:
+                    continue
+                pre_generated_text = generated_text
+                metadata = text_outputs[0].metadata
+                yield (generated_text,metadata)
+        finally:
+            RATE_LIMITERS.release_stream(request_id,count_stream_tokens(metadata) if metadata is not None else 0)
+
+    async def _async_iter_stream_outputs(self,server,request_id:str):
+        mode = "delta"
+        pre_generated_text = None
+        generated_text = ""
+        metadata = None
+        try:
+            while True:
+                try:
+                    if mode == "delta":
+                        final_output = await server.get_delta.remote(request_id,offsets=[len(generated_text)],
+                                                                     wait_for_change=True,timeout=self.stream_wait_timeout)
+                    elif mode == "wait":
+                        final_output = await server.get_item.remote(request_id,wait_for_change=True,timeout=self.stream_wait_timeout)
+                    else:
+                        final_output = await server.get_item.remote(request_id)
+                except Exception as inst:
+                    if mode == "poll":
+                        raise inst
+                    mode = "wait" if mode == "delta" else "poll"
+                    continue
+            
+                if isinstance(final_output,str):
+                    if mode == "poll":
+                        await asyncio.sleep(0.01)
+                    continue
+            
+                if final_output is None:
+                    break
+            
+                text_outputs = final_output.outputs
+                if mode == "delta":
+                    generated_text += text_outputs[0].text
+                else:
+                    generated_text = text_outputs[0].text
+            
+                if pre_generated_text is not None and generated_text == pre_generated_text:
+                    continue
+                pre_generated_text = generated_text
+                metadata = text_outputs[0].metadata
+                yield (generated_text,metadata)
+        finally:
+            RATE_LIMITERS.release_stream(request_id,count_stream_tokens(metadata) if metadata is not None else 0)
         
+    def stream_chat_oai(self,conversations, model:Optional[str]=None, role_mapping=None,llm_config:Dict[str,Any]={},delta_mode:bool=False): 
+        '''
+        stream chat with the model. 
+        Yield (text,metadata), the text is the full generated text by default, 
+        and only the new generated text if `delta_mode` is True.
+        '''
         if not model:
             model = self.default_model_name
 
@@ -1216,61 +2210,45 @@ class ByzerLLM:
         stream_server = v[0].metadata.get("stream_server","VLLM_STREAM_SERVER")
         server = ray.get_actor(stream_server)                        
 
-        pre_generated_text = None
-        while True:                 
-            final_output = ray.get(server.get_item.remote(request_id))
-            if isinstance(final_output,str):
-                time.sleep(0.01)
-                continue
-            
-            if final_output is None:
-                break
-            
-            text_outputs = final_output.outputs
-            clean_func = self.mapping_clean_func.get(model,lambda s: s)
-            generated_text = text_outputs[0].text
-            if pre_generated_text is not None and generated_text == pre_generated_text:
-                continue
-            pre_generated_text=generated_text
-            yield (clean_func(generated_text),text_outputs[0].metadata)
+        clean_func = self.mapping_clean_func.get(model,lambda s: s)
+        pre_text = ""
+        for (generated_text,metadata) in self._iter_stream_outputs(server,request_id):
+            text = clean_func(generated_text)
+            if delta_mode:
+                yield (text[len(pre_text):],metadata)
+                pre_text = text
+            else:
+                yield (text,metadata)
 
-    async def async_stream_chat_oai(self,conversations,role_mapping=None,model:Optional[str]=None,llm_config:Dict[str,Any]={}): 
+    async def async_stream_chat_oai(self,conversations,role_mapping=None,model:Optional[str]=None,llm_config:Dict[str,Any]={},delta_mode:bool=False): 
         
         if not model:
             model = self.default_model_name
         
-        meta = self.get_meta(model=model)
+        meta = await self.async_get_meta(model=model)
         if not meta.get("support_stream",False):
             raise Exception(f"The model({model}) is not support stream chat for now.")    
 
-        v = self.chat_oai(conversations,model=model,role_mapping=role_mapping,llm_config={**llm_config,**{"generation.stream":True}})       
+        v = await self.async_chat_oai(conversations,model=model,role_mapping=role_mapping,llm_config={**llm_config,**{"generation.stream":True}})       
         request_id = v[0].metadata["request_id"]
         stream_server = v[0].metadata.get("stream_server","VLLM_STREAM_SERVER")
         server = ray.get_actor(stream_server)
 
-        pre_generated_text = None
-        while True:                 
-            final_output = await server.get_item.remote(request_id)
-            if isinstance(final_output,str):
-                time.sleep(0.01)
-                continue
-            
-            if final_output is None:
-                break
-            
-            text_outputs = [output for output in final_output.outputs]
-            clean_func = self.mapping_clean_func.get(model,lambda s: s)
-            generated_text = text_outputs[0].text
-            if pre_generated_text is not None and generated_text == pre_generated_text:
-                continue
-            pre_generated_text=generated_text
-            yield (clean_func(generated_text),text_outputs[0].metadata)   
+        clean_func = self.mapping_clean_func.get(model,lambda s: s)
+        pre_text = ""
+        async for (generated_text,metadata) in self._async_iter_stream_outputs(server,request_id):
+            text = clean_func(generated_text)
+            if delta_mode:
+                yield (text[len(pre_text):],metadata)
+                pre_text = text
+            else:
+                yield (text,metadata)
 
     def clear_impl_cache(self,model:Optional[str]=None,
                          full_func_name:Optional[str]=None,
                          instruction:Optional[str]=None):
         if model is None and full_func_name is None and instruction is None:
-            self.func_impl_cache = {}          
+            self.func_impl_cache.clear()
         
         if model is not None and full_func_name is not None and instruction is None:
             raise Exception("instruction is required")
@@ -1281,18 +2259,14 @@ class ByzerLLM:
             full_func_name = "" if not full_func_name else full_func_name
 
             key = f"{model}_{instruction}_{full_func_name}"
-            for k in list(self.func_impl_cache.keys()):
-                if k.startswith(key):
-                    del self.func_impl_cache[k]
+            self.func_impl_cache.remove(lambda k: k.startswith(key))
             return self        
         
         if full_func_name is not None:            
             instruction = "" if not instruction else instruction
             model = "" if not model else model
             key = f"{model}_{instruction}_{full_func_name}"
-            for k in list(self.func_impl_cache.keys()):                
-                if k.endswith(key):
-                    del self.func_impl_cache[k]
+            self.func_impl_cache.remove(lambda k: k.endswith(key))
             return self        
 
     
@@ -1371,10 +2345,12 @@ class ByzerLLM:
                 else:
                     raise Exception("impl function should return a pydantic model")
                 
-                if not skip_cache and key in self.func_impl_cache:
+                fingerprint = FuncImplCache.make_fingerprint(str(signature),response_class.schema())
+                cached_func = None if skip_cache else self.func_impl_cache.get(key,fingerprint)
+                if cached_func is not None:
                     if verbose:
                         print(f''' {key} in cache, skip impl function''')
-                    return response_class.parse_obj(self.func_impl_cache[key](*args, **kwargs))
+                    return response_class.parse_obj(cached_func(*args, **kwargs))
                 
                 
                 input_dict = {}
@@ -1401,8 +2377,8 @@ class ByzerLLM:
 cost {time.monotonic() - start_time} seconds                     
 ''',flush=True)
 
-                if not skip_cache and key not in self.func_impl_cache:
-                    self.func_impl_cache[key] = r.metadata["func"]
+                if not skip_cache and "func" in r.metadata:
+                    self.func_impl_cache.put(key,fingerprint,func.__name__,r.metadata["raw_func"],r.metadata["func"])
                 
                 return r.value
 
@@ -1515,36 +2491,43 @@ cost {time.monotonic() - start_time} seconds
     def get_max_input_length(self,model:str):
         return self.mapping_max_input_length.get(model,None)        
 
-    def _query(self, model:str, input_value:List[Dict[str,Any]]):  
-        
-        if not self.force_skip_context_length_check:
-            for input in input_value:
-                # if this is a embedding/tokenizer query ,skip            
-                if input.get("embedding",False) or input.get("tokenizer",False):
-                    continue            
-                
-                final_ins = input.get("instruction","")
-                
-                try:
-                    input_size = len(self.tokenize(None,final_ins,{})[0].output[0])
-                except Exception as inst:                
-                    continue
-                
-                if self.get_max_input_length(model) and input_size > self.get_max_input_length(model):
-                    raise Exception(f"input length {input_size} is larger than max_input_length {self.mapping_max_input_length[model]}")                
-                
-                max_output_length = self.get_max_output_length(model)
+    def _get_context_length_check_inputs(self,input_value:List[Dict[str,Any]])->List[Dict[str,Any]]:
+        if self.force_skip_context_length_check:
+            return []
+        # if this is a embedding/tokenizer/meta query ,skip 
+        return [input for input in input_value if not (input.get("embedding",False) or input.get("tokenizer",False) 
+                or input.get("meta",False) or input.get("apply_chat_template",False))]
+    
+    def _check_context_length(self,model:str,check_inputs:List[Dict[str,Any]],input_sizes:List[Optional[int]]):
+        for input,input_size in zip(check_inputs,input_sizes):
+            if input_size is None:
+                continue
+            
+            if self.get_max_input_length(model) and input_size > self.get_max_input_length(model):
+                raise Exception(f"input length {input_size} is larger than max_input_length {self.mapping_max_input_length[model]}")                
+            
+            max_output_length = self.get_max_output_length(model)
 
-                if  self.get_max_model_length(model):                    
-                    if input_size + max_output_length > self.get_max_model_length(model):
-                        raise Exception(f"input_size ({input_size}) + max_output_length {max_output_length} is larget than model context length {self.mapping_max_model_length[model]}")                
-                
-                # dynamically update the max_length
-                input["max_length"] = input_size + max_output_length
+            if  self.get_max_model_length(model):                    
+                if input_size + max_output_length > self.get_max_model_length(model):
+                    raise Exception(f"input_size ({input_size}) + max_output_length {max_output_length} is larget than model context length {self.mapping_max_model_length[model]}")                
+            
+            # dynamically update the max_length
+            input["max_length"] = input_size + max_output_length
 
+    def _encode_input_value(self,model:str,input_value:List[Dict[str,Any]])->List[Union[str,Dict[str,Any]]]:
+        '''
+        send the items as plain python objects if the worker supports the binary protocol, 
+        otherwise as json strings. The meta is only looked up in the cache here, so the `get_meta` 
+        request itself and the workers started by old version always use json.
+        '''
+        if self.enable_binary_protocol:
+            meta = META_CACHE.peek(self._get_namespace(),model)
+            if meta is not None and meta.get("support_binary_protocol",False):
+                if self.verbose:
+                    print(f"Send to model[{model}]:{input_value}")
+                return input_value
 
-        udf_master = ray.get_actor(model)     
-        
         try:   
             new_input_value = [json.dumps(x,ensure_ascii=False) for x in input_value]
         except Exception as inst:
@@ -1552,15 +2535,213 @@ cost {time.monotonic() - start_time} seconds
            
         if self.verbose:
             print(f"Send to model[{model}]:{new_input_value}")
-      
-        try:            
-            [index, worker] = ray.get(udf_master.get.remote())                        
-            res = ray.get(worker.async_apply.remote(new_input_value))                                    
-            return json.loads(res["value"][0])
+        return new_input_value
+
+    def _decode_output_value(self,res:Dict[str,Any])->List[Dict[str,Any]]:
+        value = res["value"][0]
+        if isinstance(value,str):
+            return json.loads(value)
+        return value
+
+    def _query(self, model:str, input_value:List[Dict[str,Any]],affinity_key:Optional[str]=None):  
+        '''
+        send the requests to a worker of the model. If `affinity_key` is set and the affinity routing is 
+        enabled for the model, the requests with the same key prefer the same worker.
+        '''
+        with self.tracer.span("query",model=model,batch_size=len(input_value)):
+            check_inputs = self._get_context_length_check_inputs(input_value)
+            if check_inputs:
+                with self.tracer.span("tokenize_check",model=model):
+                    try:
+                        input_sizes = self._count_tokens(model,[input.get("instruction","") for input in check_inputs])
+                    except Exception as inst:
+                        input_sizes = [None] * len(check_inputs)
+                self._check_context_length(model,check_inputs,input_sizes)
+
+            with self.tracer.span("encode",model=model):
+                new_input_value = self._encode_input_value(model,input_value)
+            
+            affinity = None
+            if affinity_key is not None and model in self.mapping_affinity_routing:
+                affinity = (affinity_key,self.mapping_affinity_routing[model])
+
+            limiter = None if self._is_control_request(input_value) else RATE_LIMITERS.get(model)
+            if limiter is None:
+                return self._dispatch_query(model,new_input_value,affinity,request_ids=self._get_request_ids(input_value))
+            
+            with self.tracer.span("rate_limit_wait",model=model):
+                limiter.acquire()
+            num_tokens = 0
+            held = False
+            try:
+                res = self._dispatch_query(model,new_input_value,affinity,request_ids=self._get_request_ids(input_value))
+                num_tokens = count_result_tokens(res)
+                held = self._hold_stream_requests(limiter,input_value,res,num_tokens)
+                return res
+            finally:
+                if not held:
+                    limiter.release(num_tokens)
+
+    def _hold_stream_requests(self,limiter:RateLimiter,input_value:List[Dict[str,Any]],res:List[Dict[str,Any]],num_tokens:int)->bool:
+        '''
+        the stream requests keep the slot of the limiter until they are consumed by `_iter_stream_outputs`,
+        return False if there is no stream request
+        '''
+        if not any(input.get("generation.stream",False) for input in input_value):
+            return False
+        request_ids = [item["metadata"]["request_id"] for item in res 
+                       if isinstance(item,dict) and isinstance(item.get("metadata",None),dict) and item["metadata"].get("request_id",None)]
+        if not request_ids:
+            return False
+        RATE_LIMITERS.hold_stream(limiter,request_ids,num_tokens)
+        return True
+
+    def _is_control_request(self,input_value:List[Dict[str,Any]])->bool:
+        '''
+        the meta/tokenizer/apply_chat_template/abort requests
+        '''
+        return all(input.get("tokenizer",False) or input.get("meta",False) or input.get("apply_chat_template",False) 
+                   or input.get("gen.abort",False) for input in input_value)
+
+    def _get_request_ids(self,input_value:List[Dict[str,Any]])->List[str]:
+        return [input["gen.request_id"] for input in input_value if input.get("gen.request_id",None) and not input.get("gen.abort",False)]
+
+    def _remember_request_worker(self,model:str,request_ids:List[str],worker:Any):
+        '''
+        remember which worker runs the request, so `abort` can be sent to the same worker
+        '''
+        if not request_ids:
+            return
+        with self.request_workers_lock:
+            for request_id in request_ids:
+                self.request_workers[request_id] = (model,worker)
+                self.request_workers.move_to_end(request_id)
+            while len(self.request_workers) > 1024:
+                self.request_workers.popitem(last=False)
+
+    def _dispatch_query(self,model:str,new_input_value:List[Any],affinity:Optional[Tuple[str,Dict[str,Any]]]=None,request_ids:List[str]=[]):
+        group = self.mapping_model_group.get(model,None)
+        if group is None:
+            return self._apply_on_worker(model,new_input_value,affinity=affinity,request_ids=request_ids)
+        return group.run(lambda replica: self._apply_on_worker(replica,new_input_value,affinity=affinity,request_ids=request_ids))
+
+    def _acquire_affinity_lease(self,namespace:str,model:str,affinity:Tuple[str,Dict[str,Any]]):
+        '''
+        return the pinned lease of the preferred worker which is not busy, or None
+        '''
+        (affinity_key,config) = affinity
+        if not LEASE_MANAGER.supports_pinned(namespace,model):
+            return None
+        try:
+            (num_workers,max_concurrency) = LEASE_MANAGER.get_worker_info(namespace,model)
+            if num_workers <= 1:
+                return None
+            max_active_tasks = config["max_active_tasks"] or max_concurrency
+            for index in AFFINITY_ROUTER.preferred_workers(model,num_workers,affinity_key,limit=config["num_candidates"]):
+                [index,worker] = LEASE_MANAGER.acquire_pinned(namespace,model,index)
+                if ray.get(worker.stat.remote())["active_task"] < max_active_tasks:
+                    return [index,worker]
         except Exception as inst:
-            raise inst
+            if self.verbose:
+                print(f"Fail to route by affinity key for model[{model}]: {inst}",flush=True)
+        return None
+
+    async def _async_acquire_affinity_lease(self,namespace:str,model:str,affinity:Tuple[str,Dict[str,Any]]):
+        (affinity_key,config) = affinity
+        if not LEASE_MANAGER.supports_pinned(namespace,model):
+            return None
+        try:
+            (num_workers,max_concurrency) = await LEASE_MANAGER.async_get_worker_info(namespace,model)
+            if num_workers <= 1:
+                return None
+            max_active_tasks = config["max_active_tasks"] or max_concurrency
+            for index in AFFINITY_ROUTER.preferred_workers(model,num_workers,affinity_key,limit=config["num_candidates"]):
+                [index,worker] = await LEASE_MANAGER.async_acquire_pinned(namespace,model,index)
+                if (await worker.stat.remote())["active_task"] < max_active_tasks:
+                    return [index,worker]
+        except Exception as inst:
+            if self.verbose:
+                print(f"Fail to route by affinity key for model[{model}]: {inst}",flush=True)
+        return None
+
+    def _apply_on_worker(self,model:str,new_input_value:List[Any],affinity:Optional[Tuple[str,Dict[str,Any]]]=None,request_ids:List[str]=[]):
+        namespace = self._get_namespace()
+        with self.tracer.span("lease_wait",model=model):
+            lease = None if affinity is None else self._acquire_affinity_lease(namespace,model,affinity)
+            pinned = lease is not None
+            [index, worker] = lease if pinned else LEASE_MANAGER.acquire(namespace,model)
+        self._remember_request_worker(model,request_ids,worker)
+        success = False
+        try:            
+            with self.tracer.span("worker_execute",model=model):
+                res = ray.get(worker.async_apply.remote(new_input_value))                                    
+            success = True
+            with self.tracer.span("decode",model=model):
+                return self._decode_output_value(res)
+        finally:
+            LEASE_MANAGER.release(namespace,model,index,worker,reusable=success,pinned=pinned)
+
+    async def _async_query(self, model:str, input_value:List[Dict[str,Any]],affinity_key:Optional[str]=None):
+        '''
+        the same as `_query`, but await the ray object refs instead of blocking on `ray.get`,
+        so one event loop can drive many requests concurrently.
+        '''
+        with self.tracer.span("query",model=model,batch_size=len(input_value)):
+            check_inputs = self._get_context_length_check_inputs(input_value)
+            if check_inputs:
+                with self.tracer.span("tokenize_check",model=model):
+                    try:
+                        input_sizes = await self._async_count_tokens(model,[input.get("instruction","") for input in check_inputs])
+                    except Exception as inst:
+                        input_sizes = [None] * len(check_inputs)
+                self._check_context_length(model,check_inputs,input_sizes)
+
+            with self.tracer.span("encode",model=model):
+                new_input_value = self._encode_input_value(model,input_value)
+
+            affinity = None
+            if affinity_key is not None and model in self.mapping_affinity_routing:
+                affinity = (affinity_key,self.mapping_affinity_routing[model])
+
+            limiter = None if self._is_control_request(input_value) else RATE_LIMITERS.get(model)
+            if limiter is None:
+                return await self._async_dispatch_query(model,new_input_value,affinity,request_ids=self._get_request_ids(input_value))
+            
+            with self.tracer.span("rate_limit_wait",model=model):
+                await limiter.async_acquire()
+            num_tokens = 0
+            held = False
+            try:
+                res = await self._async_dispatch_query(model,new_input_value,affinity,request_ids=self._get_request_ids(input_value))
+                num_tokens = count_result_tokens(res)
+                held = self._hold_stream_requests(limiter,input_value,res,num_tokens)
+                return res
+            finally:
+                if not held:
+                    limiter.release(num_tokens)
+
+    async def _async_dispatch_query(self,model:str,new_input_value:List[Any],affinity:Optional[Tuple[str,Dict[str,Any]]]=None,request_ids:List[str]=[]):
+        group = self.mapping_model_group.get(model,None)
+        if group is None:
+            return await self._async_apply_on_worker(model,new_input_value,affinity=affinity,request_ids=request_ids)
+        return await group.async_run(lambda replica: self._async_apply_on_worker(replica,new_input_value,affinity=affinity,request_ids=request_ids))
+
+    async def _async_apply_on_worker(self,model:str,new_input_value:List[Any],affinity:Optional[Tuple[str,Dict[str,Any]]]=None,request_ids:List[str]=[]):
+        namespace = self._get_namespace()
+        with self.tracer.span("lease_wait",model=model):
+            lease = None if affinity is None else await self._async_acquire_affinity_lease(namespace,model,affinity)
+            pinned = lease is not None
+            [index, worker] = lease if pinned else await LEASE_MANAGER.async_acquire(namespace,model)
+        self._remember_request_worker(model,request_ids,worker)
+        success = False
+        try:
+            with self.tracer.span("worker_execute",model=model):
+                res = await worker.async_apply.remote(new_input_value)
+            success = True
+            with self.tracer.span("decode",model=model):
+                return self._decode_output_value(res)
         finally:
-            ray.get(udf_master.give_back.remote(index)) 
+            LEASE_MANAGER.release(namespace,model,index,worker,reusable=success,pinned=pinned)
 
 def default_chat_wrapper(llm:"ByzerLLM",conversations: Optional[List[Dict]] = None,llm_config={}):
     return llm.chat_oai(conversations=conversations,llm_config=llm_config)
@@ -0,0 +1,541 @@
+from typing import Dict,Any,Optional,Tuple,List,Callable
+from collections import OrderedDict
+from byzerllm.utils import generate_str_md5
+import numpy as np
+import threading
+import hashlib
+import contextlib
+import sqlite3
+import json
+import copy
+import time
+import sys
+import os
+
+
+class MetaCache:
+    '''
+    A process-wide cache for the model meta returned by `ByzerLLM.get_meta`.
+    The key is (ray namespace, udf name), so all ByzerLLM instances and threads
+    in the same process share the meta and only the first lookup costs a remote call.
+    '''
+    def __init__(self,ttl:float=600):
+        self.ttl = ttl
+        self.cache:Dict[Tuple[str,str],Tuple[float,Dict[str,Any]]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,namespace:str,udf_name:str)->Optional[Dict[str,Any]]:
+        key = (namespace,udf_name)
+        with self.lock:
+            if key in self.cache:
+                (create_time,value) = self.cache[key]
+                if self.ttl is None or self.ttl <= 0 or time.monotonic() - create_time < self.ttl:
+                    self.hits += 1
+                    return value
+                del self.cache[key]
+            self.misses += 1
+            return None
+
+    def peek(self,namespace:str,udf_name:str)->Optional[Dict[str,Any]]:
+        '''
+        the same as `get`, but not counted in the hits/misses, for the internal lookups of every request
+        '''
+        key = (namespace,udf_name)
+        with self.lock:
+            if key in self.cache:
+                (create_time,value) = self.cache[key]
+                if self.ttl is None or self.ttl <= 0 or time.monotonic() - create_time < self.ttl:
+                    return value
+            return None
+
+    def put(self,namespace:str,udf_name:str,value:Dict[str,Any]):
+        with self.lock:
+            self.cache[(namespace,udf_name)] = (time.monotonic(),value)
+
+    def invalidate(self,namespace:Optional[str]=None,udf_name:Optional[str]=None):
+        '''
+        remove the cached meta. If namespace/udf_name is None, it matches all.
+        '''
+        with self.lock:
+            for (ns,name) in list(self.cache.keys()):
+                if (namespace is None or ns == namespace) and (udf_name is None or name == udf_name):
+                    del self.cache[(ns,name)]
+
+    def set_ttl(self,ttl:float):
+        self.ttl = ttl
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            return {"hits":self.hits,"misses":self.misses,"size":len(self.cache),"ttl":self.ttl}
+
+
+META_CACHE = MetaCache()
+
+
+class TokenizerRegistry:
+    '''
+    A process-wide registry of the tokenizers loaded in the client process. The key is (ray namespace, udf name)
+    like `MetaCache`, so the tokenizer of a model is loaded once per process, not once per ByzerLLM instance.
+    None means the tokenizer can not be loaded locally and the remote tokenizer should be used.
+    '''
+    def __init__(self):
+        self.tokenizers:Dict[Tuple[str,str],Any] = {}
+        self.lock = threading.Lock()
+        self.loading_locks:Dict[Tuple[str,str],threading.Lock] = {}
+
+    def contains(self,namespace:str,udf_name:str)->bool:
+        with self.lock:
+            return (namespace,udf_name) in self.tokenizers
+
+    def put(self,namespace:str,udf_name:str,tokenizer:Any):
+        with self.lock:
+            self.tokenizers[(namespace,udf_name)] = tokenizer
+
+    def get_or_load(self,namespace:str,udf_name:str,loader:Callable[[],Any])->Any:
+        '''
+        return the registered tokenizer, or load it with `loader` once even if many threads ask for it at the same time
+        '''
+        key = (namespace,udf_name)
+        with self.lock:
+            if key in self.tokenizers:
+                return self.tokenizers[key]
+            loading_lock = self.loading_locks.setdefault(key,threading.Lock())
+        with loading_lock:
+            with self.lock:
+                if key in self.tokenizers:
+                    return self.tokenizers[key]
+            tokenizer = loader()
+            with self.lock:
+                self.tokenizers[key] = tokenizer
+                self.loading_locks.pop(key,None)
+            return tokenizer
+
+    def invalidate(self,namespace:Optional[str]=None,udf_name:Optional[str]=None):
+        '''
+        If namespace/udf_name is None, it matches all.
+        '''
+        with self.lock:
+            for key in list(self.tokenizers.keys()):
+                (ns,name) = key
+                if (namespace is None or ns == namespace) and (udf_name is None or name == udf_name):
+                    del self.tokenizers[key]
+
+
+TOKENIZER_REGISTRY = TokenizerRegistry()
+
+
+class ResponseCache:
+    '''
+    An exact-match cache for the chat responses. The key is computed from the model and the 
+    final request (the rendered instruction, history and generation params) sent to the model.
+
+    There are two tiers:
+
+    1. a bounded in-memory LRU.
+    2. an optional sqlite file (`db_path`), which can be shared by processes and survives restarts. 
+       The hits in the disk tier will be promoted to the memory tier.
+
+    `ttl` is in seconds, None or <= 0 means the cached responses never expire.
+    '''
+
+    # the keys which are different for every request and should not be part of the cache key
+    VOLATILE_KEYS = ["gen.request_id","request_id"]
+
+    def __init__(self,max_size:int=1024,ttl:Optional[float]=None,db_path:Optional[str]=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.cache:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path,check_same_thread=False,timeout=30)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT, expire_time REAL)")
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(model:str,request:Dict[str,Any])->str:
+        '''
+        normalize the request and hash it. The scalar generation params are compared as strings, 
+        so `{"temperature":0.1}` and `{"temperature":"0.1"}` share the same key.
+        '''
+        normalized = {"model":model}
+        for k,v in request.items():
+            if k in ResponseCache.VOLATILE_KEYS:
+                continue
+            if k in ["instruction","history"] or isinstance(v,(dict,list)):
+                normalized[k] = v
+            else:
+                normalized[k] = str(v)
+        s = json.dumps(normalized,sort_keys=True,ensure_ascii=False,default=str)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def _expire_time(self)->Optional[float]:
+        if self.ttl is None or self.ttl <= 0:
+            return None
+        # wall clock time, so the expire time in the disk tier is valid across processes
+        return time.time() + self.ttl
+
+    def get(self,key:str)->Optional[Dict[str,Any]]:
+        now = time.time()
+        with self.lock:
+            if key in self.cache:
+                (expire_time,value) = self.cache[key]
+                if expire_time is None or expire_time > now:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                del self.cache[key]
+
+            if self.conn is not None:
+                row = self.conn.execute("SELECT value,expire_time FROM response_cache WHERE key=?",(key,)).fetchone()
+                if row is not None:
+                    (value,expire_time) = row
+                    if expire_time is None or expire_time > now:
+                        value = json.loads(value)
+                        self._put_memory(key,expire_time,value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return copy.deepcopy(value)
+                    self.conn.execute("DELETE FROM response_cache WHERE key=?",(key,))
+                    self.conn.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self,key:str,value:Dict[str,Any]):
+        expire_time = self._expire_time()
+        with self.lock:
+            self._put_memory(key,expire_time,copy.deepcopy(value))
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO response_cache (key,value,expire_time) VALUES (?,?,?)",
+                                  (key,json.dumps(value,ensure_ascii=False,default=str),expire_time))
+                self.conn.commit()
+
+    def _put_memory(self,key:str,expire_time:Optional[float],value:Dict[str,Any]):
+        self.cache[key] = (expire_time,value)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM response_cache")
+                self.conn.commit()
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            return {"hits":self.hits,"disk_hits":self.disk_hits,"misses":self.misses,
+                    "size":len(self.cache),"max_size":self.max_size,"ttl":self.ttl,"db_path":self.db_path}
+
+
+class FuncImplCache:
+    '''
+    The cache for the functions generated by `ByzerLLM.impl`. 
+
+    The compiled functions are kept in memory. If `db_path` is set, the generated source is also 
+    persisted in a sqlite file, so other processes (e.g. Ray workers on the same node) and later runs 
+    can load and compile it lazily instead of asking the model to generate the code again.
+
+    Every entry has a fingerprint computed from the function signature and the response class schema, 
+    the entry is dropped automatically when the fingerprint is changed.
+    '''
+    def __init__(self,db_path:Optional[str]=None):
+        self.db_path = db_path
+        self.cache:Dict[str,Tuple[str,Any]] = {}
+        self.lock = threading.Lock()
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path,check_same_thread=False,timeout=30)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS func_impl_cache (key TEXT PRIMARY KEY, func_name TEXT, source TEXT, fingerprint TEXT, create_time REAL)")
+            self.conn.commit()
+
+    @staticmethod
+    def make_fingerprint(signature:str,response_class_schema:Dict[str,Any])->str:
+        s = json.dumps({"signature":signature,"schema":response_class_schema},sort_keys=True,ensure_ascii=False,default=str)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def get(self,key:str,fingerprint:str)->Optional[Callable]:
+        with self.lock:
+            if key in self.cache:
+                (cached_fingerprint,func) = self.cache[key]
+                if cached_fingerprint == fingerprint:
+                    return func
+                del self.cache[key]
+
+            if self.conn is None:
+                return None
+
+            row = self.conn.execute("SELECT func_name,source,fingerprint FROM func_impl_cache WHERE key=?",(key,)).fetchone()
+            if row is None:
+                return None
+            
+            (func_name,source,cached_fingerprint) = row
+            func = None
+            if cached_fingerprint == fingerprint:
+                try:
+                    variables = {}
+                    exec(source,variables)
+                    func = variables.get(func_name,None)
+                except Exception:
+                    func = None
+
+            if func is None:
+                # stale or broken entry
+                self.conn.execute("DELETE FROM func_impl_cache WHERE key=?",(key,))
+                self.conn.commit()
+                return None
+            
+            self.cache[key] = (fingerprint,func)
+            return func
+
+    def put(self,key:str,fingerprint:str,func_name:str,source:str,func:Callable):
+        with self.lock:
+            self.cache[key] = (fingerprint,func)
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO func_impl_cache (key,func_name,source,fingerprint,create_time) VALUES (?,?,?,?,?)",
+                                  (key,func_name,source,fingerprint,time.time()))
+                self.conn.commit()
+
+    def keys(self)->List[str]:
+        with self.lock:
+            keys = set(self.cache.keys())
+            if self.conn is not None:
+                keys.update([row[0] for row in self.conn.execute("SELECT key FROM func_impl_cache").fetchall()])
+            return list(keys)
+
+    def remove(self,match:Callable[[str],bool]):
+        '''
+        remove the entries whose key matches.
+        '''
+        for key in self.keys():
+            if match(key):
+                with self.lock:
+                    self.cache.pop(key,None)
+                    if self.conn is not None:
+                        self.conn.execute("DELETE FROM func_impl_cache WHERE key=?",(key,))
+                        self.conn.commit()
+
+    def clear(self):
+        self.remove(lambda key: True)
+
+
+class RenderCache:
+    '''
+    A process-wide LRU of the rendered conversations, shared by all ByzerLLM instances. The keys are tuples
+    which start with (ray namespace, udf name), so the entries of a model can be invalidated together.
+
+    1. ("chat_template",namespace,model,md5 of the conversations): the instructions rendered by the remote 
+       chat template of the model, so the same conversations only cost one remote call.
+    2. ("session",namespace,model,session_id): the latest rendered prefix of the session. The lookup is O(1), 
+       the caller checks the prefix is still the head of the new conversations.
+    '''
+    def __init__(self,max_size:int=1024):
+        self.max_size = max_size
+        self.cache:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key:Tuple[str,...])->Any:
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+            return None
+
+    def put(self,key:Tuple[str,...],value:Any):
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self,namespace:Optional[str]=None,udf_name:Optional[str]=None):
+        with self.lock:
+            if namespace is None:
+                self.cache.clear()
+                return
+            for key in [k for k in self.cache if k[1] == namespace and (udf_name is None or k[2] == udf_name)]:
+                del self.cache[key]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            return {"hits":self.hits,"misses":self.misses,"size":len(self.cache),"max_size":self.max_size}
+
+
+RENDER_CACHE = RenderCache()
+
+
+class EmbeddingCache:
+    '''
+    A content-addressed cache for the embeddings. The key is made of the model, the md5 of the text 
+    and the md5 of the other params of the request, so the same text is embedded only once.
+
+    There are two tiers:
+
+    1. a bounded in-memory LRU of float32 arrays.
+    2. an optional directory (`cache_dir`). The vectors are appended to `vectors_<dim>.f32` files and 
+       read with numpy memmap, the row of every key is kept in a sqlite index. The processes on the same 
+       node can share the directory, and the processes opened with `read_only=True` never write to it.
+       The hits in the disk tier will be promoted to the memory tier.
+       On Windows there is no `fcntl`, the writers are not locked across the processes, so do not share 
+       a writable directory between processes there.
+    '''
+
+    def __init__(self,max_size:int=10000,cache_dir:Optional[str]=None,read_only:bool=False):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.read_only = read_only
+        self.cache:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.conn = None
+        self.memmaps:Dict[int,np.memmap] = {}
+        if cache_dir:
+            index_path = os.path.join(cache_dir,"index.sqlite")
+            if read_only:
+                if not os.path.exists(index_path):
+                    raise Exception(f"embedding cache index {index_path} does not exist")
+                self.conn = sqlite3.connect(f"file:{index_path}?mode=ro",uri=True,check_same_thread=False,timeout=30)
+            else:
+                os.makedirs(cache_dir,exist_ok=True)
+                self.conn = sqlite3.connect(index_path,check_same_thread=False,timeout=30)
+                self.conn.execute("CREATE TABLE IF NOT EXISTS emb_cache (key TEXT PRIMARY KEY, dim INTEGER, row INTEGER)")
+                self.conn.commit()
+
+    @staticmethod
+    def make_key(model:str,request:Dict[str,Any])->str:
+        '''
+        `request` is the item sent to the model for one text. 
+        The volatile keys and the instruction are excluded from the params hash.
+        '''
+        params = {k:v if isinstance(v,(dict,list)) else str(v) for k,v in request.items() 
+                  if k != "instruction" and k not in ResponseCache.VOLATILE_KEYS}
+        params_md5 = generate_str_md5(json.dumps(params,sort_keys=True,ensure_ascii=False,default=str))
+        return f"{model}:{generate_str_md5(request.get('instruction',''))}:{params_md5}"
+
+    def _vectors_path(self,dim:int)->str:
+        return os.path.join(self.cache_dir,f"vectors_{dim}.f32")
+
+    def _read_disk(self,dim:int,row:int)->Optional[np.ndarray]:
+        vectors = self.memmaps.get(dim,None)
+        if vectors is None or row >= vectors.shape[0]:
+            # the file is appended by other processes, map it again
+            path = self._vectors_path(dim)
+            num_rows = os.path.getsize(path) // (4 * dim) if os.path.exists(path) else 0
+            if row >= num_rows:
+                return None
+            vectors = np.memmap(path,dtype=np.float32,mode="r",shape=(num_rows,dim))
+            self.memmaps[dim] = vectors
+        return np.array(vectors[row])
+
+    def get(self,key:str)->Optional[np.ndarray]:
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+
+            if self.conn is not None:
+                row = self.conn.execute("SELECT dim,row FROM emb_cache WHERE key=?",(key,)).fetchone()
+                if row is not None:
+                    value = self._read_disk(row[0],row[1])
+                    if value is not None:
+                        self._put_memory(key,value)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+
+            self.misses += 1
+            return None
+
+    def put_many(self,items:List[Tuple[str,Any]]):
+        items = [(key,np.asarray(value,dtype=np.float32).reshape(-1)) for (key,value) in items]
+        with self.lock:
+            for (key,value) in items:
+                self._put_memory(key,value)
+            if self.conn is not None and not self.read_only and items:
+                self._append_disk(items)
+
+    def put(self,key:str,value:Any):
+        self.put_many([(key,value)])
+
+    def _append_disk(self,items:List[Tuple[str,np.ndarray]]):
+        by_dim:Dict[int,List[Tuple[str,np.ndarray]]] = {}
+        for (key,value) in items:
+            by_dim.setdefault(value.shape[0],[]).append((key,value))
+
+        with self._disk_lock():
+            for dim,dim_items in by_dim.items():
+                path = self._vectors_path(dim)
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                start = size // (4 * dim)
+                with open(path,"ab") as f:
+                    # drop the partial row left by a crashed writer
+                    f.truncate(start * 4 * dim)
+                    f.write(np.stack([value for (_,value) in dim_items]).tobytes())
+                self.conn.executemany("INSERT OR REPLACE INTO emb_cache (key,dim,row) VALUES (?,?,?)",
+                                      [(key,dim,start + i) for i,(key,_) in enumerate(dim_items)])
+            self.conn.commit()
+
+    @contextlib.contextmanager
+    def _disk_lock(self):
+        '''
+        the lock file serializes the writers of all the processes sharing the directory
+        '''
+        if sys.platform == "win32":
+            yield
+            return
+        import fcntl
+        with open(os.path.join(self.cache_dir,".lock"),"a") as lock_file:
+            fcntl.flock(lock_file,fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file,fcntl.LOCK_UN)
+
+    def _put_memory(self,key:str,value:np.ndarray):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.memmaps = {}
+            if self.conn is not None and not self.read_only:
+                with self._disk_lock():
+                    dims = [row[0] for row in self.conn.execute("SELECT DISTINCT dim FROM emb_cache").fetchall()]
+                    self.conn.execute("DELETE FROM emb_cache")
+                    self.conn.commit()
+                    for dim in dims:
+                        if os.path.exists(self._vectors_path(dim)):
+                            os.remove(self._vectors_path(dim))
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            disk_size = None
+            if self.conn is not None:
+                disk_size = self.conn.execute("SELECT COUNT(*) FROM emb_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {"hits":self.hits,"disk_hits":self.disk_hits,"misses":self.misses,
+                    "hit_rate":self.hits / total if total > 0 else 0.0,
+                    "size":len(self.cache),"max_size":self.max_size,
+                    "disk_size":disk_size,"cache_dir":self.cache_dir,"read_only":self.read_only}
@@ -164,7 +164,8 @@ async def create_chat_completion(request: ChatCompletionRequest,
         # Send first response for each request.n (index) with the role          
         result_generator = llm.async_stream_chat_oai(model=model_name,
                                            conversations=request.messages,
-                                           llm_config={"gen.request_id":request_id}) 
+                                           llm_config={"gen.request_id":request_id},
+                                           delta_mode=True) 
         role = get_role()     
         for i in range(request.n):
             choice_data = ChatCompletionResponseStreamChoice(
@@ -232,19 +233,15 @@ async def create_chat_completion(request: ChatCompletionRequest,
 
     async def completion_full_generator():
         
-        async def chat():
-            r = llm.chat_oai(model=model_name,
+        result = await llm.async_chat_oai(model=model_name,
                             conversations=request.messages,
                             llm_config={"gen.request_id":request_id}) 
-            for _ in r:
-                yield _
-        
-        result_generator = await asyncio.to_thread(chat) 
         
-        async for res in result_generator:
+        final_res = None
+        for res in result:
             if await raw_request.is_disconnected():
                 # Abort the request if the client disconnects.
-                await llm.abort(request_id,model=model_name)
+                await asyncio.to_thread(llm.abort,request_id,model=model_name)
                 return create_error_response(HTTPStatus.BAD_REQUEST,
                                              "Client disconnected")
             final_res = res
@@ -0,0 +1,282 @@
+from typing import Dict,Any,Optional,Tuple,List,Set
+from collections import deque
+import threading
+import logging
+import time
+import ray
+
+logger = logging.getLogger(__name__)
+
+
+class ModelNotFoundError(ValueError):
+    '''
+    the udf master actor of the model can not be found, e.g. the model is not deployed or undeployed
+    '''
+    pass
+
+
+class PinnedLeaseNotSupportedError(Exception):
+    '''
+    the udf master of the model can not return the worker by index(requires pyjava>=0.6.21),
+    so the affinity routing of the model is disabled
+    '''
+    pass
+
+
+class WorkerLeaseManager:
+    '''
+    Manage the udf master actor handles and the worker leases of the models in the client process.
+
+    Every `_query` needs a worker lease from the udf master(`udf_master.get`) and give it back
+    (`udf_master.give_back`) after the worker applies the request. This manager:
+
+    1. caches the udf master actor handles, so we do not resolve `ray.get_actor(model)` for every request.
+    2. gives back the lease without waiting for the result, which saves one round trip per request.
+    3. when `lease_window` > 0, holds the lease for `lease_window` seconds after the request is finished,
+       so the next request of the same model in this process can reuse it without asking the udf master.
+       The expired leases are given back by a background thread.
+    '''
+    def __init__(self,lease_window:float=0.0):
+        self.lease_window = lease_window
+        self.lock = threading.Lock()
+        self.masters:Dict[Tuple[str,str],Any] = {}
+        self.idle_leases:Dict[Tuple[str,str],deque] = {}
+        # (num_workers, worker_max_concurrency) and the worker handles by index, used by the pinned leases
+        self.worker_infos:Dict[Tuple[str,str],Tuple[int,int]] = {}
+        self.workers:Dict[Tuple[str,str],Dict[int,Any]] = {}
+        # the models whose udf master does not support the pinned leases
+        self.pinned_unsupported:Set[Tuple[str,str]] = set()
+        self.reaper:Optional[threading.Thread] = None
+
+    def set_lease_window(self,lease_window:float):
+        self.lease_window = lease_window
+        if lease_window <= 0:
+            self.release_idle_leases()
+
+    def get_master(self,namespace:str,model:str):
+        key = (namespace,model)
+        with self.lock:
+            if key in self.masters:
+                return self.masters[key]
+        try:
+            master = ray.get_actor(model)
+        except ValueError as inst:
+            raise ModelNotFoundError(f"Model {model} is not found in namespace {namespace}: {inst}") from inst
+        with self.lock:
+            self.masters[key] = master
+        return master
+
+    def invalidate(self,namespace:Optional[str]=None,model:Optional[str]=None):
+        '''
+        drop the cached udf master handles and give back the idle leases of the model.
+        If namespace/model is None, it matches all.
+        '''
+        expired = []
+        with self.lock:
+            for key in list(self.masters.keys()):
+                (ns,name) = key
+                if (namespace is None or ns == namespace) and (model is None or name == model):
+                    master = self.masters.pop(key)
+                    self.worker_infos.pop(key,None)
+                    self.workers.pop(key,None)
+                    self.pinned_unsupported.discard(key)
+                    for (_,index,_) in self.idle_leases.pop(key,[]):
+                        expired.append((master,index))
+        self._give_back_all(expired)
+
+    def acquire(self,namespace:str,model:str)->Tuple[int,Any]:
+        lease = self._pop_idle_lease(namespace,model)
+        if lease is not None:
+            return lease
+        try:
+            return ray.get(self.get_master(namespace,model).get.remote())
+        except ray.exceptions.RayActorError:
+            # the model may be redeployed, try again with a fresh actor handle
+            self.invalidate(namespace,model)
+            return ray.get(self.get_master(namespace,model).get.remote())
+
+    async def async_acquire(self,namespace:str,model:str)->Tuple[int,Any]:
+        lease = self._pop_idle_lease(namespace,model)
+        if lease is not None:
+            return lease
+        try:
+            return await self.get_master(namespace,model).get.remote()
+        except ray.exceptions.RayActorError:
+            self.invalidate(namespace,model)
+            return await self.get_master(namespace,model).get.remote()
+
+    def get_worker_info(self,namespace:str,model:str)->Tuple[int,int]:
+        '''
+        return (num_workers, worker_max_concurrency) of the model
+        '''
+        key = (namespace,model)
+        with self.lock:
+            if key in self.worker_infos:
+                return self.worker_infos[key]
+        self._check_pinned_supported(key)
+        master = self.get_master(namespace,model)
+        try:
+            info = (ray.get(master.stat.remote())["total_workers"],ray.get(master.get_worker_max_concurrency.remote()))
+        except AttributeError as inst:
+            self._disable_pinned(key,inst)
+        with self.lock:
+            self.worker_infos[key] = info
+        return info
+
+    async def async_get_worker_info(self,namespace:str,model:str)->Tuple[int,int]:
+        key = (namespace,model)
+        with self.lock:
+            if key in self.worker_infos:
+                return self.worker_infos[key]
+        self._check_pinned_supported(key)
+        master = self.get_master(namespace,model)
+        try:
+            info = ((await master.stat.remote())["total_workers"],await master.get_worker_max_concurrency.remote())
+        except AttributeError as inst:
+            self._disable_pinned(key,inst)
+        with self.lock:
+            self.worker_infos[key] = info
+        return info
+
+    def acquire_pinned(self,namespace:str,model:str,index:int)->Tuple[int,Any]:
+        '''
+        get the worker by index without taking a concurrency slot from the udf master, 
+        so the pinned lease should be released with `pinned=True`. 
+        The caller should check the worker is not busy by itself.
+        '''
+        key = (namespace,model)
+        with self.lock:
+            worker = self.workers.get(key,{}).get(index,None)
+        if worker is None:
+            self._check_pinned_supported(key)
+            try:
+                [index,worker] = ray.get(self.get_master(namespace,model).get.remote(index))
+            except TypeError as inst:
+                # `get()` of the old udf master takes no index
+                self._disable_pinned(key,inst)
+            with self.lock:
+                self.workers.setdefault(key,{})[index] = worker
+        return [index,worker]
+
+    async def async_acquire_pinned(self,namespace:str,model:str,index:int)->Tuple[int,Any]:
+        key = (namespace,model)
+        with self.lock:
+            worker = self.workers.get(key,{}).get(index,None)
+        if worker is None:
+            self._check_pinned_supported(key)
+            try:
+                [index,worker] = await self.get_master(namespace,model).get.remote(index)
+            except TypeError as inst:
+                self._disable_pinned(key,inst)
+            with self.lock:
+                self.workers.setdefault(key,{})[index] = worker
+        return [index,worker]
+
+    def supports_pinned(self,namespace:str,model:str)->bool:
+        with self.lock:
+            return (namespace,model) not in self.pinned_unsupported
+
+    def _check_pinned_supported(self,key:Tuple[str,str]):
+        with self.lock:
+            if key in self.pinned_unsupported:
+                raise PinnedLeaseNotSupportedError(f"The udf master of model {key[1]} does not support the pinned leases")
+
+    def _disable_pinned(self,key:Tuple[str,str],inst:Exception):
+        with self.lock:
+            first = key not in self.pinned_unsupported
+            self.pinned_unsupported.add(key)
+        if first:
+            logger.warning(f"The udf master of model {key[1]} does not support the pinned leases "
+                           f"(requires pyjava>=0.6.21), the affinity routing of the model is disabled: {inst}")
+        raise PinnedLeaseNotSupportedError(f"The udf master of model {key[1]} does not support the pinned leases") from inst
+
+    def release(self,namespace:str,model:str,index:int,worker:Any,reusable:bool=True,pinned:bool=False):
+        '''
+        release the lease. If `reusable` is False (e.g. the request is failed),
+        the lease will be given back to the udf master directly.
+        The pinned lease do not hold a slot of the udf master, so there is nothing to give back.
+        '''
+        if pinned:
+            return
+        key = (namespace,model)
+        if self.lease_window > 0 and reusable:
+            with self.lock:
+                if key in self.masters:
+                    self.idle_leases.setdefault(key,deque()).append((time.monotonic() + self.lease_window,index,worker))
+                    self._start_reaper()
+                    return
+        self._give_back(namespace,model,index)
+
+    def release_idle_leases(self):
+        expired = []
+        with self.lock:
+            for key,leases in self.idle_leases.items():
+                master = self.masters.get(key,None)
+                while leases:
+                    (_,index,_) = leases.popleft()
+                    if master is not None:
+                        expired.append((master,index))
+        self._give_back_all(expired)
+
+    def _pop_idle_lease(self,namespace:str,model:str)->Optional[Tuple[int,Any]]:
+        key = (namespace,model)
+        now = time.monotonic()
+        expired = []
+        lease = None
+        with self.lock:
+            leases = self.idle_leases.get(key,None)
+            master = self.masters.get(key,None)
+            while leases:
+                (expire_time,index,worker) = leases.pop()
+                if expire_time > now:
+                    lease = [index,worker]
+                    break
+                expired.append((master,index))
+        self._give_back_all(expired)
+        return lease
+
+    def _give_back(self,namespace:str,model:str,index:int):
+        master = self.get_master(namespace,model)
+        # do not wait for the result, the udf master will process it in order
+        master.give_back.remote(index)
+
+    def _give_back_all(self,items:List[Tuple[Any,int]]):
+        for (master,index) in items:
+            if master is None:
+                continue
+            try:
+                master.give_back.remote(index)
+            except Exception:
+                pass
+
+    def _start_reaper(self):
+        if self.reaper is not None and self.reaper.is_alive():
+            return
+        self.reaper = threading.Thread(target=self._reap,daemon=True)
+        self.reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.lease_window,0.1))
+            now = time.monotonic()
+            expired = []
+            with self.lock:
+                for key,leases in self.idle_leases.items():
+                    master = self.masters.get(key,None)
+                    remain = deque()
+                    while leases:
+                        item = leases.popleft()
+                        if item[0] > now:
+                            remain.append(item)
+                        else:
+                            expired.append((master,item[1]))
+                    self.idle_leases[key] = remain
+                has_leases = any(len(leases) > 0 for leases in self.idle_leases.values())
+                if not has_leases:
+                    self.reaper = None
+            self._give_back_all(expired)
+            if not has_leases:
+                return
+
+
+LEASE_MANAGER = WorkerLeaseManager()
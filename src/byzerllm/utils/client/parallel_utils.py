@@ -1,4 +1,10 @@
+from typing import Any,Callable,Dict,List,Optional
 import concurrent.futures
+import threading
+import asyncio
+import copy
+import uuid
+import time
 
 def chat_oai(llm,workers: int=3, **kwargs):
     """
@@ -31,4 +37,304 @@ def get_single_result(ts):
             if t[0].value:
                 return t        
     
-    return None
\ No newline at end of file
+    return None
+
+
+def _backoff_seconds(retry_backoff:float,attempt:int)->float:
+    return retry_backoff * (2 ** attempt)
+
+
+def map_chat_oai(llm,
+                 conversations_list:List[List[Dict[str,Any]]],
+                 max_concurrency:int=4,
+                 progress_callback:Optional[Callable[[int,int,int,Any],None]]=None,
+                 max_retries:int=0,
+                 retry_backoff:float=1.0,
+                 return_exceptions:bool=False,
+                 **kwargs)->List[Any]:
+    """
+    Invoke llm.chat_oai for every conversation in conversations_list with at most 
+    max_concurrency threads, and return the results in the same order of conversations_list.
+
+    progress_callback(done, total, index, result) is called when a conversation is finished, 
+    the result is the exception if it failed.
+    A failed request is retried max_retries times, waiting retry_backoff * 2^attempt seconds.
+    If return_exceptions is True, the exception is put in the results instead of being raised.
+    On KeyboardInterrupt, the pending requests are cancelled and the interrupt is raised again.
+    The other kwargs are passed to llm.chat_oai.
+    """
+    total = len(conversations_list)
+    results = [None] * total
+    if total == 0:
+        return results
+
+    cancelled = threading.Event()
+    lock = threading.Lock()
+    done = [0]
+
+    def run(index:int):
+        attempt = 0
+        while True:
+            if cancelled.is_set():
+                raise concurrent.futures.CancelledError()
+            try:
+                return llm.chat_oai(conversations=conversations_list[index],**kwargs)
+            except Exception as inst:
+                if attempt >= max_retries:
+                    raise inst
+                # wait for backoff, but stop as soon as the job is cancelled
+                if cancelled.wait(_backoff_seconds(retry_backoff,attempt)):
+                    raise concurrent.futures.CancelledError()
+                attempt += 1
+
+    def on_done(index:int,value:Any):
+        results[index] = value
+        with lock:
+            done[0] += 1
+            finished = done[0]
+        if progress_callback is not None:
+            progress_callback(finished,total,index,value)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,min(max_concurrency,total)))
+    futures = {executor.submit(run,index):index for index in range(total)}
+    try:
+        pending = set(futures.keys())
+        while pending:
+            # wait with timeout so KeyboardInterrupt can be received by the main thread
+            finished,pending = concurrent.futures.wait(pending,timeout=0.5,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                index = futures[future]
+                try:
+                    on_done(index,future.result())
+                except Exception as inst:
+                    if not return_exceptions:
+                        raise inst
+                    on_done(index,inst)
+    except BaseException:
+        cancelled.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+
+    executor.shutdown(wait=True)
+    return results
+
+
+async def async_map_chat_oai(llm,
+                             conversations_list:List[List[Dict[str,Any]]],
+                             max_concurrency:int=4,
+                             progress_callback:Optional[Callable[[int,int,int,Any],None]]=None,
+                             max_retries:int=0,
+                             retry_backoff:float=1.0,
+                             return_exceptions:bool=False,
+                             **kwargs)->List[Any]:
+    """
+    The async version of map_chat_oai which uses llm.async_chat_oai. 
+    When it's cancelled or one request fails (and return_exceptions is False), 
+    the other requests are cancelled.
+    """
+    total = len(conversations_list)
+    results = [None] * total
+    if total == 0:
+        return results
+
+    semaphore = asyncio.Semaphore(max(1,max_concurrency))
+    done = [0]
+
+    async def run(index:int):
+        async with semaphore:
+            attempt = 0
+            while True:
+                try:
+                    value = await llm.async_chat_oai(conversations=conversations_list[index],**kwargs)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as inst:
+                    if attempt >= max_retries:
+                        if not return_exceptions:
+                            raise inst
+                        value = inst
+                        break
+                    await asyncio.sleep(_backoff_seconds(retry_backoff,attempt))
+                    attempt += 1
+        results[index] = value
+        done[0] += 1
+        if progress_callback is not None:
+            progress_callback(done[0],total,index,value)
+
+    tasks = [asyncio.ensure_future(run(index)) for index in range(total)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+        raise
+    return results
+
+
+def _is_valid_result(t)->bool:
+    """
+    the same check as get_single_result
+    """
+    if not t:
+        return False
+    if hasattr(t[0],"values"):
+        return bool(t[0].values)
+    if hasattr(t[0],"value"):
+        return bool(t[0].value)
+    return bool(t[0].output)
+
+
+def _get_hedge_delay(llm,model:str,hedge_delay:Optional[float],default_hedge_delay:float)->float:
+    """
+    use the p95 latency of chat_oai of the model if the tracing of llm is enabled
+    """
+    if hedge_delay is not None:
+        return hedge_delay
+    histogram = getattr(llm,"latency_histogram",None)
+    if histogram is not None:
+        delay = histogram.percentile(model,"chat_oai",95)
+        if delay > 0:
+            return delay
+    return default_hedge_delay
+
+
+def _abort_quietly(llm,request_id:str,model:str):
+    try:
+        llm.abort(request_id,model=model)
+    except Exception:
+        pass
+
+
+def hedged_chat_oai(llm,
+                    conversations:List[Dict[str,Any]],
+                    hedge_delay:Optional[float]=None,
+                    max_hedges:int=1,
+                    default_hedge_delay:float=1.0,
+                    model:Optional[str]=None,
+                    llm_config:Dict[str,Any]={},
+                    **kwargs):
+    """
+    Invoke llm.chat_oai with hedged requests: if the request is not finished in hedge_delay seconds 
+    (or it fails/returns empty result), start another one, up to max_hedges extra requests. 
+    The first non-empty result wins and the other running requests are aborted by llm.abort.
+
+    hedge_delay: None means the p95 latency of chat_oai of the model when llm.setup_tracing is enabled, 
+    otherwise default_hedge_delay.
+    """
+    if not model:
+        model = llm.default_model_name
+    delay = _get_hedge_delay(llm,model,hedge_delay,default_hedge_delay)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_hedges + 1)
+    request_ids = {}
+
+    def submit():
+        request_id = str(uuid.uuid4())
+        future = executor.submit(llm.chat_oai,conversations=copy.deepcopy(conversations),model=model,
+                                 llm_config={**llm_config,"gen.request_id":request_id},**kwargs)
+        request_ids[future] = request_id
+        return future
+
+    winner = None
+    last_result = None
+    last_error = None
+    pending = {submit()}
+    try:
+        while pending:
+            can_hedge = len(request_ids) <= max_hedges
+            done,pending = concurrent.futures.wait(pending,timeout=delay if can_hedge else None,
+                                                   return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                pending.add(submit())
+                continue
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as inst:
+                    last_error = inst
+                    continue
+                last_result = result
+                if _is_valid_result(result):
+                    winner = future
+                    break
+            if winner is not None:
+                break
+            if not pending and can_hedge:
+                pending.add(submit())
+    finally:
+        for future,request_id in request_ids.items():
+            if future is not winner and not future.done():
+                future.cancel()
+                _abort_quietly(llm,request_id,model)
+        executor.shutdown(wait=False)
+
+    if winner is not None:
+        return winner.result()
+    if last_result is not None:
+        return last_result
+    raise last_error
+
+
+async def async_hedged_chat_oai(llm,
+                                conversations:List[Dict[str,Any]],
+                                hedge_delay:Optional[float]=None,
+                                max_hedges:int=1,
+                                default_hedge_delay:float=1.0,
+                                model:Optional[str]=None,
+                                llm_config:Dict[str,Any]={},
+                                **kwargs):
+    """
+    The async version of hedged_chat_oai which uses llm.async_chat_oai.
+    """
+    if not model:
+        model = llm.default_model_name
+    delay = _get_hedge_delay(llm,model,hedge_delay,default_hedge_delay)
+
+    request_ids = {}
+
+    def submit():
+        request_id = str(uuid.uuid4())
+        task = asyncio.ensure_future(llm.async_chat_oai(conversations=copy.deepcopy(conversations),model=model,
+                                                        llm_config={**llm_config,"gen.request_id":request_id},**kwargs))
+        request_ids[task] = request_id
+        return task
+
+    winner = None
+    last_result = None
+    last_error = None
+    pending = {submit()}
+    try:
+        while pending:
+            can_hedge = len(request_ids) <= max_hedges
+            done,pending = await asyncio.wait(pending,timeout=delay if can_hedge else None,
+                                              return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                pending.add(submit())
+                continue
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                last_result = task.result()
+                if _is_valid_result(last_result):
+                    winner = task
+                    break
+            if winner is not None:
+                break
+            if not pending and can_hedge:
+                pending.add(submit())
+    finally:
+        for task,request_id in request_ids.items():
+            if task is not winner and not task.done():
+                task.cancel()
+                await asyncio.to_thread(_abort_quietly,llm,request_id,model)
+
+    if winner is not None:
+        return winner.result()
+    if last_result is not None:
+        return last_result
+    raise last_error
@@ -0,0 +1,247 @@
+from typing import Dict,Any,Optional,List
+from collections import deque
+import itertools
+import threading
+import asyncio
+import time
+
+
+class RateLimitTimeoutError(Exception):
+    pass
+
+
+class RateLimiter:
+    '''
+    Limit the requests of a model in this process by:
+
+    1. max_concurrency: the max number of running requests
+    2. requests_per_second: a token bucket of requests
+    3. tokens_per_minute: a token bucket of the prompt and generated tokens. The tokens are only known
+       after the response, so the bucket may go below zero and the next requests wait until it is refilled.
+
+    The waiting requests from threads and coroutines are admitted in FIFO order.
+    If a request can not be admitted in `queue_timeout` seconds, `RateLimitTimeoutError` is raised.
+    '''
+    def __init__(self,model:str,
+                 max_concurrency:Optional[int]=None,
+                 tokens_per_minute:Optional[int]=None,
+                 requests_per_second:Optional[float]=None,
+                 queue_timeout:float=60):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_second = requests_per_second
+        self.queue_timeout = queue_timeout
+
+        self.cond = threading.Condition()
+        self.tickets = itertools.count()
+        self.queue:deque = deque()
+        self.running = 0
+
+        now = time.monotonic()
+        self.request_capacity = max(1.0,requests_per_second) if requests_per_second else 0
+        self.request_tokens = self.request_capacity
+        self.request_update_time = now
+        self.token_tokens = float(tokens_per_minute) if tokens_per_minute else 0
+        self.token_update_time = now
+
+    def _refill(self,now:float):
+        if self.requests_per_second:
+            self.request_tokens = min(self.request_capacity,
+                                      self.request_tokens + (now - self.request_update_time) * self.requests_per_second)
+            self.request_update_time = now
+        if self.tokens_per_minute:
+            self.token_tokens = min(float(self.tokens_per_minute),
+                                    self.token_tokens + (now - self.token_update_time) * self.tokens_per_minute / 60)
+            self.token_update_time = now
+
+    def _try_acquire(self,ticket:int)->float:
+        '''
+        should be called with the lock. Return 0 if the request is admitted,
+        otherwise the seconds to wait before trying again.
+        '''
+        if self.queue[0] != ticket:
+            return 0.1
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0
+        if self.max_concurrency and self.running >= self.max_concurrency:
+            # woken up by `release`
+            wait = 0.1
+        if self.requests_per_second and self.request_tokens < 1:
+            wait = max(wait,(1 - self.request_tokens) / self.requests_per_second)
+        if self.tokens_per_minute and self.token_tokens <= 0:
+            wait = max(wait,(1 - self.token_tokens) * 60 / self.tokens_per_minute)
+        if wait > 0:
+            return wait
+
+        self.queue.popleft()
+        self.running += 1
+        if self.requests_per_second:
+            self.request_tokens -= 1
+        self.cond.notify_all()
+        return 0
+
+    def _timeout_error(self,start:float)->RateLimitTimeoutError:
+        return RateLimitTimeoutError(f"The request of model({self.model}) waited {time.monotonic() - start:.2f}s "
+                                     f"in the rate limit queue and exceeded queue_timeout({self.queue_timeout}s). "
+                                     f"running:{self.running} waiting:{len(self.queue)}")
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            ticket = next(self.tickets)
+            self.queue.append(ticket)
+            try:
+                while True:
+                    wait = self._try_acquire(ticket)
+                    if wait == 0:
+                        return
+                    remain = start + self.queue_timeout - time.monotonic()
+                    if remain <= 0:
+                        raise self._timeout_error(start)
+                    self.cond.wait(min(wait,remain))
+            except BaseException:
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+                    self.cond.notify_all()
+                raise
+
+    async def async_acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            ticket = next(self.tickets)
+            self.queue.append(ticket)
+        try:
+            while True:
+                with self.cond:
+                    wait = self._try_acquire(ticket)
+                if wait == 0:
+                    return
+                remain = start + self.queue_timeout - time.monotonic()
+                if remain <= 0:
+                    raise self._timeout_error(start)
+                # the coroutine can not be notified by the condition, so poll with a short interval
+                await asyncio.sleep(min(wait,remain,0.01))
+        except BaseException:
+            with self.cond:
+                if ticket in self.queue:
+                    self.queue.remove(ticket)
+                    self.cond.notify_all()
+            raise
+
+    def release(self,num_tokens:int=0):
+        '''
+        release the running request and account the prompt and generated tokens of it
+        '''
+        with self.cond:
+            self.running = max(0,self.running - 1)
+            if self.tokens_per_minute and num_tokens > 0:
+                self._refill(time.monotonic())
+                self.token_tokens -= num_tokens
+            self.cond.notify_all()
+
+    def stats(self)->Dict[str,Any]:
+        with self.cond:
+            self._refill(time.monotonic())
+            return {
+                "model":self.model,
+                "running":self.running,
+                "waiting":len(self.queue),
+                "max_concurrency":self.max_concurrency,
+                "requests_per_second":self.requests_per_second,
+                "tokens_per_minute":self.tokens_per_minute,
+                "available_requests":self.request_tokens if self.requests_per_second else None,
+                "available_tokens":self.token_tokens if self.tokens_per_minute else None
+            }
+
+
+def count_result_tokens(results:List[Dict[str,Any]])->int:
+    '''
+    the sum of the prompt and generated tokens in the metadata of the results
+    '''
+    total = 0
+    for item in results:
+        metadata = item.get("metadata",{}) if isinstance(item,dict) else {}
+        if not isinstance(metadata,dict):
+            continue
+        for key in ["input_tokens_count","generated_tokens_count"]:
+            v = metadata.get(key,0)
+            if isinstance(v,(int,float)) and v > 0:
+                total += int(v)
+    return total
+
+
+def count_stream_tokens(metadata:Any)->int:
+    '''
+    the prompt and generated tokens in the metadata(`SingleOutputMeta`) of the last stream output
+    '''
+    if not isinstance(metadata,dict):
+        metadata = {key:getattr(metadata,key,0) for key in ["input_tokens_count","generated_tokens_count"]}
+    return count_result_tokens([{"metadata":metadata}])
+
+
+class RateLimiterRegistry:
+    '''
+    The rate limiters of the models, shared by all ByzerLLM instances in the process.
+
+    A stream request returns before the text is generated, so its slot is held by `hold_stream` 
+    until the stream is consumed and `release_stream` charges the tokens of it. The holds which are not 
+    released in `stream_hold_timeout` seconds (e.g. the stream is never read) are released without tokens.
+    '''
+    def __init__(self,stream_hold_timeout:float=600):
+        self.limiters:Dict[str,RateLimiter] = {}
+        self.lock = threading.Lock()
+        self.stream_hold_timeout = stream_hold_timeout
+        # request_id -> the hold shared by the stream requests of one query
+        self.stream_holds:Dict[str,Dict[str,Any]] = {}
+
+    def get(self,model:str)->Optional[RateLimiter]:
+        if self.stream_holds:
+            self.release_expired_streams()
+        return self.limiters.get(model,None)
+
+    def hold_stream(self,limiter:RateLimiter,request_ids:List[str],num_tokens:int=0):
+        hold = {"limiter":limiter,"request_ids":set(request_ids),"num_tokens":num_tokens,
+                "expire_time":time.monotonic() + self.stream_hold_timeout}
+        with self.lock:
+            for request_id in request_ids:
+                self.stream_holds[request_id] = hold
+
+    def release_stream(self,request_id:str,num_tokens:int=0):
+        '''
+        the stream is finished, the slot is released when all the streams of the query are finished
+        '''
+        with self.lock:
+            hold = self.stream_holds.pop(request_id,None)
+            if hold is None:
+                return
+            hold["request_ids"].discard(request_id)
+            hold["num_tokens"] += num_tokens
+            if hold["request_ids"]:
+                return
+        hold["limiter"].release(hold["num_tokens"])
+
+    def release_expired_streams(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for (request_id,hold) in list(self.stream_holds.items()):
+                if hold["expire_time"] > now:
+                    continue
+                del self.stream_holds[request_id]
+                hold["request_ids"].discard(request_id)
+                if not hold["request_ids"]:
+                    expired.append(hold)
+        for hold in expired:
+            hold["limiter"].release(hold["num_tokens"])
+
+    def set(self,model:str,limiter:Optional[RateLimiter]):
+        with self.lock:
+            if limiter is None:
+                self.limiters.pop(model,None)
+            else:
+                self.limiters[model] = limiter
+
+
+RATE_LIMITERS = RateLimiterRegistry()
@@ -0,0 +1,72 @@
+from typing import Dict,Any,Optional,List,Tuple
+from collections import OrderedDict
+from byzerllm.utils import generate_str_md5
+import threading
+import heapq
+import json
+
+
+class RerankScoreCache:
+    '''
+    An in-memory LRU of the rerank scores. The key is made of the model, the md5 of the query,
+    the md5 of the passage and the md5 of the other params, so the identical (query, passage) pairs
+    are only scored once.
+    '''
+    def __init__(self,max_size:int=100000):
+        self.max_size = max_size
+        self.cache:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model:str,query:str,passage:str,params:Dict[str,Any]={})->str:
+        params_md5 = generate_str_md5(json.dumps({k:str(v) for k,v in params.items()},sort_keys=True,ensure_ascii=False))
+        return f"{model}:{generate_str_md5(query)}:{generate_str_md5(passage)}:{params_md5}"
+
+    def get(self,key:str)->Optional[float]:
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+            return None
+
+    def put(self,key:str,score:float):
+        with self.lock:
+            self.cache[key] = score
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self)->Dict[str,Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits":self.hits,"misses":self.misses,
+                    "hit_rate":self.hits / total if total > 0 else 0.0,
+                    "size":len(self.cache),"max_size":self.max_size}
+
+
+def parse_rerank_output(output:Any)->Dict[str,float]:
+    '''
+    the rerank model returns `(pair, score)` for one pair, or a list of `(pair, score)` sorted by score.
+    return the scores by passage.
+    '''
+    if len(output) == 2 and isinstance(output[1],(int,float)):
+        pairs = [output[0]] if isinstance(output[0][0],str) else output[0]
+        return {pair[1]:float(output[1]) for pair in pairs}
+    return {pair[1]:float(score) for (pair,score) in output}
+
+
+def select_top_k(scores:List[float],top_k:Optional[int]=None)->List[Tuple[int,float]]:
+    '''
+    return (index, score) of the top_k scores in descending order. None means all.
+    '''
+    if top_k is None or top_k >= len(scores):
+        return sorted(enumerate(scores),key=lambda x: x[1],reverse=True)
+    return heapq.nlargest(top_k,enumerate(scores),key=lambda x: x[1])
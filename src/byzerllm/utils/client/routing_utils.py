@@ -0,0 +1,219 @@
+from typing import Dict,Any,Optional,List,Callable,Set,Tuple
+import threading
+import hashlib
+import bisect
+import json
+import random
+import time
+import ray
+
+from byzerllm.utils.client.lease_utils import ModelNotFoundError
+
+
+class RoutingPolicy:
+    LeastOutstanding = "least_outstanding"
+    PowerOfTwo = "power_of_two"
+    WeightedRoundRobin = "weighted_round_robin"
+
+
+# the replica is dead or not deployed, the request can be retried safely on another replica.
+# ActorDiedError and ActorUnavailableError are subclasses of RayActorError
+REPLICA_FAILURES = (ray.exceptions.RayActorError,ModelNotFoundError)
+
+
+def is_replica_failure(inst:BaseException)->bool:
+    '''
+    The exception raised by the worker is re-raised as a `RayTaskError` which is also an instance of its cause, 
+    e.g. a ValueError of a bad prompt. It means the replica is alive, so it is not a replica failure.
+    '''
+    return isinstance(inst,REPLICA_FAILURES) and not isinstance(inst,ray.exceptions.RayTaskError)
+
+
+class ModelGroup:
+    '''
+    A group of deployments (replicas) of the same model, e.g. `qwen_a`,`qwen_b`.
+    The outstanding requests of every replica are tracked in this process, and the
+    replica which fails is ejected for `eject_seconds`.
+
+    Policies:
+        least_outstanding: the replica with the least outstanding requests
+        power_of_two: pick two replicas randomly and choose the one with less outstanding requests
+        weighted_round_robin: smooth weighted round robin by `weights`
+
+    If `max_outstanding` is set, the replicas which reach it are treated as overloaded and skipped
+    unless all the replicas are overloaded.
+    '''
+    def __init__(self,name:str,replicas:List[str],
+                 policy:str=RoutingPolicy.LeastOutstanding,
+                 weights:Optional[List[float]]=None,
+                 eject_seconds:float=30,
+                 max_outstanding:Optional[int]=None,
+                 max_retries:int=1):
+        if not replicas:
+            raise Exception(f"model group {name} should have at least one replica")
+        if policy not in [RoutingPolicy.LeastOutstanding,RoutingPolicy.PowerOfTwo,RoutingPolicy.WeightedRoundRobin]:
+            raise Exception(f"Unknown routing policy {policy}")
+        if weights is not None and len(weights) != len(replicas):
+            raise Exception("the size of weights should be the same as replicas")
+
+        self.name = name
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.weights = dict(zip(self.replicas,weights if weights is not None else [1] * len(self.replicas)))
+        self.eject_seconds = eject_seconds
+        self.max_outstanding = max_outstanding
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.outstanding:Dict[str,int] = {replica:0 for replica in self.replicas}
+        self.ejected_until:Dict[str,float] = {}
+        self.current_weights:Dict[str,float] = {replica:0 for replica in self.replicas}
+
+    def _available_replicas(self,exclude:Set[str])->List[str]:
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica not in exclude] or list(self.replicas)
+        healthy = [replica for replica in candidates if self.ejected_until.get(replica,0) <= now]
+        if not healthy:
+            # all the replicas are ejected, try the one which will come back first
+            return [min(candidates,key=lambda replica: self.ejected_until.get(replica,0))]
+        if self.max_outstanding is not None:
+            not_overloaded = [replica for replica in healthy if self.outstanding[replica] < self.max_outstanding]
+            if not_overloaded:
+                return not_overloaded
+        return healthy
+
+    def choose(self,exclude:Set[str]=set())->str:
+        '''
+        choose a replica and increase its outstanding count, call `release` after the request is finished.
+        '''
+        with self.lock:
+            replicas = self._available_replicas(exclude)
+            if len(replicas) == 1:
+                replica = replicas[0]
+            elif self.policy == RoutingPolicy.PowerOfTwo:
+                (a,b) = random.sample(replicas,2)
+                replica = a if self.outstanding[a] <= self.outstanding[b] else b
+            elif self.policy == RoutingPolicy.WeightedRoundRobin:
+                total = 0
+                for r in replicas:
+                    self.current_weights[r] += self.weights[r]
+                    total += self.weights[r]
+                replica = max(replicas,key=lambda r: self.current_weights[r])
+                self.current_weights[replica] -= total
+            else:
+                min_outstanding = min(self.outstanding[r] for r in replicas)
+                replica = random.choice([r for r in replicas if self.outstanding[r] == min_outstanding])
+            self.outstanding[replica] += 1
+            return replica
+
+    def release(self,replica:str,failed:bool=False):
+        with self.lock:
+            self.outstanding[replica] = max(0,self.outstanding[replica] - 1)
+            if failed:
+                self.ejected_until[replica] = time.monotonic() + self.eject_seconds
+            elif replica in self.ejected_until:
+                del self.ejected_until[replica]
+
+    def run(self,func:Callable[[str],Any])->Any:
+        '''
+        run `func(replica)` on the chosen replica, and retry on another replica if the replica fails.
+        '''
+        tried = set()
+        while True:
+            replica = self.choose(exclude=tried)
+            tried.add(replica)
+            try:
+                result = func(replica)
+            except BaseException as inst:
+                if not is_replica_failure(inst):
+                    self.release(replica)
+                    raise
+                self.release(replica,failed=True)
+                if len(tried) > self.max_retries or len(tried) >= len(self.replicas):
+                    raise inst
+                continue
+            self.release(replica)
+            return result
+
+    async def async_run(self,func:Callable[[str],Any])->Any:
+        tried = set()
+        while True:
+            replica = self.choose(exclude=tried)
+            tried.add(replica)
+            try:
+                result = await func(replica)
+            except BaseException as inst:
+                if not is_replica_failure(inst):
+                    self.release(replica)
+                    raise
+                self.release(replica,failed=True)
+                if len(tried) > self.max_retries or len(tried) >= len(self.replicas):
+                    raise inst
+                continue
+            self.release(replica)
+            return result
+
+    def stats(self)->Dict[str,Any]:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "name":self.name,
+                "policy":self.policy,
+                "replicas":[{"name":replica,
+                             "outstanding":self.outstanding[replica],
+                             "weight":self.weights[replica],
+                             "ejected":self.ejected_until.get(replica,0) > now} for replica in self.replicas]
+            }
+
+
+def _hash(s:str)->int:
+    return int(hashlib.md5(s.encode("utf-8")).hexdigest()[:16],16)
+
+
+def conversation_affinity_key(conversations:List[Dict[str,Any]],num_prefix_messages:int=2)->str:
+    '''
+    the hash of the first messages (e.g. the system prompt and the first user message) of the conversation, 
+    which are the same in every turn of a multi-turn chat.
+    '''
+    prefix = [{"role":item.get("role",""),"content":item.get("content","")} for item in conversations[:num_prefix_messages]]
+    return hashlib.md5(json.dumps(prefix,ensure_ascii=False,sort_keys=True,default=str).encode("utf-8")).hexdigest()
+
+
+class AffinityRouter:
+    '''
+    Map the affinity key (e.g. the session id) to the workers of a model with consistent hashing, 
+    so the turns of a conversation land on the same worker and the prefix cache of the worker can be reused, 
+    and only a few keys are moved when the number of workers is changed.
+    '''
+    def __init__(self,virtual_nodes:int=64):
+        self.virtual_nodes = virtual_nodes
+        self.rings:Dict[Tuple[str,int],Tuple[List[int],List[int]]] = {}
+        self.lock = threading.Lock()
+
+    def _get_ring(self,model:str,num_workers:int)->Tuple[List[int],List[int]]:
+        key = (model,num_workers)
+        with self.lock:
+            if key not in self.rings:
+                nodes = sorted([(_hash(f"{model}#{index}#{v}"),index) for index in range(num_workers) for v in range(self.virtual_nodes)])
+                self.rings[key] = ([h for (h,_) in nodes],[index for (_,index) in nodes])
+            return self.rings[key]
+
+    def preferred_workers(self,model:str,num_workers:int,affinity_key:str,limit:Optional[int]=None)->List[int]:
+        '''
+        return the distinct worker indices in the order of preference
+        '''
+        if num_workers <= 0:
+            return []
+        limit = num_workers if limit is None else min(limit,num_workers)
+        (hashes,indices) = self._get_ring(model,num_workers)
+        pos = bisect.bisect(hashes,_hash(affinity_key))
+        result = []
+        for i in range(len(hashes)):
+            index = indices[(pos + i) % len(hashes)]
+            if index not in result:
+                result.append(index)
+                if len(result) >= limit:
+                    break
+        return result
+
+
+AFFINITY_ROUTER = AffinityRouter()
@@ -0,0 +1,203 @@
+from typing import Dict,Any,Optional,List,Callable
+from collections import deque
+import contextvars
+import threading
+import json
+import math
+import time
+import uuid
+
+
+class Span:
+    '''
+    A named phase of a request, e.g. `chat_oai`, `query`, `lease_wait`.
+    The duration is in seconds.
+    '''
+    def __init__(self,name:str,model:Optional[str]=None,
+                 trace_id:Optional[str]=None,
+                 parent_span_id:Optional[str]=None,
+                 attributes:Dict[str,Any]={}):
+        self.name = name
+        self.model = model
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.start = time.monotonic()
+        self.duration = 0.0
+        self.error = None
+
+    def set_attribute(self,key:str,value:Any):
+        self.attributes[key] = value
+
+    def to_dict(self)->Dict[str,Any]:
+        '''
+        OpenTelemetry style representation of the span
+        '''
+        return {
+            "name":self.name,
+            "trace_id":self.trace_id,
+            "span_id":self.span_id,
+            "parent_span_id":self.parent_span_id,
+            "start_time_unix_nano":int(self.start_time * 1e9),
+            "end_time_unix_nano":int((self.start_time + self.duration) * 1e9),
+            "status":"ERROR" if self.error else "OK",
+            "attributes":{"model":self.model,**self.attributes,**({"error":self.error} if self.error else {})}
+        }
+
+
+_current_span:contextvars.ContextVar = contextvars.ContextVar("byzerllm_current_span",default=None)
+
+
+class _SpanContext:
+    def __init__(self,tracer:"Tracer",span:Span):
+        self.tracer = tracer
+        self.span = span
+        self.token = None
+
+    def __enter__(self)->Span:
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self,exc_type,exc_value,tb):
+        self.span.duration = time.monotonic() - self.span.start
+        if exc_type is not None:
+            self.span.error = f"{exc_type.__name__}: {exc_value}"
+        _current_span.reset(self.token)
+        self.tracer.export(self.span)
+        return False
+
+
+class _NullSpanContext:
+    def __enter__(self):
+        return None
+
+    def __exit__(self,exc_type,exc_value,tb):
+        return False
+
+_NULL_SPAN_CONTEXT = _NullSpanContext()
+
+
+class Tracer:
+    '''
+    Record the spans and send them to the exporters. An exporter is a callable which accepts a `Span`.
+    The spans opened inside another span share its trace_id and record it as the parent.
+
+    ```python
+    with tracer.span("query",model="chat") as span:
+        ...
+    ```
+    When there is no exporter, `span` returns a no-op context manager which yields None.
+    '''
+    def __init__(self):
+        self.exporters:List[Callable[[Span],None]] = []
+
+    @property
+    def enabled(self)->bool:
+        return len(self.exporters) > 0
+
+    def add_exporter(self,exporter:Callable[[Span],None]):
+        self.exporters.append(exporter)
+
+    def clear_exporters(self):
+        self.exporters = []
+
+    def span(self,name:str,model:Optional[str]=None,**attributes):
+        if not self.exporters:
+            return _NULL_SPAN_CONTEXT
+        parent = _current_span.get()
+        span = Span(name,model=model,
+                    trace_id=parent.trace_id if parent is not None else None,
+                    parent_span_id=parent.span_id if parent is not None else None,
+                    attributes=attributes)
+        return _SpanContext(self,span)
+
+    def export(self,span:Span):
+        for exporter in self.exporters:
+            try:
+                exporter(span)
+            except Exception:
+                pass
+
+
+class HistogramRegistry:
+    '''
+    Keep the latest `max_samples` durations of every (model, span name) and compute the percentiles.
+    Use it as an exporter of `Tracer`.
+    '''
+    def __init__(self,max_samples:int=10000):
+        self.max_samples = max_samples
+        self.samples:Dict[tuple,deque] = {}
+        self.counts:Dict[tuple,int] = {}
+        self.errors:Dict[tuple,int] = {}
+        self.lock = threading.Lock()
+
+    def __call__(self,span:Span):
+        self.observe(span.model,span.name,span.duration,error=span.error is not None)
+
+    def observe(self,model:Optional[str],name:str,duration:float,error:bool=False):
+        key = (model,name)
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = deque(maxlen=self.max_samples)
+                self.counts[key] = 0
+                self.errors[key] = 0
+            self.samples[key].append(duration)
+            self.counts[key] += 1
+            if error:
+                self.errors[key] += 1
+
+    @staticmethod
+    def _percentile(sorted_values:List[float],p:float)->float:
+        if not sorted_values:
+            return 0.0
+        # nearest-rank percentile
+        index = min(len(sorted_values) - 1,max(0,math.ceil(p / 100 * len(sorted_values)) - 1))
+        return sorted_values[index]
+
+    def percentile(self,model:Optional[str],name:str,p:float)->float:
+        with self.lock:
+            values = sorted(self.samples.get((model,name),[]))
+        return self._percentile(values,p)
+
+    def stats(self)->List[Dict[str,Any]]:
+        '''
+        return the count/errors/mean/p50/p90/p99 (in seconds) of every (model, span name)
+        '''
+        with self.lock:
+            items = [(key,sorted(values),self.counts[key],self.errors[key]) for key,values in self.samples.items()]
+        result = []
+        for ((model,name),values,count,errors) in items:
+            result.append({
+                "model":model,
+                "name":name,
+                "count":count,
+                "errors":errors,
+                "mean":sum(values) / len(values) if values else 0.0,
+                "p50":self._percentile(values,50),
+                "p90":self._percentile(values,90),
+                "p99":self._percentile(values,99)
+            })
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+            self.errors.clear()
+
+
+class JsonLinesExporter:
+    '''
+    Append every span to `path` as one json line.
+    '''
+    def __init__(self,path:str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self,span:Span):
+        line = json.dumps(span.to_dict(),ensure_ascii=False,default=str)
+        with self.lock:
+            with open(self.path,"a",encoding="utf-8") as f:
+                f.write(line + "\n")
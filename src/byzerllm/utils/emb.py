@@ -53,10 +53,13 @@ class ByzerLLMEmbeddings(Embeddings):
         if self.pipeline:
             return [self.pipeline(text)[0][-1] for text in texts]
         else:
-            _, embeddings = self.get_embedding_with_token_count(texts)
-            embeddings = embeddings.detach().cpu()
-            embeddings = embeddings.numpy()
-            embeddings = [emb.tolist() for emb in embeddings]
+            batch_size = int(extract_params.get("batch_size",32))
+            embeddings = []
+            # encode in micro batches, so a large list of texts will not run out of the device memory
+            for i in range(0,len(texts),batch_size):
+                with torch.no_grad():
+                    _, batch_embeddings = self.get_embedding_with_token_count(texts[i:i+batch_size])
+                embeddings.extend([emb.tolist() for emb in batch_embeddings.detach().cpu().numpy()])
             return embeddings
         
     def embed_documents(self, texts: List[str],extract_params={}) -> List[List[float]]:        
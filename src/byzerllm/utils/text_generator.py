@@ -1,5 +1,7 @@
 from typing import List,Tuple,Any,Dict
 import json
+import asyncio
+import numpy as np
 from byzerllm import get_real_tokenizer
 from .emb import ByzerLLMEmbeddings,ByzerSentenceTransformerEmbeddings
 
@@ -20,6 +22,22 @@ class ByzerLLMGenerator:
             else:    
                 self.embedding = ByzerLLMEmbeddings(model,self.tokenizer,use_feature_extraction=use_feature_extraction)
     
+    def embed_documents(self,texts:List[str],extract_params:Dict[str,Any]={})->np.ndarray:
+        '''
+        embed the texts in micro batches of `batch_size`(default 32) and return a N x D float32 array
+        '''
+        extract_params = {"batch_size":32,**extract_params}
+        model = getattr(self.embedding,"model",None)
+        if hasattr(model,"embed_documents"):
+            embeddings = model.embed_documents(texts,extract_params=extract_params)
+        elif hasattr(self.embedding,"embed_documents"):
+            embeddings = self.embedding.embed_documents(texts,extract_params=extract_params)
+        elif hasattr(model,"embed_query"):
+            embeddings = [model.embed_query(text,extract_params=extract_params) for text in texts]
+        else:
+            embeddings = [self.embedding.embed_query(text,extract_params=extract_params) for text in texts]
+        return np.asarray(embeddings,dtype=np.float32)
+
     def extract_history(self,input)-> List[Dict[str,str]]:
         history = input.get("history",[])
         return history
@@ -48,11 +66,17 @@ class ByzerLLMGenerator:
                 if k.startswith("generation."):
                     new_params[k[len("generation."):]] = v 
             
+            if query.get("embedding_batch",False):
+                return self.embed_documents(ins,extract_params=new_params)
+
             if hasattr(self.embedding.model,"embed_query"):
                 return self.embedding.model.embed_query(ins,extract_params=new_params)
             
             return self.embedding.embed_query(ins,extract_params=new_params)
         
+        if query.get("meta",False) and not self.model and self.embedding:
+            return [{"model_deploy_type":"proprietary"}]
+
         if not self.model:
             raise Exception("This model do not support text generation service")
 
@@ -116,11 +140,17 @@ class ByzerLLMGenerator:
                 if query.get("embed_rerank", False):
                     return self.embedding.embed_rerank(ins,extract_params=new_params)
 
+                if query.get("embedding_batch",False):
+                    return self.embed_documents(ins,extract_params=new_params)
+
                 if hasattr(self.embedding.model,"embed_query"):
                     return self.embedding.model.embed_query(ins,extract_params=new_params)
                 
                 return self.embedding.embed_query(ins,extract_params=new_params)                        
 
+            if query.get("meta",False) and not self.model and self.embedding:
+                return [{"model_deploy_type":"proprietary"}]
+
             if not self.model:
                 raise Exception("This model do not support text generation service")
             
@@ -167,15 +197,66 @@ class ByzerLLMGenerator:
             return response[-1]
 
 
+def decode_input_value(v)->Tuple[List[Dict[str,Any]],bool]:
+    '''
+    The client sends the items as json strings, or as plain python objects if the worker 
+    supports the binary protocol (`support_binary_protocol` in meta). In the binary protocol 
+    the objects are serialized by Ray directly, so there is no json encoding/decoding and 
+    numpy arrays are passed by zero-copy.
+    return (items, is_binary)
+    '''
+    is_binary = len(v) > 0 and all(not isinstance(item,str) for item in v)
+    return ([item if not isinstance(item,str) else json.loads(item) for item in v],is_binary)
+
+def encode_output_value(results:List[Dict[str,Any]],is_binary:bool)->Dict[str,Any]:
+    if is_binary:
+        return {"value":[results]}
+    return {"value":[json.dumps(results,ensure_ascii=False)]}
+
+def with_binary_protocol(meta):
+    '''
+    tell the client this worker supports the binary protocol
+    '''
+    if isinstance(meta,list):
+        return [{**item,"support_binary_protocol":True} if isinstance(item,dict) else item for item in meta]
+    return meta
+
+def with_batch_embedding(meta):
+    '''
+    tell the client this worker accepts one embedding request with a list of texts(`embedding_batch`)
+    '''
+    if isinstance(meta,list):
+        return [{**item,"support_batch_embedding":True} if isinstance(item,dict) else item for item in meta]
+    return meta
+
+def encode_embeddings(v,is_binary:bool):
+    '''
+    the N x D float32 array of the batch embedding is sent as is in the binary protocol, 
+    otherwise as nested lists.
+    '''
+    if isinstance(v,np.ndarray) and not is_binary:
+        return v.tolist()
+    return v
+
 async def simple_predict_func(model,v):
     (model,tokenizer) = model
     llm = ByzerLLMGenerator(model,tokenizer)
-    data = [json.loads(item) for item in v]
+    (data,is_binary) = decode_input_value(v)
+    
+    # run the items concurrently, so the backends like vLLM can 
+    # batch the requests which are sent in one call.
+    outputs = await asyncio.gather(*[llm.async_predict(item) for item in data])
     
     results=[]
-    for item in data:        
-        v = await llm.async_predict(item)
-        
+    for item,v in zip(data,outputs):        
+        if item.get("meta",False):
+            v = with_binary_protocol(v)
+            if llm.embedding is not None:
+                v = with_batch_embedding(v)
+
+        if item.get("embedding_batch",False):
+            v = encode_embeddings(v,is_binary)
+
         if item.get("tokenizer",False) or item.get("embedding",False) or item.get("meta",False) or item.get("apply_chat_template",False):
             results.append({
             "predict":v,
@@ -191,13 +272,13 @@ async def simple_predict_func(model,v):
                 "metadata":metadata,
                 "input":item})
 
-    return {"value":[json.dumps(results,ensure_ascii=False)]}
+    return encode_output_value(results,is_binary)
 
 
 def chatglm_predict_func(model,v):
     (trainer,tokenizer) = model
     llm = ByzerLLMGenerator(trainer,tokenizer,use_feature_extraction=True)
-    data = [json.loads(item) for item in v]
+    (data,is_binary) = decode_input_value(v)
     
     results=[]
     for item in data:
@@ -205,6 +286,14 @@ def chatglm_predict_func(model,v):
             item["instruction"] = f'{item["system"]}\n{item["instruction"]}'
         v = llm.predict(item)
 
+        if item.get("meta",False):
+            v = with_binary_protocol(v)
+            if llm.embedding is not None:
+                v = with_batch_embedding(v)
+
+        if item.get("embedding_batch",False):
+            v = encode_embeddings(v,is_binary)
+
         if item.get("tokenizer",False) or item.get("embedding",False) or item.get("meta",False) or item.get("apply_chat_template",False):
             results.append({
             "predict":v,
@@ -220,10 +309,10 @@ def chatglm_predict_func(model,v):
                 "metadata":metadata,
                 "input":item})
         
-    return {"value":[json.dumps(results,ensure_ascii=False)]}
+    return encode_output_value(results,is_binary)
 
 def qa_predict_func(model,v):        
-    data = [json.loads(item) for item in v]
+    (data,is_binary) = decode_input_value(v)
     
     results=[]
     for item in data:
@@ -234,4 +323,4 @@ def qa_predict_func(model,v):
             "predict":v,
             "input":item})
         
-    return {"value":[json.dumps(results,ensure_ascii=False)]}
\ No newline at end of file
+    return encode_output_value(results,is_binary)
\ No newline at end of file